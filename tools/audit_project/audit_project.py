@@ -17,15 +17,37 @@ Instructions:
 9. look at the output
    TODO
 
+The checks are run directly by rule_runner.py. Every check is run, not just
+up to the first failure. Other options:
+   --jobs N            spread the checks over N processes
+   --json FILE         also write the results as JSON
+   --junit FILE        also write the results as JUnit xml
+   --profile FILE      time each check, write the times and memory as csv
+   --watch DIR         keep running, auditing exports in DIR as they change
+   --fix FILE          write a copy with drifted ob_* alerts and surveys fixed
+
+Give several files, or a directory, to audit them side by side
+   ./audit_project.py --jobs 4 ../../previous_versions ../../latest_version
+   --pytest            hand over to pytest instead (stops at first failure)
+
+The checks are also still a pytest test module:
+   pytest audit_project.py --projxmlfile downloadefile.xml
+
 """
 
-from copy import deepcopy
 from os import access, R_OK
-from os.path import isfile
+from os.path import isdir, isfile, realpath
+import argparse
 import sys
 
-import pytest
-from lxml import etree
+from banned_strings import scan_file
+from calc_graph import form_graph
+from field_references import find_references
+from form_compare import compare_observations
+from project_model import ODM, REDCAP, iter_chunks
+from redcap_logic import equivalent, fields
+from rule_runner import rule, skip_rule
+from template_families import copy_differences, template_families
 
 EXPECTED_OBSERVATIONS = [
     'ob_template', 'ob_0',
@@ -54,91 +76,97 @@ STAFF_ALERT_PHONENUM = '61482525929'
 DEVELOPER_PHONENUMBERS = ['', '']
 DEVELOPER_EMAILS = ['', ]
 
-# We're using pytest for most of the heavy lifting, but we need a way to
-# pass in the project XML file from the cmdline. Pytest makes that difficult
-# we have to define a cmldine arg '--projxmlfile' in the conftest.py file
-#
-# Then we don't want to parse the XML in every single test. So we parse it
-# once and cache it in a module global variable
-GLOBAL_REDCAP_XML_ROOT = None
-
-
-@pytest.fixture
-def projxmlpath(request):
-    """Get the filepath to the XML file under test"""
-    return request.config.getoption("--projxmlfile")
-
-
-@pytest.fixture
-def proj(request):
-    """Get a lxml root element for the redcap project xml file
-    Cache it in GLOBAL_REDCAP_XML_ROOT so we don't parse it every time"""
-    global GLOBAL_REDCAP_XML_ROOT
-
-    if GLOBAL_REDCAP_XML_ROOT is None:
-        try:
-            xmlfilepath = request.config.getoption("--projxmlfile")
-            GLOBAL_REDCAP_XML_ROOT = etree.parse(xmlfilepath).getroot()
-        except Exception:
-            pytest.exit("Couldn't parse XML file %s" % pytest.GLOBAL_REDCAP_XML_FILEPATH)
-
-    if GLOBAL_REDCAP_XML_ROOT is None:
-        pytest.exit("Error accessing project xml root")
-
-    return GLOBAL_REDCAP_XML_ROOT
-
-
+# Things copied from ob_template for every observation, by family
+# (see template_families.py)
+STAFF_ALERT_SMS_FAMILY = ('alert', 'Obs Combined Staff alert - ob_template', 'SMS')
+STAFF_ALERT_EMAIL_FAMILY = ('alert', 'Obs Combined Staff alert email - ob_template', 'EMAIL')
+PATIENT_ALERT_SMS_FAMILY = ('alert', 'Obs Combined Patient alert - ob_template', 'SMS')
+LATE_OBS_ALERT_SMS_FAMILY = ('alert', 'Late obs staff - ob_template', 'SMS')
+INVITE_FAMILY = ('invite', 'ob_template')
+
+# What each family's copies may do differently from the template
+TEMPLATE_FAMILY_RULES = {
+    # Morning and afternoon alerts go out at different times
+    STAFF_ALERT_SMS_FAMILY: {'ignore': ['cron_send_email_on_next_time']},
+    STAFF_ALERT_EMAIL_FAMILY: {'ignore': ['cron_send_email_on_next_time']},
+    # Late alerts hang off the preceding observation's form
+    LATE_OBS_ALERT_SMS_FAMILY: {'ignore': ['cron_send_email_on_next_time', 'form_name']},
+    # ob_template's invite is switched off, only the message is copied. The
+    # schedule is checked by test_observation_auto_invite_settings
+    INVITE_FAMILY: {'only': ['email_subject', 'email_content', 'delivery_type']},
+}
+
+# Families with a check of their own, test_observation_copies_match_their_templates
+# checks the rest
+FAMILIES_WITH_OWN_RULE = {
+    STAFF_ALERT_SMS_FAMILY, STAFF_ALERT_EMAIL_FAMILY, PATIENT_ALERT_SMS_FAMILY,
+    LATE_OBS_ALERT_SMS_FAMILY,
+    ('survey', 'ob_template'),  # test_observation_surveys_settings_all_match_template_settings
+    ('form', 'ob_template'),    # test_observation_structure_matches_template
+}
+
+
+# Text that must not appear anywhere in the project xml file, by category.
+# Literal strings, or compiled bytes regexes eg re.compile(rb'04\d{8}')
+# See banned_strings.py
+BANNED_STRINGS = {
+    # We should use COVID-19 not covid Covid covid-19
+    'covid_capitals': ['covid', 'Covid'],
+    'developer_email': DEVELOPER_EMAILS,
+    'developer_phone': DEVELOPER_PHONENUMBERS,
+    # The pre may 2020 staff email address
+    'old_staff_email': ['covidhmp@mh.org.au'],
+}
+
+
+@rule()
 def test_twilio_sending_from_australian_mobilenum(proj):
     """Project should be configured to send from our twilo australian number"""
-    pytest.skip("Project settings aren't present in XML file. Need to find alternate test method.")
+    skip_rule("Project settings aren't present in XML file. Need to find alternate test method.")
     # assert == AUSTRALIAN_TWILIO_NUMBER
 
 
+@rule()
 def test_patient_mobile_is_entered_in_international_format(proj):
-    # TODO field helper function
-    xpath = r"./Study/MetaDataVersion/ItemDef/[@OID='mobile']"
-    itemdef = proj.find(xpath, proj.nsmap)
+    itemdef = proj.item('mobile')
     assert itemdef is not None
     assert itemdef.attrib['{https://projectredcap.org}FieldType'] == "text"
     assert itemdef.attrib['DataType'] == "integer"
 
-    # TODO make validation lookup helper
     # There should be min/max integer validation enforcing the number format
-    # We have to use .xpath() here not .find()
-    # And .xpath() takes a different namespace argument to .find()
-    xpathns = {'xmlns': proj.nsmap[None]}
-    xpathmin = r'./xmlns:RangeCheck/xmlns:CheckValue[text()="61400000000"]'
-    xpathmax = r'./xmlns:RangeCheck/xmlns:CheckValue[text()="61499999999"]'
-    range_check_min = itemdef.xpath(xpathmin, namespaces=xpathns)
-    range_check_max = itemdef.xpath(xpathmax, namespaces=xpathns)
-    assert range_check_min is not None
-    assert range_check_max is not None
+    check_values = get_range_check_values(itemdef)
+    assert "61400000000" in check_values
+    assert "61499999999" in check_values
 
 
+@rule()
 def test_observation_template_exists(proj):
     assert get_instrument(proj, 'ob_template') is not None
 
 
+@rule()
 def test_registration_instrument_exists(proj):
     assert get_instrument(proj, 'registration') is not None
 
 
+@rule()
 def test_clinicalnotes_instrument_exists(proj):
     assert get_instrument(proj, 'clinicalnote') is not None
 
 
+@rule()
 def test_clinicalnotes_is_repeating_instrument(proj):
     """Clinical Notes must be set as repeatable so clinician's can add many notes"""
-    instr = "clinicalnote"
-    xpath = r"./Study/GlobalVariables/redcap:RepeatingInstrumentsAndEvents/redcap:RepeatingInstruments/redcap:RepeatingInstrument[@redcap:RepeatInstrument='%s']" % instr
-    assert proj.find(xpath, proj.nsmap) is not None
+    assert proj.repeating_instrument('clinicalnote') is not None
 
 
+@rule()
 def test_clinicalnotes_instrument_has_survey(proj):
     """Clinical Notes survey must be available as a survey"""
     assert get_instrument_survey(proj, 'clinicalnote') is not None
 
 
+@rule()
 def test_clinicalnotes_survey_repeat_settings(proj):
     """Clinical Notes survey has to be able to repeat and should prompt the
     user to """
@@ -151,151 +179,81 @@ def test_clinicalnotes_survey_repeat_settings(proj):
     assert surv.attrib['repeat_survey_btn_text'] == "Add another clinical note"
 
 
+@rule()
 def test_all_surveys_are_set_to_enhanced_ui(proj):
     """All surveys should have the 'Use enhanced radio buttons and checkboxes?'
     setting ticked"""
-    xpath = r"./Study/GlobalVariables/redcap:SurveysGroup/redcap:Surveys"
-    return proj.find(xpath, proj.nsmap)
-    for surv in proj.find(xpath, proj.nsmap):
+    for surv in proj.all_surveys():
         assert surv.attrib['enhanced_choices'] == "1"
 
 
-@pytest.mark.parametrize("obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_exists(proj, obs):
     assert get_instrument(proj, obs) is not None
 
 
-# TODO rename and test this
-def form_tree_definition(proj, formname):
-    """Turn the form (instrument) definition in the project xml file into
-    a python dictionary tree.
-
-    In the XML structure items are defined in different places and the are
-    various places where 'ref' items have to be looked up to find 'def'.
-
-    Turn it into a nice neat:
-    FormDef
-        ItemGroup(s)
-            Item(s)
-    """
-
-    """
-    Form Def
-    <FormDef OID="Form.ob_template" Name="Ob Template" Repeating="No" redcap:FormName="ob_template">
-        <ItemGroupRef ItemGroupOID="ob_template.timestamp_template" Mandatory="No"/>
-        ...
-    </FormDef>
-
-
-    <ItemGroupDef OID="ob_template.timestamp_template" Name="Ob Template" Repeating="No">
-        <ItemRef ItemOID="timestamp_template" Mandatory="No" redcap:Variable="timestamp_template"/>
-        <ItemRef ItemOID="title_measurements_template" Mandatory="No" redcap:Variable="title_measurements_template"/>
-        ...
-    </ItemGroupDef>
-    <ItemGroupDef OID="ob_template.supqn_tired_template" Name="Confirm and Submit" Repeating="No">
-        ...
-    </ItemGroupDef>
-    ...
-    """
-
-    tree = {}
-    xpath = r"./Study/MetaDataVersion/FormDef/[@OID='%s']" % formname
-    root = proj.find(xpath, proj.nsmap)
-
-    tree = {**tree, **root.attrib}
-    # tree['ItemGroupRef'] = []
-    # tree['ItemGroupDef'] = []
-    tree['ItemGroup'] = []
-
-    for igr in root.getchildren():
-        igr_oid = igr.attrib['ItemGroupOID']
-
-        igd_xpath = r"./Study/MetaDataVersion/ItemGroupDef/[@OID='%s']" % igr_oid
-        igd = proj.find(igd_xpath, proj.nsmap)
-
-        itemgroup = {**igr.attrib, **igd.attrib}
-
-        itemgroup['Item'] = []
-        for itemref in igd.getchildren():
-            item_oid = itemref.attrib['ItemOID']
-
-            itmd_xpath = r"./Study/MetaDataVersion/ItemDef/[@OID='%s']" % item_oid
-            itm = proj.find(itmd_xpath, proj.nsmap)
-
-            item = {
-                **itm.attrib
-            }
-            itemgroup['Item'].append(item)
-
-        tree['ItemGroup'].append(itemgroup)
-
-    return tree
-
-
-# TODO rename and test this
-def rename_tree(form_tree, obcode):
-    """Given a tree template from form_tree_definition('Form.ob_template')
-    recurse downwards renaming keys/vals from ob_template to ob_{code}
-
-    Why? This results in a nice python dictionary object that we can ==
-    compare with pytest and get pretty printed diff.
-    """
-    ob_suffix = obcode.split('_')[1]
-    new_suffix = f'_{ob_suffix}'
-    new = deepcopy(form_tree)
-    new['Name'] = new['Name'].replace('Template', ob_suffix)
-    new['OID'] = new['OID'].replace('_template', new_suffix)
-    new['{https://projectredcap.org}FormName'] = new['{https://projectredcap.org}FormName'].replace('_template', new_suffix)
-
-    for ig in new['ItemGroup']:
-        ig['Name'] = ig['Name'].replace('Template', ob_suffix)
-        ig['OID'] = ig['OID'].replace('_template', new_suffix)
-        ig['ItemGroupOID'] = ig['ItemGroupOID'].replace('_template', new_suffix)
-
-        # ig['{https://projectredcap.org}FormName'] = new['{https://projectredcap.org}FormName'].replace('_template', new_suffix)
-
-        for item in ig['Item']:
-
-            for k, v in item.items():
-                item[k] = v.replace('_template', new_suffix)
-
-            # item['Name'] = new['Name'].replace('_template', new_suffix)
-            # item['{https://projectredcap.org}FormName'] = new['{https://projectredcap.org}FormName'].replace('_template', new_suffix)
-
-    return new
-
-
-@pytest.mark.parametrize("obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_structure_matches_template(proj, obs):
+    """Each observation should have the same field structure as ob_template,
+    with _template renamed to its own suffix"""
     # No need to compare template to itself
     if obs == 'ob_template':
         return True
 
-    # Are the fields the same?
-    # Are the
-    # TODO break out all this code
+    differences = get_observation_structure_differences(proj, obs)
+    assert differences == [], differences
+
 
+def get_observation_structure_differences(proj, obs):
+    """How observation obs differs from ob_template. See form_compare.py.
+    Every observation is compared in one sweep, the first time it's asked"""
+    return compare_observations(proj, tuple(EXPECTED_OBSERVATIONS))[obs]
 
 
-    # Should have the same field structure
-    tpl_formdef = form_tree_definition(proj, "Form.ob_template")
-    obs_formdef = form_tree_definition(proj, f"Form.{obs}")
+@rule()
+def test_calc_fields_come_after_the_fields_they_use(proj):
+    """REDCap works out calc fields in one pass in form order. A calc placed
+    before a field it uses sees that field's old value, eg calc_trigger_cr
+    has to come after calc_trigger_mc. Also no calcs depending on themselves"""
+    problems = {}
+    for form in proj.all_forms():
+        form_name = form.attrib[REDCAP + 'FormName']
+        found = form_graph(proj, form_name).problems()
+        if found:
+            problems[form_name] = found
+    assert problems == {}
 
-    assert obs_formdef == rename_tree(tpl_formdef, obs)
 
+@rule()
+def test_field_references_are_to_fields_that_exist(proj):
+    """Every [field] in alerts, invites, surveys, reports, branching logic,
+    calcs and labels is a field in the project, eg not a deleted supqn_
+    question. REDCap just pipes in a blank"""
+    unknown = find_references(proj).unknown
+    assert unknown == {}, unknown
 
-@pytest.mark.parametrize("obs", EXPECTED_OBSERVATIONS)
+
+@rule(over=EXPECTED_OBSERVATIONS)
+def test_observation_only_refers_to_its_own_fields(proj, obs):
+    """The observation's alerts, invite, survey and fields don't refer to
+    another observation's fields, eg [hr_3a] left in an ob_4a alert"""
+    crossed = find_references(proj).crossed.get(obs, [])
+    assert crossed == [], crossed
+
+
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_has_survey(proj, obs):
     """Is a survey instrument defined for this observation"""
     assert get_instrument_survey(proj, obs) is not None
 
 
-@pytest.mark.parametrize("obs", EXPECTED_OBSERVATION_AUTOMATIC_INVITES)
+@rule(over=EXPECTED_OBSERVATION_AUTOMATIC_INVITES)
 def test_observation_has_automated_invite(proj, obs):
     """Does this observation (eg ob_3a) have an automatic invite defined"""
     assert get_instrument_survey_automated_invite(proj, obs) is not None
 
 
+@rule()
 def test_registration_does_not_have_automated_invite(proj):
     """Registration is triggered by a staff member opening a link to register
     a new patient. It should not be automatically sent to anyone"""
@@ -304,16 +262,19 @@ def test_registration_does_not_have_automated_invite(proj):
     assert invite is None or invite.attrib['active'] == '0'
 
 
+@rule()
 def test_clinicalnote_does_not_have_automated_invite(proj):
     invite = get_instrument_survey_automated_invite(proj, 'clinicalnote')
     assert invite is None or invite.attrib['active'] == '0'
 
 
+@rule()
 def test_observation_template_does_not_have_automated_invite(proj):
     invite = get_instrument_survey_automated_invite(proj, 'ob_template')
     assert invite is None or invite.attrib['active'] == '0'
 
 
+@rule()
 def test_first_observation_does_not_have_automated_invite(proj):
     """The patient gets a link to their first observation during their
     registration, not via automatic invites"""
@@ -321,6 +282,7 @@ def test_first_observation_does_not_have_automated_invite(proj):
     assert invite is None or invite.attrib['active'] == '0'
 
 
+@rule()
 def test_observation_survey_template_settings(proj):
     surv = get_instrument_survey(proj, 'ob_template')
 
@@ -341,6 +303,7 @@ def test_observation_survey_template_settings(proj):
     assert surv.attrib['enhanced_choices'] == "1"
 
 
+@rule()
 def test_observation_surveys_settings_all_match_template_settings(proj):
     """Every observation survey should match the settings on ob_template"""
     template = get_instrument_survey(proj, 'ob_template')
@@ -366,7 +329,7 @@ def test_observation_surveys_settings_all_match_template_settings(proj):
         assert surv_vars == template_vars
 
 
-@pytest.mark.parametrize("obs", EXPECTED_OBSERVATION_AUTOMATIC_INVITES)
+@rule(over=EXPECTED_OBSERVATION_AUTOMATIC_INVITES)
 def test_observation_auto_invite_settings(proj, obs):
     """Check a number of specific logic / settings on observation auto invite"""
     invite = get_instrument_survey_automated_invite(proj, obs)
@@ -420,6 +383,7 @@ def test_observation_auto_invite_settings(proj, obs):
     assert invite.attrib['reminder_timelag_minutes'] == "0"
 
 
+@rule()
 def test_observation_auto_invite_all_have_same_text(proj):
     # Grab the invite message text from each observation invite
     invite_texts = [
@@ -436,31 +400,39 @@ def test_observation_auto_invite_all_have_same_text(proj):
 
 
 
+@rule()
 def test_alert_template_exists_combined_staff_alert_sms_exists(proj):
     assert get_alert_template_combined_staff_alert_sms(proj) is not None
 
 
+@rule()
 def test_alert_template_exists_combined_staff_alert_email_exists(proj):
     assert get_alert_template_combined_staff_alert_email(proj) is not None
 
 
+@rule()
 def test_alert_template_exists_combined_patient_alert_sms_exists(proj):
     assert get_alert_template_combined_patient_alert_sms(proj) is not None
 
 
+@rule()
+def test_alert_template_exists_late_obs_staff_alert_sms_exists(proj):
+    assert get_alert_template_late_obs_staff_alert_sms(proj) is not None
+
+
+@rule()
 def test_email_alerts_have_to_address(proj):
     """All email alerts in the system must have an email-to address.
     Regression test. One of our tools broke and removed the to address in some
     existing email alerts
     """
-    alerts_path = r"./Study/GlobalVariables/redcap:AlertsGroup"
-    alerts = proj.find(alerts_path, proj.nsmap)
-    xpath = f"redcap:Alerts/[@alert_type='EMAIL']"
-    for alert in alerts.findall(xpath, proj.nsmap):
+    for alert in proj.all_alerts():
+        if alert.attrib['alert_type'] != 'EMAIL':
+            continue
         assert alert.attrib['email_to'] > ''
 
 
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_has_staff_alerts(proj, obs):
 
     # SMS combined alert
@@ -474,7 +446,7 @@ def test_observation_has_staff_alerts(proj, obs):
     assert node is not None
 
 
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_has_patient_alert(proj, obs):
     # SMS combined alert
     alert_title = "Obs Combined Patient alert - %s" % obs
@@ -482,40 +454,30 @@ def test_observation_has_patient_alert(proj, obs):
     assert node is not None
 
 
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_staff_alerts_match_template(proj, obs):
     """Each ob_nn observation staff alert should have the same structure and
     content as the ob_template version of the alert. Tests SMS and EMAIL version"""
     if obs == "ob_template":
         return True
 
-    ignore_fields = ['cron_send_email_on_next_time']
+    diffs = get_template_copy_differences(
+        proj, obs, [STAFF_ALERT_SMS_FAMILY, STAFF_ALERT_EMAIL_FAMILY])
+    assert diffs == {}, diffs
 
-    template = get_alert_template_combined_staff_alert_sms(proj)
-    alert_title = "Obs Combined Staff alert - %s" % obs
-    sms = get_alert(proj, alert_title, form_name=obs, alert_type='SMS')
-    assert obs_alert_matches_template(sms, obs, template, ignore_fields)
-
-    template = get_alert_template_combined_staff_alert_email(proj)
-    alert_title = "Obs Combined Staff alert email - %s" % obs
-    email = get_alert(proj, alert_title, form_name=obs, alert_type='EMAIL')
-    assert obs_alert_matches_template(email, obs, template, ignore_fields)
 
-
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_observation_patient_alerts_match_template(proj, obs):
     """Each ob_nn observation alert for the patient should have the same
     content and settings as the ob_template version."""
     if obs == "ob_template":
         return True
 
-    template = get_alert_template_combined_patient_alert_sms(proj)
-    alert_title = "Obs Combined Patient alert - %s" % obs
-    sms = get_alert(proj, alert_title, form_name=obs, alert_type='SMS')
-    assert obs_alert_matches_template(sms, obs, template, [])
+    diffs = get_template_copy_differences(proj, obs, [PATIENT_ALERT_SMS_FAMILY])
+    assert diffs == {}, diffs
 
 
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_late_observation_staff_alert_match_template(proj, obs):
     """Each 'Late obs staff - ob_xx' alert should have the same structure and
     content as the 'Late obs staff - ob_template' version of the alert."""
@@ -530,15 +492,32 @@ def test_late_observation_staff_alert_match_template(proj, obs):
     # See documentation/redcap_design_overview.md  'Late Observation Alert for Staff'
     preceding_obs = get_obs_preceding_obs(obs)
     alert_title = "Late obs staff - %s" % obs
-    sms = get_alert(proj, alert_title, form_name=preceding_obs, alert_type='SMS')
-    template = get_alert_template_late_obs_staff_alert_sms(proj)
+    assert get_alert(proj, alert_title, form_name=preceding_obs, alert_type='SMS') is not None
+
+    diffs = get_template_copy_differences(proj, obs, [LATE_OBS_ALERT_SMS_FAMILY])
+    assert diffs == {}, diffs
+
+
+@rule(over=EXPECTED_OBSERVATIONS)
+def test_observation_copies_match_their_templates(proj, obs):
+    """Everything else copied from ob_template for each observation, found by
+    name (see template_families.py), should match its template. Covers any new
+    alerts made from ob_template without a check of their own"""
+    if obs == "ob_template":
+        return True
+
+    others = [key for key in template_families(proj) if key not in FAMILIES_WITH_OWN_RULE]
+    diffs = get_template_copy_differences(proj, obs, others)
+    assert diffs == {}, diffs
 
-    # Ignore the time of day, that will be different for morning/afternoons
-    ignore_fields = ['cron_send_email_on_next_time']
-    assert obs_alert_matches_template(sms, obs, template, ignore_fields)
 
+def get_template_copy_differences(proj, obs, families):
+    """How the observation's copies of the ob_template things in families
+    differ from them. {family: [difference, ...]}"""
+    return copy_differences(proj, obs, TEMPLATE_FAMILY_RULES, families)
 
-@pytest.mark.parametrize(", obs", EXPECTED_OBSERVATIONS)
+
+@rule(over=EXPECTED_OBSERVATIONS)
 def test_late_observation_staff_alert_triggers_at_5_hours(proj, obs):
     # We don't worry about late observations for the demo _0 obs
     if obs in ["ob_template", "ob_0"]:
@@ -559,6 +538,7 @@ def test_late_observation_staff_alert_triggers_at_5_hours(proj, obs):
         assert False  # unknown obcode
 
 
+@rule()
 def test_registered_patients_should_immediately_be_directed_to_consent_form(proj):
     """After a patient is registered we then ask them to fill out the Consent
     instrument"""
@@ -570,14 +550,14 @@ def test_registered_patients_should_immediately_be_directed_to_consent_form(proj
     sms = get_alert(proj, title=TITLE, form_name='registration', alert_type='SMS')
     assert sms is not None
 
-    # TODO change this to be an AST comparison so it's less flakey
     alert_logic = sms.attrib['alert_condition']
-    assert alert_logic == "[mon_group] <> '0'"
+    assert equivalent(alert_logic, "[mon_group] <> '0'")
 
     # Should be sent immediately
     assert sms.attrib['cron_send_email_on'] == 'now'
 
 
+@rule()
 def test_after_completing_consent_patient_should_be_linked_to_first_observation(proj):
     """After patient completes consent form (and agrees) they should be
     get a link telling them what to do next (based on monitoring group)
@@ -591,13 +571,13 @@ def test_after_completing_consent_patient_should_be_linked_to_first_observation(
     sms = get_alert(proj, title=TITLE, form_name=trigger_instrument, alert_type='SMS')
     assert sms is not None
 
-    # TODO change this to be an AST comparison so it's less flakey
     # Check that they've agreed, and they're under observation
     alert_logic = sms.attrib['alert_condition']
-    assert 'cons_agree' in alert_logic
-    assert 'calc_mon_status_observation' in alert_logic
+    assert 'cons_agree' in fields(alert_logic)
+    assert 'calc_mon_status_observation' in fields(alert_logic)
 
 
+@rule()
 def test_staff_are_reminded_to_call_bidaily_patients_after_n_days(proj):
     """We should prompt staff after N days to call our daily monitoring patients"""
 
@@ -612,6 +592,7 @@ def test_staff_are_reminded_to_call_bidaily_patients_after_n_days(proj):
     assert sms.attrib['cron_send_email_on_time_lag_minutes'] == "0"
 
 
+@rule()
 def test_post_discharge_patient_followup_alert_is_scheduled(proj):
     """After a patient has been discharged, and if they are healthy, we should
     contact them after N days and ask them to participtate in our feedback
@@ -629,6 +610,7 @@ def test_post_discharge_patient_followup_alert_is_scheduled(proj):
     assert sms.attrib['cron_send_email_on_time_lag_minutes'] == "0"
 
 
+@rule()
 def test_discharge_reminder_to_staff_should_include_discharge_link(proj):
     """We email staff telling them to discharge a patient when the time comes.
     That email should include a link to jump straight to the discharge form
@@ -640,6 +622,7 @@ def test_discharge_reminder_to_staff_should_include_discharge_link(proj):
     assert '[form-url:discharge]' in sms.attrib['alert_message']
 
 
+@rule()
 def test_patients_awaiting_discharge_should_show_in_awaiting_discharge_report(proj):
     """We have a report 'Patients awaiting discharge' that should show staff
     any patients that they need to discharge."""
@@ -657,69 +640,10 @@ def test_patients_awaiting_discharge_should_show_in_awaiting_discharge_report(pr
     report_logic = rpt.attrib['advanced_logic']
     alert_logic = alert.attrib['alert_condition']
 
-    # TODO change this to be an AST comparison so it's less flakey
-    assert report_logic == alert_logic
-
-
-def obs_alert_matches_template(alert, obsid, templatealert, allowed_field_differences):
-    """Compare a redcap observation <redcap:Alerts nodes to see if its content
-    is equivalent to the _template version of the alert. We don't expect them
-    to be identical. The variables names (eg hr_template hr_1a) will differ
-    and some meta data like alert IDs and timestamps."""
-
-    # These fields we expect to be different
-    ALWAYS_IGNORE_FIELDS = ['alert_number', 'form_name', 'alert_condition',
-                            'alert_message', 'alert_title', 'email_subject',
-                            'email_timestamp_sent', 'email_sent']
-
-    ignore_fields = ALWAYS_IGNORE_FIELDS + allowed_field_differences
-
-    # Compare all the simple fields that should be identical
-    alert_vars = {
-        k: v for k, v in alert.attrib.items() if k not in ignore_fields}
-
-    template_vars = {
-        k: v for k, v in templatealert.attrib.items() if k not in ignore_fields}
-
-    for field in [f for f in templatealert.attrib.keys() if f not in ignore_fields]:
-        # if not alert_vars[field] == template_vars[field]:
-        #     breakpoint()
-
-        #pytest.xfail("Not Implemented")
-        if not alert_vars[field] == template_vars[field]:
-        #    if template_vars[field] == 'covidhmp@mh.org.au':
-        #    breakpoint()
-            pass
-
-        assert alert_vars[field] == template_vars[field]
-
-    if not alert_vars == template_vars:
-        return False
-
-    # Check the content (title, subject, bodytext) of the alert and conditional
-    # logic. These we expect to change based on the obs eg hr_template, hr_3a
-    # eg
-    #    alert_title="Obs Combined Patient alert - ob_4a"
-    #    alert_condition # "[calc_trigger_alert_patient_4a] = 1"
-    fields = ['alert_condition', 'alert_title', 'alert_message']
-    for field in fields:
-        test = equiv_template_text(text=alert.attrib[field],
-                                   tpltext=templatealert.attrib[field],
-                                   expected_obs_id=obsid)
-        # if not test:
-        #    print(f"error with field {field}")
-        #    breakpoint()
-        assert test
-
-    # The alert shouldn't be using any variables that end in _template
-    # [xxx_template] vars either. We might have forgotten to change one when
-    # copying from the template.
-    for field in fields:
-        assert "_template]" not in alert.attrib[field]
-
-    return True
+    assert equivalent(report_logic, alert_logic)
 
 
+@rule()
 def test_staff_reminder_patient_day_7_alert_exists(proj):
     # Staff are reminded to call home observation patients 7 days after they
     # begin their observation.
@@ -741,33 +665,33 @@ def test_staff_reminder_patient_day_7_alert_exists(proj):
 def get_instrument_variable_names(proj, id):
     instr = get_instrument(proj, id)
 
-    item_group_oids = [x.attrib['ItemGroupOID'] for x in
-                       instr.findall(r'./ItemGroupRef', proj.nsmap)]
-
     variables = []
-    for oid in item_group_oids:
-        for item_group_def in proj.findall(r".//ItemGroupDef[@OID='%s']" % oid, proj.nsmap):
-            for item_ref in item_group_def:
-                variables.append(item_ref.attrib['ItemOID'])
+    for item_group_ref in instr:
+        item_group_def = proj.item_group(item_group_ref.attrib['ItemGroupOID'])
+        for item_ref in item_group_def:
+            variables.append(item_ref.attrib['ItemOID'])
 
     return variables
 
 
+def get_range_check_values(itemdef):
+    """The <RangeCheck><CheckValue>s (min/max validation) of an ItemDef"""
+    return [check_value.text
+            for range_check in itemdef if range_check.tag == ODM + 'RangeCheck'
+            for check_value in range_check if check_value.tag == ODM + 'CheckValue']
+
+
 def get_instrument(proj, id):
-    return proj.find(
-        r"./Study/MetaDataVersion/FormDef[@redcap:FormName='%s']" % id,
-        proj.nsmap)
+    return proj.instrument(id)
 
 
 def get_instrument_survey(proj, id):
-    xpath = r"./Study/GlobalVariables/redcap:SurveysGroup/redcap:Surveys[@form_name='%s']" % id
-    return proj.find(xpath, proj.nsmap)
+    return proj.survey(id)
 
 
 def get_instrument_survey_automated_invite(proj, id):
     """Given an instrument id return the automated invite definition if defined"""
-    xpath = r"./Study/GlobalVariables/redcap:SurveysSchedulerGroup/redcap:SurveysScheduler[@survey_id='%s']" % id
-    return proj.find(xpath, proj.nsmap)
+    return proj.invite(id)
 
 
 
@@ -778,7 +702,7 @@ def get_alert_template_combined_staff_alert_sms(proj):
 
     node = get_alert(proj, alert_title, form_name, alert_type)
 
-    assert node.attrib['alert_condition'] == "[calc_trigger_alert_staff_template] = 1"
+    assert equivalent(node.attrib['alert_condition'], "[calc_trigger_alert_staff_template] = 1")
 
     return node
 
@@ -790,7 +714,7 @@ def get_alert_template_combined_staff_alert_email(proj):
 
     node = get_alert(proj, alert_title, form_name, alert_type)
 
-    assert node.attrib['alert_condition'] == "[calc_trigger_alert_staff_template] = 1"
+    assert equivalent(node.attrib['alert_condition'], "[calc_trigger_alert_staff_template] = 1")
 
     return node
 
@@ -802,7 +726,7 @@ def get_alert_template_combined_patient_alert_sms(proj):
 
     node = get_alert(proj, alert_title, form_name, alert_type)
     assert node.attrib['alert_type'] == alert_type
-    assert node.attrib['alert_condition'] == "[calc_trigger_alert_patient_template] = 1"
+    assert equivalent(node.attrib['alert_condition'], "[calc_trigger_alert_patient_template] = 1")
 
     return node
 
@@ -814,25 +738,19 @@ def get_alert_template_late_obs_staff_alert_sms(proj):
 
     node = get_alert(proj, alert_title, form_name, alert_type)
     assert node.attrib['alert_type'] == alert_type
-    assert node.attrib['alert_condition'] == "[calc_allow_patient_comms] = 1 and [timestamp_template] = \"\""
+    assert equivalent(node.attrib['alert_condition'], "[calc_allow_patient_comms] = 1 and [timestamp_template] = \"\"")
 
     return node
 
 
 def get_alert(proj, title, form_name, alert_type):
     """Find REDCap Alert definition node in project xml file"""
-    alerts_path = r"./Study/GlobalVariables/redcap:AlertsGroup"
-    alerts = proj.find(alerts_path, proj.nsmap)
-    xpath = f"redcap:Alerts/[@form_name='{form_name}'][@alert_title='{title}'][@alert_type='{alert_type}']"
-    return alerts.find(xpath, proj.nsmap)
+    return proj.alert(title, form_name, alert_type)
 
 
 def get_report(proj, title):
     """Find REDCap definition node in project xml file"""
-    reports_path = r"./Study/GlobalVariables/redcap:ReportsGroup"
-    reports = proj.find(reports_path, proj.nsmap)
-    xpath = f"redcap:Reports/[@title='{title}']"
-    return reports.find(xpath, proj.nsmap)
+    return proj.report(title)
 
 
 def obs_is_morning(obcode):
@@ -924,6 +842,8 @@ def test_equiv_template_text():
 
 
 def test_get_obs_day():
+    import pytest
+
     assert get_obs_day('ob_0') == 0
     assert get_obs_day('ob_1a') == 1
     assert get_obs_day('ob_2b') == 2
@@ -941,6 +861,8 @@ def test_get_obs_day():
 
 
 def test_get_obs_preceding_obs():
+    import pytest
+
     assert get_obs_preceding_obs('ob_2a') == 'ob_1a'
     assert get_obs_preceding_obs('ob_2b') == 'ob_1b'
     assert get_obs_preceding_obs('ob_10b') == 'ob_9b'
@@ -958,50 +880,280 @@ def test_get_obs_preceding_obs():
         get_obs_preceding_obs('blaa')
 
 
+def test_redcap_logic():
+    """Internal test of the REDCap logic parser and evaluator"""
+    from datetime import datetime
+    from redcap_logic import LogicError, compile_logic
+    import pytest
+
+    assert equivalent("[mon_group] <> '0'", "([mon_group] != 0)")
+    assert equivalent("[a] = 1 and [b] = 2", "[b] = '2' AND [a]=1")
+    assert not equivalent("[a] = 1", "[a] = 2")
+    assert fields("[cons_agree(1)] = 1 and [x] > [y]") == {'cons_agree', 'x', 'y'}
+
+    calc = compile_logic("if([temp_3a] > [fw_high_temp], 1, 0)")
+    assert calc({'temp_3a': '38.7', 'fw_high_temp': '38.5'}) == 1
+    assert calc({'temp_3a': '', 'fw_high_temp': '38.5'}) == 0
+
+    invite = compile_logic("[calc_mon_status_observation] = 1 and "
+                           "datediff([mon_admission_date], 'today', 'd') = 9")
+    record = {'calc_mon_status_observation': '1', 'mon_admission_date': '2020-05-01'}
+    assert invite(record, datetime(2020, 5, 10))
+    assert not invite(record, datetime(2020, 5, 11))
+
+    assert compile_logic("[cons_agree(1)] = '1'")({'cons_agree___1': '1'})
+
+    for bad in ["[a] = ", "if([a], 1)", "nosuchfunction([a])", "[a] = 'x"]:
+        with pytest.raises(LogicError):
+            compile_logic(bad)
+
+
+def test_calc_graph():
+    """Internal test of the calc field dependency graph"""
+    from calc_graph import CalcGraph, calctext
+
+    assert calctext('@HIDDEN @CALCTEXT(if([a] > 1, "y", "n")) @READONLY') == \
+        'if([a] > 1, "y", "n")'
+    assert calctext('@HIDDEN') is None
+
+    graph = CalcGraph((('temp', None), ('c1', '[temp] > 38'), ('c3', '[c2] + 1'),
+                       ('c2', '[c1] * 2'), ('late', None), ('c4', '[late] + [c3]')))
+    assert graph.out_of_order == [('c3', 'c2')]
+    assert graph.cycles == []
+    assert graph.longest == ['c4', 'c3', 'c2', 'c1']
+
+    graph = CalcGraph((('a', '[c]'), ('b', '[a]'), ('c', '[b]'), ('d', '[d] + 1'), ('e', '[a]')))
+    assert graph.cycles == [['a', 'b', 'c'], ['d']]
+    assert graph.longest == ['e']
+
+
+def test_template_family_key():
+    """Internal test of finding ob_template's copies by name"""
+    from template_families import as_template, family_key
+
+    assert family_key('alert', 'Late obs staff - ob_12b', 'SMS') == \
+        (('alert', 'Late obs staff - ob_template', 'SMS'), 'ob_12b')
+    assert family_key('survey', 'ob_0') == (('survey', 'ob_template'), 'ob_0')
+    assert family_key('survey', 'registration') == (None, None)
+    assert family_key('alert', 'Staff Reminder Patient Call BIDAILY Day 7') == (None, None)
+    assert as_template("[calc_trigger_alert_staff_3a] = 1", 'ob_3a') == \
+        "[calc_trigger_alert_staff_template] = 1"
+
+
+def test_fix_project_element():
+    """Internal test of rewriting a drifted alert from its template's bytes"""
+    from fix_project import fixed_element, scan
+
+    buf = (b'<redcap:Alerts alert_title="A - ob_template" alert_type="SMS" alert_number="1" '
+           b'alert_message="&lt;p&gt;[hr_template]\r\n" email_to=""/>\n'
+           b'\t<redcap:Alerts alert_title="A - ob_3a" alert_type="SMS" alert_number="7" '
+           b'alert_message="old" email_to="x"/>')
+    template, copy = scan(buf)
+    assert copy.family() == (('alert', 'A - ob_template', 'SMS'), 'ob_3a')
+    fixed = fixed_element(template, copy, ['alert_message', 'email_to'], 'ob_3a')
+    assert fixed.to_bytes() == (b'<redcap:Alerts alert_title="A - ob_3a" alert_type="SMS" '
+                                b'alert_number="7" alert_message="&lt;p&gt;[hr_3a]\r\n" '
+                                b'email_to=""/>')
+    assert buf[copy.start:copy.end].startswith(b'<redcap:Alerts alert_title="A - ob_3a"')
+
+
+def test_field_reference_tokenize():
+    """Internal test of finding the fields referred to in logic and text"""
+    from field_references import tokenize
+
+    assert tokenize("[hr_3a] > [fw_high_hr] and [cons_agree(1)] = '1'") == \
+        (('hr_3a', None), ('fw_high_hr', None), ('cons_agree', None))
+    assert tokenize("[event_1_arm_1][hr_3a] [survey-url:ob_0] [survey-queue-url]") == \
+        (('hr_3a', None), ('survey-url', 'ob_0'), ('survey-queue-url', None))
+    assert tokenize("No fields [here") == ()
+    assert tokenize("Reply [1] for [event_1_arm_1] or [2]") == ()
+
+
+def test_describe_failure(tmp_path):
+    """Internal test of the native runner's message for a bare failed assert.
+    The asserts are compiled from a file of their own so pytest doesn't
+    rewrite them"""
+    from rule_runner import describe_failure
+
+    rules = tmp_path / 'rules.py'
+    rules.write_text("def fails(attrib):\n"
+                     "    assert attrib['active'] == \\\n"
+                     "        '1'\n"
+                     "def differs(settings, template):\n"
+                     "    assert settings == template\n")
+    found = {}
+    exec(compile(rules.read_text(), str(rules), 'exec'), found)
+
+    for call, expected in ((lambda: found['fails']({'active': '0'}),
+                            "rules.py:2: assert attrib['active'] == '1' (attrib['active'] = '0')"),
+                           (lambda: found['differs']({'a': '1', 'b': '2'}, {'a': '1', 'b': '3'}),
+                            "rules.py:5: assert settings == template ('b': '2' != '3')")):
+        try:
+            call()
+        except AssertionError as exc:
+            assert describe_failure(exc) == expected
+        else:
+            assert False
+
+
+def test_synthetic_project_renamer():
+    """Internal test of renaming a copied observation for a synthetic project"""
+    from synthetic_project import observation_codes, renamer
+
+    assert observation_codes(2, 3) == ['ob_1a', 'ob_1b', 'ob_1c', 'ob_2a', 'ob_2b', 'ob_2c']
+    rename = renamer('ob_2a', 'ob_37a', 'ob_36a')
+    assert rename("[hr_2a] > [hr_1a] and [help_2a___1] and [hr_12a]") == \
+        "[hr_37a] > [hr_36a] and [help_37a___1] and [hr_12a]"
+    assert rename("Ob 2a") == "Ob 37a"
+    assert rename("datediff([mon_admission_date], 'today', 'd') = 1") == \
+        "datediff([mon_admission_date], 'today', 'd') = 36"
+
+
+def test_iter_chunks():
+    """Internal test of the streaming loader skipping attachment payloads"""
+    buf = b'0123456789'
+    assert b''.join(iter_chunks(buf, [])) == buf
+    assert b''.join(iter_chunks(buf, [(2, 4)])) == b'01456789'
+    assert b''.join(iter_chunks(buf, [(0, 2), (8, 10)])) == b'234567'
+
+
+@rule()
 def test_project_uses_capital_letters_for_covid(projxmlpath):
     """We should use COVID-19 not covid Covid covid-19"""
-    with open(projxmlpath) as file:
-        assert "covid" not in file.read()
-    with open(projxmlpath) as file:
-        assert "Covid" not in file.read()
+    assert get_banned_strings(projxmlpath, 'covid_capitals') == []
 
 
+@rule()
 def test_project_doesnt_contain_dev_email(projxmlpath):
-    """Daniel's email should not be present in the project's xml file
-    TODO: Bad test"""
-    for email in DEVELOPER_EMAILS:
-        with open(projxmlpath) as file:
-            assert email not in file.read()
+    """Daniel's email should not be present in the project's xml file"""
+    assert get_banned_strings(projxmlpath, 'developer_email') == []
 
 
+@rule()
 def test_project_doesnt_contain_dev_phone(projxmlpath):
-    """Daniel's email should not be present in the project's xml file
-    TODO: Bad test"""
-    for phone in DEVELOPER_PHONENUMBERS:
-        with open(projxmlpath) as file:
-            assert phone not in file.read()
+    """Daniel's phone number should not be present in the project's xml file"""
+    assert get_banned_strings(projxmlpath, 'developer_phone') == []
 
 
+@rule()
 def test_project_doesnt_contain_old_staff_email(projxmlpath):
     """The pre may 2020 staff email address should not be used anywhere
     in the project xml file"""
-    with open(projxmlpath) as file:
-        assert "covidhmp@mh.org.au" not in file.read()
+    assert get_banned_strings(projxmlpath, 'old_staff_email') == []
 
 
+def get_banned_strings(projxmlpath, category):
+    """Every BANNED_STRINGS[category] hit in the project xml file.
+    The whole file is scanned for every category once, and remembered"""
+    return scan_file(projxmlpath, BANNED_STRINGS)[category]
 
-if __name__ == '__main__':
 
-    # TODO cmd line checking
-    if len(sys.argv) != 2:
-        sys.exit("Usage:\n%s Project.REDCAP.xml" % sys.argv[0])
 
-    proj_path = sys.argv[1]
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Audit a REDCap project xml file")
+    parser.add_argument(
+        'projxmlfile', nargs='*', metavar='Project.REDCAP.xml',
+        help="Export to audit. Several, or a directory, to audit them side by side")
+    parser.add_argument(
+        '--watch', metavar='DIR',
+        help="Keep running, auditing exports in DIR as they change (watch_audit.py)")
+    parser.add_argument(
+        '--jobs', type=int, default=1, metavar='N',
+        help="Run the checks in N processes")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="Only re-run the checks affected by changes since the last audit")
+    parser.add_argument('--json', metavar='FILE', help="Write results as JSON")
+    parser.add_argument('--junit', metavar='FILE', help="Write results as JUnit xml")
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help="Record each check's time and memory, write them as csv to FILE")
+    parser.add_argument(
+        '--pstats', metavar='DIR',
+        help="With --profile, cProfile the slowest rules into DIR")
+    parser.add_argument(
+        '--slowest', type=int, default=10, metavar='N',
+        help="How many of the slowest rules --profile shows (default 10)")
+    parser.add_argument(
+        '--fix', metavar='FILE',
+        help="Also write a copy of the project with drifted observation "
+             "alerts and surveys fixed from ob_template (fix_project.py)")
+    parser.add_argument(
+        '--pytest', action='store_true',
+        help="Run the checks through pytest, stopping at the first failure")
+    args = parser.parse_args()
+    if args.watch:
+        import watch_audit
+
+        watch_audit.watch(args.watch, jobs=args.jobs)
+        sys.exit(0)
+    if not args.projxmlfile:
+        parser.error("give the project xml file to audit, or --watch DIR")
+    if len(args.projxmlfile) > 1 or isdir(args.projxmlfile[0]):
+        if args.incremental or args.junit or args.profile or args.pytest or args.fix:
+            parser.error("only --jobs and --json work with several files")
+        import batch_audit
+
+        sys.exit(0 if batch_audit.batch(args.projxmlfile, args.jobs, json_path=args.json)
+                 else 1)
+    if args.profile and args.incremental:
+        parser.error("--profile times every check, it can't be --incremental")
+    if args.pstats and not args.profile:
+        parser.error("--pstats needs --profile")
+
+    proj_path = args.projxmlfile[0]
 
     if not (isfile(proj_path) and access(proj_path, R_OK)):
         sys.exit("%s does not exist or is not readable" % proj_path)
 
-    # Hand over to pytest
-    # HACK. Stuff xml path into a pytest variable, defined in conftest.py
-    pytest.main(["audit_project.py", "-vvvx",
-                 "--projxmlfile", proj_path])
+    if args.fix and realpath(args.fix) == realpath(proj_path):
+        sys.exit("Write the fixed project to another file")
+
+    if args.pytest:
+        import pytest
+
+        # Stuff xml path into a pytest option, defined in conftest.py
+        sys.exit(pytest.main([__file__, "-vvvx", "--projxmlfile", proj_path]))
+
+    # Imported as a module so the rules register under the name
+    # 'audit_project' and worker processes can find them
+    import audit_project
+    import rule_runner
+
+    if args.incremental:
+        import incremental
+
+        results, reused = incremental.run_incremental(
+            audit_project, proj_path, jobs=args.jobs)
+    else:
+        results, reused = rule_runner.run_checks(
+            audit_project, proj_path, jobs=args.jobs,
+            profile=bool(args.profile)), 0
+    ok = rule_runner.print_report(results, sys.stdout)
+    if reused:
+        print(f"{len(results) - reused} checks run, "
+              f"{reused} unchanged since the last audit")
+
+    if args.json:
+        rule_runner.write_json(results, args.json, proj_path)
+    if args.junit:
+        rule_runner.write_junit(results, args.junit, 'audit_project')
+    if args.profile:
+        import rule_profile
+
+        rule_profile.print_profile(results, sys.stdout, args.slowest)
+        rule_profile.write_profile(results, args.profile)
+        if args.pstats:
+            slowest = [total.rule for total in rule_profile.rule_totals(results)[:args.slowest]]
+            rule_profile.dump_pstats(audit_project, proj_path, slowest, args.pstats)
+
+    if args.fix:
+        import fix_project
+
+        print()
+        fix_project.print_fixes(
+            *fix_project.fix(proj_path, args.fix, TEMPLATE_FAMILY_RULES), sys.stdout)
+
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Scan a REDCap project xml file for text that shouldn't be in it
+
+eg. 'Covid' instead of 'COVID', developer phone numbers, old email addresses
+
+The file is memory mapped and every banned pattern is searched for in one
+pass with a single combined regex. Each hit is reported with its line and
+column, and the REDCap definition it's in (the alert, item, survey, ...).
+
+Patterns are either literal strings or compiled bytes regexes:
+    patterns = {
+        'old_staff_email': ['covidhmp@mh.org.au'],
+        'dev_phone': [re.compile(rb'0412\\s?345\\s?678')],
+    }
+Blank literal strings are ignored, they're placeholders for 'not configured'.
+
+Usage
+  ./banned_strings.py Project.REDCAP.xml TEXT [TEXT ...]
+"""
+
+from functools import lru_cache
+import html
+import mmap
+import os
+import re
+import sys
+
+# The REDCap definitions we name when reporting where a hit is, and the
+# attributes that identify each one
+UNIT_ATTRS = {
+    b'redcap:Alerts': ('alert_title', 'form_name', 'alert_type'),
+    b'redcap:Surveys': ('form_name',),
+    b'redcap:SurveysScheduler': ('survey_id',),
+    b'redcap:Reports': ('title',),
+    b'FormDef': ('OID',),
+    b'ItemGroupDef': ('OID',),
+    b'ItemDef': ('OID',),
+    b'CodeList': ('OID',),
+}
+UNIT_START = b'<(?P<unit>' + b'|'.join(re.escape(tag) for tag in UNIT_ATTRS) + b')[\\s>/]'
+ATTRS = re.compile(rb'([\w:]+)="([^"]*)"')
+
+
+class Hit:
+    """Where a banned pattern was found"""
+
+    __slots__ = ('category', 'text', 'offset', 'line', 'column', 'element')
+
+    def __init__(self, category, text, offset, line, column, element):
+        self.category = category
+        self.text = text
+        self.offset = offset
+        self.line = line
+        self.column = column
+        self.element = element
+
+    def __repr__(self):
+        return f'{self.line}:{self.column} {self.text!r} in {self.element}'
+
+
+def compile_pattern(pattern):
+    """Literal str or compiled bytes regex -> bytes regex source"""
+    if isinstance(pattern, str):
+        return re.escape(pattern.encode())
+    return pattern.pattern
+
+
+def describe_unit(buf, start):
+    """'<redcap:Alerts alert_title=".."...' -> "redcap:Alerts 'title' 'form' 'SMS'"""
+    tag_end = buf.find(b'>', start)
+    tag = re.match(rb'<([\w:]+)', buf[start:start + 64]).group(1)
+    attrs = {k.decode(): html.unescape(v.decode())
+             for k, v in ATTRS.findall(buf[start:tag_end])}
+    ids = ' '.join(repr(attrs.get(name, '')) for name in UNIT_ATTRS[tag])
+    return f'{tag.decode()} {ids}'
+
+
+def unit_contains(buf, start, tag, offset):
+    """Does the element starting at start still enclose offset?"""
+    tag_end = buf.find(b'>', start)
+    if offset <= tag_end:
+        return True  # In its attributes
+    if buf[tag_end - 1:tag_end] == b'/':
+        return False  # <.../> has no content
+    close = buf.find(b'</' + tag + b'>', start)
+    return close < 0 or offset < close
+
+
+@lru_cache(maxsize=16)
+def scan_cached(xmlfilepath, mtime_ns, size, patterns):
+    return scan(xmlfilepath, patterns)
+
+
+def scan_file(xmlfilepath, patterns):
+    """scan(), remembering the answer until the file changes"""
+    stat = os.stat(xmlfilepath)
+    frozen = tuple((category, tuple(pats)) for category, pats in sorted(patterns.items()))
+    return scan_cached(xmlfilepath, stat.st_mtime_ns, stat.st_size, frozen)
+
+
+def scan(xmlfilepath, patterns):
+    """Find every banned pattern in the file in one pass.
+
+    patterns is {category: [pattern, ...]} (or the items() of one).
+    Returns {category: [Hit, ...]} with an entry for every category"""
+    if isinstance(patterns, dict):
+        patterns = patterns.items()
+
+    hits = {}
+    singles = []            # (category, compiled pattern)
+    for category, pats in patterns:
+        hits[category] = []
+        for pattern in pats:
+            if pattern == '':
+                continue
+            singles.append((category, re.compile(compile_pattern(pattern))))
+
+    if not singles or os.path.getsize(xmlfilepath) == 0:
+        return hits
+
+    # One regex that stops at anything interesting: a REDCap definition
+    # starting, or any of the banned patterns
+    combined = re.compile(UNIT_START + b'|' + b'|'.join(
+        b'(?:%s)' % single.pattern for _category, single in singles))
+
+    with open(xmlfilepath, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        unit_start, unit_tag = None, None
+        line, line_counted_to = 1, 0
+        pos = 0
+        while True:
+            match = combined.search(buf, pos)
+            if match is None:
+                break
+            start = match.start()
+
+            if match.group('unit'):
+                unit_start, unit_tag = start, match.group('unit')
+                pos = start + 1
+                continue
+
+            # Patterns can overlap ('covid' and 'covidhmp@..') so try them
+            # all here, and carry on searching from the next byte
+            for category, single in singles:
+                found = single.match(buf, start)
+                if found is None:
+                    continue
+
+                line += buf[line_counted_to:start].count(b'\n')
+                line_counted_to = start
+                column = start - (buf.rfind(b'\n', 0, start) + 1) + 1
+
+                if unit_start is not None and unit_contains(buf, unit_start, unit_tag, start):
+                    element = describe_unit(buf, unit_start)
+                else:
+                    element = 'project'
+
+                hits[category].append(Hit(
+                    category, found.group().decode(errors='replace'),
+                    start, line, column, element))
+            pos = start + 1
+
+    return hits
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit("Usage:\n%s Project.REDCAP.xml TEXT [TEXT ...]" % sys.argv[0])
+
+    found = scan(sys.argv[1], {'banned': sys.argv[2:]})['banned']
+    for hit in found:
+        print(hit)
+    sys.exit(1 if found else 0)
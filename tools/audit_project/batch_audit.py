@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Audit many project exports at once
+
+We run several copies of the project (sites, test and production) and keep
+old exports in previous_versions/. This audits a list of exports, or every
+.xml file in a directory, in parallel worker processes (one file per worker
+at a time) and shows the results side by side, one column per file:
+
+    Files
+      1 CovidHomeMonitoring_2020-05-05_1649.REDCap.xml  2 failed, 355 passed  load 0.950s  audit 0.310s
+      2 COVIDHomeMonitoring_2020-05-20_1527.REDCap.xml  357 passed             load 0.021s  audit 0.240s
+
+                                                           1 2
+    test_observation_has_automated_invite[ob_1b]           F .
+    ...
+
+. passed, F failed, E error, s skipped, - not run for that file. Only checks
+that didn't pass everywhere are shown, unless --all. A file that can't be
+read or parsed is listed with why and is E in every row. The other files
+are still audited.
+
+Files with the same contents (a copy of an export under another name) are
+loaded and audited once. Every file goes through the snapshot cache
+(project_cache.py), so an export that has been audited before, in a batch
+or on its own, isn't parsed again.
+
+Usage
+  ./batch_audit.py [--jobs N] [--all] [--json FILE] Project.REDCap.xml|DIR ...
+  ./audit_project.py --jobs 4 ../../previous_versions ../../latest_version
+"""
+
+from multiprocessing import get_context
+from pathlib import Path
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+from lxml import etree
+
+from project_cache import file_sha256, load_project_cached
+from rule_runner import ERROR, FAILED, PASSED, SKIPPED, run_checks, summarise
+
+MARKS = {PASSED: '.', FAILED: 'F', ERROR: 'E', SKIPPED: 's'}
+
+
+def find_exports(paths):
+    """The xml files named, and those in the directories named, in order and
+    without repeats"""
+    found = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            found.extend(sorted(path.glob('*.xml')))
+        else:
+            found.append(path)
+
+    unique = []
+    seen = set()
+    for path in found:
+        if path.resolve() not in seen:
+            seen.add(path.resolve())
+            unique.append(str(path))
+    return unique
+
+
+def audit_file(module_name, xmlfilepath):
+    """Load and audit one file. Run in a worker process. A file that won't
+    load has its 'error' set and no results"""
+    module = importlib.import_module(module_name)
+    start = time.perf_counter()
+    try:
+        proj = load_project_cached(xmlfilepath)
+    except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+        return {
+            'projxmlfile': xmlfilepath,
+            'sha256': None,
+            'load': time.perf_counter() - start,
+            'audit': 0.0,
+            'summary': {},
+            'results': [],
+            'error': f"{type(exc).__name__}: {exc}",
+        }
+    loaded = time.perf_counter()
+    results = run_checks(module, xmlfilepath, proj=proj)
+    return {
+        'projxmlfile': xmlfilepath,
+        'sha256': proj.sha256,
+        'load': loaded - start,
+        'audit': time.perf_counter() - loaded,
+        'summary': summarise(results),
+        'results': results,
+        'error': None,
+    }
+
+
+def audit_files(module, xmlfilepaths, jobs=1):
+    """Audit every file, identical files only once. Returns an audit dict
+    (see audit_file()) per file, in the order given"""
+    by_hash = {}
+    for path in xmlfilepaths:
+        try:
+            key = file_sha256(path)
+        except OSError:
+            key = path      # audit_file() reports it
+        by_hash.setdefault(key, []).append(path)
+    first = [paths[0] for paths in by_hash.values()]
+
+    if jobs <= 1 or len(first) <= 1:
+        audits = [audit_file(module.__name__, path) for path in first]
+    else:
+        with get_context().Pool(min(jobs, len(first))) as pool:
+            audits = pool.starmap(audit_file, [(module.__name__, path) for path in first])
+
+    by_path = {}
+    for paths, audit in zip(by_hash.values(), audits):
+        for path in paths:
+            by_path[path] = dict(audit, projxmlfile=path,
+                                 same_as=None if path == audit['projxmlfile']
+                                 else audit['projxmlfile'])
+    return [by_path[path] for path in xmlfilepaths]
+
+
+def result_matrix(audits):
+    """[(check id, [outcome or None per file]), ...] in check order. Every
+check is an ERROR for a file that didn't load"""
+    rows = {}
+    for column, audit in enumerate(audits):
+        for result in audit['results']:
+            row = rows.setdefault(result['id'], [None] * len(audits))
+            row[column] = result['outcome']
+    for column, audit in enumerate(audits):
+        if audit['error']:
+            for row in rows.values():
+                row[column] = ERROR
+    return list(rows.items())
+
+
+def print_matrix(audits, out, show_all=False):
+    """The files, their timings and the rule x file table. Returns True if
+    every check passed in every file"""
+    out.write("Files\n")
+    width = max(len(os.path.basename(audit['projxmlfile'])) for audit in audits)
+    summaries = [f"ERROR {audit['error']}" if audit['error']
+                 else ', '.join(f'{n} {outcome.lower()}'
+                                for outcome, n in sorted(audit['summary'].items()))
+                 for audit in audits]
+    summary_width = max(len(summary) for summary in summaries)
+    for number, (audit, summary) in enumerate(zip(audits, summaries), 1):
+        if audit['same_as']:
+            timing = f"same as {os.path.basename(audit['same_as'])}"
+        else:
+            timing = f"load {audit['load']:.3f}s  audit {audit['audit']:.3f}s"
+        out.write(f"  {number:>2} {os.path.basename(audit['projxmlfile']):{width}}  "
+                  f"{summary:{summary_width}}  {timing}\n")
+
+    matrix = result_matrix(audits)
+    # Files that didn't load are E throughout, the others pick the rows
+    loaded = [column for column, audit in enumerate(audits) if not audit['error']]
+    shown = [(check_id, outcomes) for check_id, outcomes in matrix
+             if show_all or any(outcomes[column] not in (PASSED, SKIPPED) for column in loaded)]
+    ok = all(outcome in (PASSED, SKIPPED)
+             for _check_id, outcomes in matrix for outcome in outcomes) \
+        and len(loaded) == len(audits)
+
+    if shown:
+        id_width = max(len(check_id) for check_id, _outcomes in shown)
+        out.write('\n' + ' ' * id_width + ' '
+                  + ' '.join(f'{number:>2}' for number in range(1, len(audits) + 1)) + '\n')
+        for check_id, outcomes in shown:
+            out.write(f'{check_id:{id_width}} '
+                      + ' '.join(f'{MARKS.get(outcome, "-"):>2}' for outcome in outcomes)
+                      + '\n')
+    elif ok:
+        out.write(f"\nAll {len(matrix)} checks passed in every file\n")
+    elif loaded:
+        out.write(f"\nAll {len(matrix)} checks passed in every file that loaded\n")
+    return ok
+
+
+def write_json(audits, path):
+    with open(path, 'w') as file:
+        json.dump({'files': audits}, file, indent=1)
+
+
+def batch(paths, jobs=1, show_all=False, json_path=None, out=sys.stdout):
+    """Audit the exports and directories of exports in paths with
+    audit_project's rules, print the matrix. Returns True if all passed"""
+    # Imported as a module so worker processes find the rules under the
+    # same name
+    import audit_project
+
+    xmlfilepaths = find_exports(paths)
+    if not xmlfilepaths:
+        raise ValueError("No .xml files in " + ' '.join(paths))
+    audits = audit_files(audit_project, xmlfilepaths, jobs)
+    ok = print_matrix(audits, out, show_all)
+    if json_path:
+        write_json(audits, json_path)
+    return ok
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Audit many REDCap project xml files side by side")
+    parser.add_argument('paths', nargs='+', metavar='Project.REDCAP.xml|DIR')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), metavar='N',
+                        help="Audit N files at a time (default one per CPU)")
+    parser.add_argument('--all', action='store_true',
+                        help="Show every check, not just the ones that failed somewhere")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Write every file's results as JSON")
+    args = parser.parse_args()
+
+    try:
+        ok = batch(args.paths, args.jobs, args.all, args.json)
+    except (OSError, ValueError) as exc:
+        sys.exit(str(exc))
+    sys.exit(0 if ok else 1)
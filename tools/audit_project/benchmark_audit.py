@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Time the audit tools on synthetic projects of growing size
+
+Makes a synthetic copy of a real export for each size, DAYS x SLOTS
+observations (synthetic_project.py), and times on each
+    parse   streaming the xml, attachments skipped (project_model.py)
+    index   building the ProjectModel from the parsed tree
+    audit   every audit_project.py check, over all the synthetic project's
+            observations rather than just ob_1a ... ob_14b
+    diff    diff_project.py comparing the project with a second copy of it
+taking the best of --repeat runs. Each run starts cold, as a fresh
+./audit_project.py would: a new ProjectModel, so nothing memoised, and the
+module level caches (parsed logic, calc graphs, the banned strings scan)
+cleared.
+
+    ./benchmark_audit.py Project.REDCap.xml --sizes 14x2,28x2,56x2,90x2,90x4
+
+      size  observations     MB    parse    index    audit     diff  audit per obs
+      14x2            28    4.1    0.034    0.054    0.132    0.139         0.0047
+      90x2           180    9.6    0.117    0.242    0.540    0.571         0.0030
+      ...
+
+--save writes the times as JSON, to keep as a baseline. --baseline compares
+with one: a stage more than --threshold (default 25%) slower than the
+baseline's, and by more than MIN_SECONDS, is flagged as a regression and
+the exit status is 1. Baselines are only comparable on the same machine.
+
+Usage
+  ./benchmark_audit.py Project.REDCap.xml [--sizes 14x2,28x2,...] [--repeat N]
+                       [--save FILE] [--baseline FILE] [--threshold 0.25] [--keep DIR]
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+import argparse
+import datetime
+import json
+import mmap
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from diff_project import diff_projects
+from project_cache import file_sha256
+from project_model import (AUDIT_SECTIONS, ProjectModel, find_attachments, iter_chunks,
+                           parse_sections)
+from rule_profile import clear_caches
+from rule_runner import run_checks, summarise
+from synthetic_project import observation_codes, parse_size, write_synthetic
+
+DEFAULT_SIZES = ['14x2', '28x2', '56x2', '90x2']
+
+STAGES = ('parse', 'index', 'audit', 'diff')
+
+DEFAULT_THRESHOLD = 0.25
+
+# Smaller slow downs than this are timer noise
+MIN_SECONDS = 0.02
+
+@contextmanager
+def audited_observations(module, obcodes):
+    """Have the audit's per observation checks run over obcodes. The rules
+    read the lists when the checks are collected, so change them in place"""
+    saved = (list(module.EXPECTED_OBSERVATIONS),
+             list(module.EXPECTED_OBSERVATION_AUTOMATIC_INVITES))
+    module.EXPECTED_OBSERVATIONS[:] = ['ob_template', 'ob_0'] + obcodes
+    module.EXPECTED_OBSERVATION_AUTOMATIC_INVITES[:] = obcodes
+    try:
+        yield
+    finally:
+        module.EXPECTED_OBSERVATIONS[:], module.EXPECTED_OBSERVATION_AUTOMATIC_INVITES[:] = saved
+
+
+def time_stages(module, xmlfilepath):
+    """{stage: seconds} for one run, and the audit results"""
+    clear_caches()
+
+    seconds = {}
+    start = time.perf_counter()
+    with open(xmlfilepath, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        attachments, skip = find_attachments(xmlfilepath, buf)
+        root = parse_sections(iter_chunks(buf, skip), AUDIT_SECTIONS)
+    seconds['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    proj = ProjectModel(root, xmlfilepath=xmlfilepath, attachments=attachments)
+    seconds['index'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = run_checks(module, xmlfilepath, proj=proj)
+    seconds['audit'] = time.perf_counter() - start
+
+    other = ProjectModel(root, xmlfilepath=xmlfilepath, attachments=attachments)
+    start = time.perf_counter()
+    diff_projects(proj, other)
+    seconds['diff'] = time.perf_counter() - start
+    return seconds, results
+
+
+def benchmark_size(module, xmlfilepath, size, directory, repeat):
+    """Make the size's synthetic project in directory and time it"""
+    days, slots = parse_size(size)
+    path = str(Path(directory) / f'synthetic_{size}.REDCap.xml')
+    start = time.perf_counter()
+    write_synthetic(xmlfilepath, path, days, slots)
+    generated = time.perf_counter() - start
+
+    obcodes = observation_codes(days, slots)
+    best = {}
+    with audited_observations(module, obcodes):
+        for _ in range(repeat):
+            seconds, results = time_stages(module, path)
+            for stage in STAGES:
+                best[stage] = min(best.get(stage, seconds[stage]), seconds[stage])
+    return {
+        'observations': len(obcodes),
+        'bytes': os.path.getsize(path),
+        'generate': generated,
+        'checks': len(results),
+        'summary': summarise(results),
+        'seconds': best,
+    }
+
+
+def benchmark(module, xmlfilepath, sizes, repeat=3, keep=None, out=sys.stdout):
+    """Time every size. Returns the run as a JSON-able dict"""
+    run = {
+        'projxmlfile': os.path.basename(xmlfilepath),
+        'sha256': file_sha256(xmlfilepath),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'repeat': repeat,
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = keep or scratch
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for size in sizes:
+            run['sizes'][size] = benchmark_size(module, xmlfilepath, size, directory, repeat)
+            out.write(f"{size}: {run['sizes'][size]['observations']} observations done\n")
+            out.flush()
+    return run
+
+
+def regressions(baseline, run, threshold=DEFAULT_THRESHOLD):
+    """[(size, stage, baseline seconds, seconds), ...] of stages slower than
+    the baseline by more than threshold (a fraction) and MIN_SECONDS"""
+    found = []
+    for size, timing in run['sizes'].items():
+        before = baseline['sizes'].get(size)
+        if before is None:
+            continue
+        for stage in STAGES:
+            old, new = before['seconds'].get(stage), timing['seconds'][stage]
+            if old is not None and new > old * (1 + threshold) and new - old > MIN_SECONDS:
+                found.append((size, stage, old, new))
+    return found
+
+
+def print_run(run, out, baseline=None):
+    """The table of times, with the change from the baseline if given"""
+    out.write(f"\n{'size':>6}  {'observations':>12}  {'MB':>5}  "
+              + '  '.join(f'{stage:>7}' for stage in STAGES)
+              + f"  {'audit per obs':>13}\n")
+    for size, timing in run['sizes'].items():
+        seconds = timing['seconds']
+        out.write(f"{size:>6}  {timing['observations']:>12}  {timing['bytes'] / 1e6:5.1f}  "
+                  + '  '.join(f'{seconds[stage]:7.3f}' for stage in STAGES)
+                  + f"  {seconds['audit'] / timing['observations']:13.4f}\n")
+        before = baseline and baseline['sizes'].get(size)
+        if before:
+            out.write(f"{'':>6}  {'vs baseline':>12}  {'':>5}  "
+                      + '  '.join(f"{change(before['seconds'].get(stage), seconds[stage]):>7}"
+                                  for stage in STAGES) + '\n')
+
+
+def change(old, new):
+    """'+12%' """
+    if not old:
+        return '-'
+    return f'{(new - old) / old:+.0%}'
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Time parsing, indexing, auditing and diffing synthetic projects")
+    parser.add_argument('projxmlfile', metavar='Project.REDCAP.xml',
+                        help="The real export the synthetic projects are made from")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES), metavar='DAYSxSLOTS,...',
+                        help="Sizes to time (default %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help="Take the best of N runs (default %(default)s)")
+    parser.add_argument('--save', metavar='FILE', help="Write the times as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Compare with times saved earlier, flag regressions")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, metavar='FRACTION',
+                        help="How much slower than the baseline is a regression "
+                             "(default %(default)s)")
+    parser.add_argument('--keep', metavar='DIR',
+                        help="Keep the synthetic projects in DIR")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(',')
+    try:
+        for size in sizes:
+            parse_size(size)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+    except (OSError, ValueError) as exc:
+        sys.exit(str(exc))
+
+    # Imported as a module so the rules register under 'audit_project', as
+    # audit_project.py's main does
+    import audit_project
+
+    run = benchmark(audit_project, args.projxmlfile, sizes, args.repeat, args.keep)
+    print_run(run, sys.stdout, baseline)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(run, file, indent=1)
+
+    if baseline is None:
+        sys.exit(0)
+    slower = regressions(baseline, run, args.threshold)
+    for size, stage, old, new in slower:
+        print(f"REGRESSION {size} {stage}: {old:.3f}s -> {new:.3f}s ({change(old, new)})")
+    if not slower:
+        print(f"\nNo regressions against {args.baseline}")
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Dependency graph of each instrument's calculated fields
+
+REDCap works out calc fields in the order they are on the form, in one pass,
+with no planning (see documentation/redcap_design_overview.md). A calc that
+uses another calc further down the form sees that field's old value. So on
+every observation form calc_trigger_mc must come before calc_trigger_cr,
+which must come before calc_trigger_fw.
+
+For each form we take every calc field (redcap:Calculation) and @CALCTEXT
+field, find the [fields] its logic uses (redcap_logic.py) and report
+- calcs placed before another calc on the same form that they use. Fields
+  people type in are fine anywhere, their value is there before any calc runs
+- cycles, fields that depend on themselves through others
+- the longest chain of calcs depending on calcs, the ones most at risk when
+  fields are moved
+
+Graphs are remembered by the content of the form's fields, so unchanged
+forms are only worked out once. Building one is linear in the number of
+fields and references.
+
+Usage
+  ./calc_graph.py Project.REDCap.xml [form_name ...]
+"""
+
+from functools import lru_cache
+import sys
+
+from project_model import REDCAP
+from redcap_logic import LogicError, fields
+
+CALCTEXT = '@CALCTEXT('
+
+
+def form_items(proj, form_name):
+    """ItemDefs of an instrument in form order"""
+    form = proj.instrument(form_name)
+    if form is None:
+        raise ValueError(f"No instrument {form_name} in {proj.xmlfilepath}")
+    for igr in form:
+        for itemref in proj.item_group(igr.attrib['ItemGroupOID']):
+            yield proj.item(itemref.attrib['ItemOID'])
+
+
+def form_calcs(proj, form_name):
+    """[(field name, calculation), ...] of an instrument's calc fields in
+    form order, the order REDCap works them out in"""
+    return [(item.attrib['OID'], item.attrib[REDCAP + 'Calculation'])
+            for item in form_items(proj, form_name)
+            if item is not None and REDCAP + 'Calculation' in item.attrib]
+
+
+def calctext(annotation):
+    """The logic inside an @CALCTEXT(...) action tag, or None"""
+    start = annotation.find(CALCTEXT)
+    if start < 0:
+        return None
+    depth = 0
+    for pos in range(start + len(CALCTEXT) - 1, len(annotation)):
+        if annotation[pos] == '(':
+            depth += 1
+        elif annotation[pos] == ')':
+            depth -= 1
+            if depth == 0:
+                return annotation[start + len(CALCTEXT):pos]
+    return annotation[start + len(CALCTEXT):]
+
+
+def form_fields(proj, form_name):
+    """((field name, logic or None), ...) for every field on the form in
+    order. Logic is the calculation or @CALCTEXT"""
+    found = []
+    for item in form_items(proj, form_name):
+        if item is None:
+            continue
+        logic = item.attrib.get(REDCAP + 'Calculation')
+        if logic is None:
+            logic = calctext(item.attrib.get(REDCAP + 'FieldAnnotation', ''))
+        found.append((item.attrib['OID'], logic))
+    return tuple(found)
+
+
+class CalcGraph:
+    """Which fields each calc on a form uses, and what's wrong with that"""
+
+    def __init__(self, form_fields):
+        self.position = {name: pos for pos, (name, _logic) in enumerate(form_fields)}
+        self.uses = {}          # calc field -> [fields on this form it uses]
+        self.errors = []        # logic we couldn't parse
+
+        for name, logic in form_fields:
+            if logic is None:
+                continue
+            try:
+                used = fields(logic)
+            except LogicError as exc:
+                self.errors.append(f"{name}: {exc}")
+                continue
+            self.uses[name] = sorted((field for field in used if field in self.position),
+                                     key=self.position.get)
+
+        self.out_of_order = [
+            (name, used)
+            for name, uses in self.uses.items()
+            for used in uses
+            if used in self.uses and self.position[used] > self.position[name]]
+        self.cycles = self.find_cycles()
+        self.longest = self.longest_chain()
+
+    def find_cycles(self):
+        """Groups of calcs that depend on each other (Tarjan's strongly
+        connected components, iteratively)"""
+        index = {}
+        low = {}
+        stack, on_stack = [], set()
+        cycles = []
+        counter = 0
+
+        for root in self.uses:
+            if root in index:
+                continue
+            work = [(root, iter(self.uses.get(root, ())))]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self.uses.get(child, ()))))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        group = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            group.append(member)
+                            if member == node:
+                                break
+                        if len(group) > 1 or node in self.uses.get(node, ()):
+                            cycles.append(sorted(group, key=self.position.get))
+        return cycles
+
+    def longest_chain(self):
+        """The longest run of calcs each using the next, leaving out any in
+        cycles and the input fields the last one uses.
+        eg [calc_trigger_alert_level, calc_trigger_fw, ...]"""
+        in_cycle = {name for cycle in self.cycles for name in cycle}
+        best = {}       # calc -> longest chain starting at it
+
+        def chain(name):
+            if name in best:
+                return best[name]
+            todo = [name]
+            while todo:
+                current = todo[-1]
+                pending = [used for used in self.uses[current]
+                           if used in self.uses and used not in best
+                           and used not in in_cycle and used != current]
+                if pending:
+                    todo.extend(pending)
+                    continue
+                todo.pop()
+                longest = max((best[used] for used in self.uses[current]
+                               if used in best), key=len, default=[])
+                best[current] = [current] + longest
+            return best[name]
+
+        chains = [chain(name) for name in self.uses if name not in in_cycle]
+        return max(chains, key=len, default=[])
+
+    def problems(self):
+        """Everything wrong with the form's calcs, as readable strings"""
+        found = list(self.errors)
+        for name, used in self.out_of_order:
+            found.append(f"{name} (field {self.position[name] + 1}) uses {used} "
+                         f"which comes after it (field {self.position[used] + 1})")
+        for cycle in self.cycles:
+            found.append("cycle: " + ' -> '.join(cycle + cycle[:1]))
+        return found
+
+
+@lru_cache(maxsize=256)
+def build_graph(form_fields):
+    """CalcGraph for a form_fields() tuple. The tuple is the key, so a form
+    whose fields haven't changed gets the graph worked out before"""
+    return CalcGraph(form_fields)
+
+
+def form_graph(proj, form_name):
+    return build_graph(form_fields(proj, form_name))
+
+
+if __name__ == '__main__':
+
+    from project_cache import load_project_cached
+
+    if len(sys.argv) < 2:
+        sys.exit("Usage:\n%s Project.REDCAP.xml [form_name ...]" % sys.argv[0])
+
+    proj = load_project_cached(sys.argv[1])
+    form_names = sys.argv[2:] or [form.attrib[REDCAP + 'FormName']
+                                  for form in proj.all_forms()]
+
+    found = False
+    for form_name in form_names:
+        graph = form_graph(proj, form_name)
+        if not graph.uses:
+            continue
+        print(f"{form_name}: {len(graph.uses)} calcs, longest chain {len(graph.longest)}: "
+              + ' <- '.join(graph.longest))
+        for problem in graph.problems():
+            found = True
+            print(f"  {problem}")
+
+    sys.exit(1 if found else 0)
@@ -1,16 +1,39 @@
 """
 Config for PyTest module
 
-Our audit_project.py tool uses the pytesting framework. Pytest expects to be
-run as a command and pointed at a directory of test. But we want a cmdline tool
-that accepts a XML file to validate as a cmdline argument. To do that we must
-jump through pytest global config hoops (below) and these have to live in a
-separate conftest.py file.
+Our audit_project.py checks are usually run by rule_runner.py, but they are
+also a pytest test module. Pytest expects to be run as a command and pointed
+at a directory of tests. To tell it which project XML file to check we
+define a cmdline arg '--projxmlfile', and the fixtures the checks ask for.
+These have to live in a separate conftest.py file.
+
+    pytest audit_project.py --projxmlfile CovidHomeMonitoring_2020-04-16_1204.REDCap.xml
 """
 
+import pytest
+
+from project_cache import load_project_cached
+
 
 def pytest_addoption(parser):
     parser.addoption(
         "--projxmlfile", action="store", default="xxxxxx",
         help='specify project xmlfile: "CovidHomeMonitoring_2020-04-16_1204.REDCap.xml'
     )
+
+
+@pytest.fixture(scope="session")
+def projxmlpath(request):
+    """Get the filepath to the XML file under test"""
+    return request.config.getoption("--projxmlfile")
+
+
+@pytest.fixture(scope="session")
+def proj(projxmlpath):
+    """Get the indexed ProjectModel for the redcap project xml file.
+    Session scoped so it's only loaded once. Between runs the parsed project
+    is also cached on disk (project_cache.py)"""
+    try:
+        return load_project_cached(projxmlpath)
+    except Exception:
+        pytest.exit("Couldn't parse XML file %s" % projxmlpath)
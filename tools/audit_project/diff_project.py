@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Structural diff of two REDCap project xml exports
+
+A text diff of two exports is swamped by the base64 survey images and by
+everything that moved when one field was added. Instead we load both files
+into ProjectModels (project_model.py, streamed, attachment payloads never
+parsed) and match up their definitions by the keys REDCap uses for them:
+
+    instruments     FormDef OID               eg Form.ob_3a
+    item groups     ItemGroupDef OID
+    fields          ItemDef OID               eg hr_3a
+    choices         CodeList OID              eg mon_sex.choices
+    surveys         form_name
+    invites         survey_id
+    alerts          title, form_name, alert_type
+    reports         title
+    repeating       instrument name
+    attachments     name and SHA-256 of the payload
+
+Then report each one added (+), removed (-) or changed (~), with the
+attributes and content that changed:
+
+    Fields
+      ~ hr_3a
+          Length: '3' -> '999'
+          Question/TranslatedText: 'Heart rate' -> 'Pulse'
+
+REDCap gives attachments a new random ID in every export, and surveys refer
+to their logo by that ID. So attachments are matched by content, and ID
+references are shown as the attachment's name and hash.
+
+Usage
+  ./diff_project.py OLD.REDCap.xml NEW.REDCap.xml
+
+Exits 1 if there are differences, like diff.
+"""
+
+from collections import Counter
+import sys
+
+from form_compare import attr_name, diff_sequence
+from project_cache import load_project_cached
+from project_model import ODM
+
+# (heading, ProjectModel index) in the order they're reported
+CATEGORIES = [
+    ('Instruments', 'forms'),
+    ('Item groups', 'item_groups'),
+    ('Fields', 'items'),
+    ('Choices', 'code_lists'),
+    ('Surveys', 'surveys'),
+    ('Invites', 'invites'),
+    ('Alerts', 'alerts'),
+    ('Reports', 'reports'),
+    ('Repeating instruments', 'repeating_instruments'),
+]
+
+
+def short_tag(tag):
+    """'{http://www.cdisc.org/ns/odm/v1.3}Question' -> 'Question'"""
+    return attr_name(tag).replace(ODM, '')
+
+
+def describe_key(key):
+    """Alerts are keyed (form_name, title, type), show them readably"""
+    if isinstance(key, tuple):
+        form_name, title, alert_type = key
+        return f'{title!r} ({form_name}, {alert_type})'
+    return str(key)
+
+
+def flatten(node, prefix='', into=None):
+    """Everything under a node as {path: value}. Paths are child tags, with a
+    [n] index where a tag repeats, '@attribute' for attributes and the bare
+    path for text eg 'Question/TranslatedText', 'CodeListItem[2]@CodedValue'"""
+    if into is None:
+        into = {}
+    counts = Counter(child.tag for child in node)
+    seen = Counter()
+    for child in node:
+        seen[child.tag] += 1
+        path = prefix + short_tag(child.tag)
+        if counts[child.tag] > 1:
+            path += f'[{seen[child.tag]}]'
+        for name, value in child.attrib.items():
+            into[f'{path}@{attr_name(name)}'] = value
+        if child.text is not None and child.text.strip():
+            into[path] = child.text
+        flatten(child, path + '/', into)
+    return into
+
+
+def attachment_names(proj):
+    """{attachment ID: 'banner1.png sha256:1a2b3c4d5e6f'}"""
+    return {id: f"{attachment.attrib.get('DocName')} sha256:{attachment.sha256()[:12]}"
+            for id, attachment in proj.attachments.items()}
+
+
+def diff_values(old, new, diffs):
+    """Compare two {name: value} dicts"""
+    for name, value in old.items():
+        if name not in new:
+            diffs.append(f'{name}: removed (was {value!r})')
+        elif new[name] != value:
+            diffs.append(f'{name}: {value!r} -> {new[name]!r}')
+    for name, value in new.items():
+        if name not in old:
+            diffs.append(f'{name}: added {value!r}')
+
+
+def ref_oid(node):
+    """The OID an ItemGroupRef/ItemRef points at"""
+    return node.attrib.get('ItemGroupOID') or node.attrib.get('ItemOID')
+
+
+def diff_node(old, new, old_ids, new_ids):
+    """Differences between two versions of one definition. *_ids translate
+    attachment IDs in attributes"""
+    diffs = []
+    diff_values({attr_name(k): old_ids.get(v, v) for k, v in old.attrib.items()},
+                {attr_name(k): new_ids.get(v, v) for k, v in new.attrib.items()}, diffs)
+    if (old.text or '').strip() != (new.text or '').strip():
+        diffs.append(f'text: {old.text!r} -> {new.text!r}')
+
+    if all(ref_oid(child) for child in [*old, *new]):
+        # FormDef/ItemGroupDef: a list of references. Compare them as a
+        # sequence so one inserted field doesn't look like everything moved
+        old_refs = {ref_oid(child): child for child in old}
+        new_refs = {ref_oid(child): child for child in new}
+        common = diff_sequence('ref', list(old_refs), list(new_refs), diffs,
+                               missing='removed', extra='added')
+        for oid in old_refs:
+            if oid in common:
+                ref_diffs = []
+                diff_values(old_refs[oid].attrib, new_refs[oid].attrib, ref_diffs)
+                diffs.extend(f'ref {oid}: {diff}' for diff in ref_diffs)
+    else:
+        diff_values(flatten(old), flatten(new), diffs)
+
+    return diffs
+
+
+def diff_index(old, new, old_ids, new_ids):
+    """Compare one ProjectModel index. Yields (sign, key, [differences])"""
+    for key, node in old.items():
+        if key not in new:
+            yield '-', key, []
+        else:
+            diffs = diff_node(node, new[key], old_ids, new_ids)
+            if diffs:
+                yield '~', key, diffs
+    for key in new:
+        if key not in old:
+            yield '+', key, []
+
+
+def diff_attachments(old_ids, new_ids):
+    """Attachments by name and content. Payloads are hashed, never decoded.
+    The same image used by several surveys is counted once for each"""
+    old = Counter(old_ids.values())
+    new = Counter(new_ids.values())
+    for name in old:
+        for _ in range(old[name] - new[name]):
+            yield '-', name, []
+    for name in new:
+        for _ in range(new[name] - old[name]):
+            yield '+', name, []
+
+
+def diff_projects(old, new):
+    """[(heading, [(sign, key, [differences]), ...]), ...] for each category
+    with differences"""
+    old_ids = attachment_names(old)
+    new_ids = attachment_names(new)
+
+    report = []
+    for heading, index in CATEGORIES:
+        changes = list(diff_index(getattr(old, index), getattr(new, index),
+                                  old_ids, new_ids))
+        if changes:
+            report.append((heading, changes))
+    changes = list(diff_attachments(old_ids, new_ids))
+    if changes:
+        report.append(('Attachments', changes))
+    return report
+
+
+def print_diff(report, out):
+    for heading, changes in report:
+        counts = Counter(sign for sign, _key, _diffs in changes)
+        out.write(f"{heading} (+{counts['+']} -{counts['-']} ~{counts['~']})\n")
+        for sign, key, diffs in changes:
+            out.write(f'  {sign} {describe_key(key)}\n')
+            for diff in diffs:
+                out.write(f'      {diff}\n')
+        out.write('\n')
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 3:
+        sys.exit("Usage:\n%s OLD.REDCap.xml NEW.REDCap.xml" % sys.argv[0])
+
+    report = diff_projects(load_project_cached(sys.argv[1]),
+                           load_project_cached(sys.argv[2]))
+    print_diff(report, sys.stdout)
+    sys.exit(1 if report else 0)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Check every [field] reference in the project points at a field that exists,
+in the right observation
+
+Alerts, invites, reports and fields refer to fields by name in square
+brackets, in logic ([hr_3a] > [fw_high_hr]) and in text piped to the patient
+('Your heart rate was [hr_3a]'). REDCap doesn't complain when one of those
+names a field that's since been deleted or renamed, it just leaves it blank.
+And copying an ob_3a alert to make the ob_4a one it's easy to miss a [hr_3a].
+
+We build a symbol table of every field (redcap:Variable, so checkboxes are
+cons_agree rather than cons_agree___1) and the instrument it's on, in one
+pass over the instruments. Then tokenize each piece of logic and text once
+(a piece of text repeated across alerts is only tokenized the first time)
+and report
+- references to fields that don't exist
+- smart variables naming an instrument that doesn't exist [survey-url:ob_0]
+- references from something belonging to one observation (its name or
+  instrument ends in eg ob_4a) to a field on another observation's form
+
+    refs = find_references(proj)
+    refs.unknown    {where: [name, ...]}
+    refs.crossed    {obcode: [(where, field), ...]}
+
+The check is one pass over the symbols and one over the text, so it stays
+linear as observation days are added.
+
+    ./field_references.py Project.REDCAP.xml
+"""
+
+from functools import lru_cache
+import re
+import sys
+
+from project_model import REDCAP
+from template_families import OBCODE
+
+# [field] [field(1)] [field:value] [smart-variable:instrument], an
+# [event_1_arm_1] prefix is a reference of its own. Event names, alone or as
+# a prefix, and numbers in text like [1] aren't fields
+REFERENCE = re.compile(r'\[([\w-]+)(?:\(([\w-]+)\))?(?::([\w-]+))?\]')
+
+# Unique event names, as in [event_1_arm_1][hr_3a]
+EVENT_NAME = re.compile(r'\w+_arm_\d+\Z')
+
+# Smart variables whose :parameter is an instrument
+INSTRUMENT_SMART_VARIABLES = frozenset([
+    'survey-url', 'survey-link', 'survey-access-code', 'survey-return-code',
+    'survey-time-completed', 'survey-date-completed', 'form-url', 'form-link',
+])
+
+ALERT_TEXT = ['alert_condition', 'alert_message', 'email_subject']
+INVITE_TEXT = ['condition_logic', 'email_subject', 'email_content']
+SURVEY_TEXT = ['instructions', 'acknowledgement']
+REPORT_TEXT = ['advanced_logic', 'limiter_logic']
+ITEM_TEXT = [REDCAP + 'BranchingLogic', REDCAP + 'Calculation', REDCAP + 'FieldAnnotation']
+
+
+class SymbolTable:
+    """Every field's variable name and the instrument it's on"""
+
+    __slots__ = ('forms', 'instruments')
+
+    def __init__(self, proj):
+        self.forms = {}         # variable -> form name
+        self.instruments = set()
+        for form in proj.all_forms():
+            form_name = sys.intern(form.attrib[REDCAP + 'FormName'])
+            self.instruments.add(form_name)
+            # REDCap's own form status field
+            self.forms[sys.intern(form_name + '_complete')] = form_name
+            for group_ref in form:
+                group = proj.item_group(group_ref.attrib['ItemGroupOID'])
+                for item_ref in group if group is not None else ():
+                    variable = item_ref.attrib.get(REDCAP + 'Variable', item_ref.attrib['ItemOID'])
+                    self.forms.setdefault(sys.intern(variable), form_name)
+
+    def observation(self, variable):
+        """The observation (eg ob_3a) whose form the field is on, or None"""
+        form_name = self.forms.get(variable)
+        if form_name is not None and OBCODE.fullmatch(form_name):
+            return form_name
+        return None
+
+
+class References:
+    """What find_references() found"""
+
+    __slots__ = ('unknown', 'crossed')
+
+    def __init__(self):
+        self.unknown = {}       # where -> [name, ...]
+        self.crossed = {}       # obcode -> [(where, field), ...]
+
+
+@lru_cache(maxsize=4096)
+def tokenize(text):
+    """((name, parameter), ...) for every reference in text, without event
+    names or [numbers]. parameter is the :instrument of smart variables, or
+    None"""
+    found = []
+    for match in REFERENCE.finditer(text):
+        name, _choice, parameter = match.groups()
+        if EVENT_NAME.match(name) or name.isdigit():
+            continue
+        found.append((sys.intern(name), parameter))
+    return tuple(found)
+
+
+def owner(*names):
+    """The observation the first name with an observation code belongs to"""
+    for name in names:
+        found = OBCODE.search(name or '')
+        if found is not None:
+            return found.group(0)
+    return None
+
+
+def texts(proj, symbols):
+    """(where, owning observation or None, text) of everything that can
+    refer to a field"""
+    for alert in proj.all_alerts():
+        where = f"alert {alert.attrib.get('alert_title')!r} ({alert.attrib.get('alert_type')})"
+        # Late alerts hang off the preceding observation's form, the title
+        # says which observation they're for
+        obcode = owner(alert.attrib.get('alert_title'), alert.attrib.get('form_name'))
+        for name in ALERT_TEXT:
+            yield f"{where} {name}", obcode, alert.attrib.get(name, '')
+
+    for invite in proj.all_invites():
+        survey_id = invite.attrib.get('survey_id')
+        for name in INVITE_TEXT:
+            yield f"invite {survey_id} {name}", owner(survey_id), invite.attrib.get(name, '')
+
+    for survey in proj.all_surveys():
+        form_name = survey.attrib.get('form_name')
+        for name in SURVEY_TEXT:
+            yield f"survey {form_name} {name}", owner(form_name), survey.attrib.get(name, '')
+
+    for report in proj.all_reports():
+        title = report.attrib.get('title')
+        for name in REPORT_TEXT:
+            yield f"report {title!r} {name}", None, report.attrib.get(name, '')
+        # A plain list of fields rather than [references]
+        columns = report.attrib.get('redcap_reports_fields', '')
+        yield (f"report {title!r} fields", None,
+               ''.join(f'[{column}]' for column in columns.split(',') if column))
+
+    for variable, form_name in symbols.forms.items():
+        item = proj.item(variable)
+        if item is None:
+            continue    # Checkbox, its ItemDefs are cons_agree___1 ...
+        obcode = owner(form_name)
+        for name in ITEM_TEXT:
+            yield f"field {variable} {name.replace(REDCAP, '')}", obcode, item.attrib.get(name, '')
+        for question in item:
+            for translated in question:
+                yield f"field {variable} label", obcode, translated.text or ''
+
+
+def find(proj):
+    symbols = SymbolTable(proj)
+    refs = References()
+    for where, obcode, text in texts(proj, symbols):
+        if '[' not in text:
+            continue
+        for name, parameter in tokenize(text):
+            if '-' in name:
+                # A smart variable eg [survey-url:ob_0]
+                if (name in INSTRUMENT_SMART_VARIABLES and parameter is not None
+                        and parameter not in symbols.instruments):
+                    refs.unknown.setdefault(where, []).append(f"{name}:{parameter}")
+                continue
+            if name not in symbols.forms:
+                refs.unknown.setdefault(where, []).append(name)
+                continue
+            other = symbols.observation(name)
+            if obcode is not None and other is not None and other != obcode:
+                refs.crossed.setdefault(obcode, []).append((where, name))
+    return refs
+
+
+def find_references(proj):
+    """References, worked out once per project"""
+    return proj.memo(find)
+
+
+if __name__ == '__main__':
+
+    from project_cache import load_project_cached
+
+    if len(sys.argv) != 2:
+        sys.exit("Usage:\n%s Project.REDCAP.xml" % sys.argv[0])
+
+    refs = find_references(load_project_cached(sys.argv[1]))
+    for where, names in refs.unknown.items():
+        print(f"{where}: no such field {', '.join(names)}")
+    for obcode, found in sorted(refs.crossed.items()):
+        for where, name in found:
+            print(f"{where}: {name} is another observation's field, not {obcode}'s")
+    if not refs.unknown and not refs.crossed:
+        print("Every field reference is to a field of its own observation")
+
+    sys.exit(1 if refs.unknown or refs.crossed else 0)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Write a copy of a project export with drifted observation copies fixed
+
+When an observation's alert, survey settings or invite message drifts from
+its ob_template version (see template_families.py) the fix so far has been
+clicking through the REDCap UI or update_alert.py, one request per alert.
+This writes a corrected export instead, which can be imported back into
+REDCap in one go:
+
+    ./fix_project.py Project.REDCap.xml Fixed.REDCap.xml
+    ./audit_project.py --fix Fixed.REDCap.xml Project.REDCap.xml
+
+Each drifted copy gets the template's value for every attribute the audit
+compares, with _template changed to its own code (hr_template -> hr_3a).
+The attributes it's allowed to have of its own (alert number, send time...,
+audit_project.TEMPLATE_FAMILY_RULES) are left alone.
+
+Only those elements change. The rest of the file, attachments included, is
+copied byte for byte: the elements are found with a byte scan, as for the
+attachments in project_model.py, and the output is written as slices of
+the memory mapped input around the replaced elements. Template values are
+copied as they are in the file, escaping and all, so nothing is re-encoded.
+
+Instruments and invites that differ from ob_template are listed but not
+fixed. Instrument fields can hold data, so they should be changed in REDCap.
+ob_template's invite is switched off and never sent, so when they differ
+it's as likely to be the one that's out of date.
+"""
+
+from pathlib import Path
+import html
+import mmap
+import re
+import sys
+
+from project_cache import load_project_cached
+from template_families import (TEMPLATE, compared, copy_differences, family_key,
+                               template_families)
+
+# The elements we can fix, all written by REDCap as one empty element
+ELEMENT = re.compile(rb'<redcap:(Alerts|SurveysScheduler|Surveys)\s([^>]*?)\s*/>')
+ATTRIBUTE = re.compile(rb'([\w:]+)="([^"]*)"')
+
+# The kinds of family that are fixed
+FIX_KINDS = ('alert', 'survey')
+
+# Element -> (family kind, attribute it's named by, other identifying attributes)
+KINDS = {
+    b'Alerts': ('alert', 'alert_title', ['alert_type']),
+    b'Surveys': ('survey', 'form_name', []),
+    b'SurveysScheduler': ('invite', 'survey_id', []),
+}
+
+
+class RawElement:
+    """An element as it is in the file: where, and its raw attribute bytes"""
+
+    __slots__ = ('tag', 'start', 'end', 'attrs')
+
+    def __init__(self, tag, start, end, attrs):
+        self.tag = tag
+        self.start = start
+        self.end = end
+        self.attrs = attrs          # {name: raw value}, in file order
+
+    def value(self, name):
+        """An attribute's value as the parser would give it"""
+        return html.unescape(self.attrs.get(name, b'').decode())
+
+    def family(self):
+        kind, name, rest = KINDS[self.tag]
+        return family_key(kind, self.value(name), *(self.value(other) for other in rest))
+
+    def to_bytes(self):
+        attrs = b' '.join(b'%s="%s"' % (name.encode(), value)
+                          for name, value in self.attrs.items())
+        return b'<redcap:%s %s/>' % (self.tag, attrs)
+
+
+def scan(buf):
+    """Every alert, survey and invite element in buf, in file order"""
+    for match in ELEMENT.finditer(buf):
+        attrs = {name.decode(): value for name, value in ATTRIBUTE.findall(match.group(2))}
+        yield RawElement(match.group(1), match.start(), match.end(), attrs)
+
+
+def drifted_copies(proj, rules, kinds=FIX_KINDS):
+    """({(family key, obcode): [difference, ...]} of copies to fix,
+    [(family key, obcode), ...] of other copies that differ from their
+    template)"""
+    drifted = {}
+    unfixed = []
+    for obcode in sorted({obcode for family in template_families(proj).values()
+                          for obcode in family.copies}):
+        for key, diffs in copy_differences(proj, obcode, rules).items():
+            if key[0] in kinds:
+                drifted[key, obcode] = diffs
+            else:
+                unfixed.append((key, obcode))
+    return drifted, unfixed
+
+
+def fixed_element(template, copy, names, obcode):
+    """copy with the template's names attributes, renamed for obcode"""
+    suffix = ('_' + obcode[3:]).encode()
+    attrs = dict(copy.attrs)
+    for name in names:
+        if name in template.attrs:
+            attrs[name] = template.attrs[name].replace(b'_' + TEMPLATE.encode(), suffix)
+    return RawElement(copy.tag, copy.start, copy.end, attrs)
+
+
+def plan(buf, proj, rules, drifted):
+    """[(start, end, replacement bytes), ...] in file order"""
+    families = template_families(proj)
+    templates = {}
+    copies = {}
+    for element in scan(buf):
+        key, obcode = element.family()
+        if key not in families:
+            continue
+        # The first of any duplicates, like the model
+        if obcode == 'ob_' + TEMPLATE:
+            templates.setdefault(key, element)
+        elif (key, obcode) in drifted:
+            copies.setdefault((key, obcode), element)
+
+    replacements = []
+    for (key, obcode), copy in copies.items():
+        names = compared(families[key], rules.get(key, {}))
+        fixed = fixed_element(templates[key], copy, names, obcode)
+        replacements.append((copy.start, copy.end, fixed.to_bytes()))
+    return sorted(replacements)
+
+
+def write_patched(buf, replacements, outpath):
+    """buf with the replacements made, streamed to outpath"""
+    with open(outpath, 'wb') as out:
+        pos = 0
+        for start, end, replacement in replacements:
+            out.write(buf[pos:start])
+            out.write(replacement)
+            pos = end
+        out.write(buf[pos:])
+
+
+def fix(xmlfilepath, outpath, rules, kinds=FIX_KINDS):
+    """Write outpath, a copy of xmlfilepath with drifted copies fixed.
+    Returns (what was fixed {(family, obcode): [difference, ...]},
+    [(family, obcode), ...] not fixed, copies still wrong after fixing)"""
+    if Path(outpath).resolve() == Path(xmlfilepath).resolve():
+        raise ValueError("Write the fixed project to another file")
+
+    proj = load_project_cached(xmlfilepath)
+    drifted, unfixed = drifted_copies(proj, rules, kinds)
+    with open(xmlfilepath, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        write_patched(buf, plan(buf, proj, rules, drifted), outpath)
+
+    still, _unfixed = drifted_copies(load_project_cached(str(outpath)), rules, kinds)
+    return drifted, unfixed, still
+
+
+def print_fixes(drifted, unfixed, still, out):
+    for (key, obcode), diffs in sorted(drifted.items()):
+        out.write(f"Fixed {key[0]} {key[1]!r} {obcode}\n")
+        for diff in diffs:
+            out.write(f"    {diff}\n")
+    for key, obcode in unfixed:
+        out.write(f"Not fixed: {key[0]} {obcode} differs from {key[1]!r}, "
+                  f"change it in REDCap\n")
+    for (key, obcode), diffs in sorted(still.items()):
+        out.write(f"Still wrong: {key[0]} {key[1]!r} {obcode}: {'; '.join(diffs)}\n")
+    if not drifted:
+        out.write("Nothing to fix\n")
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 3:
+        sys.exit("Usage:\n%s Project.REDCAP.xml Fixed.REDCAP.xml" % sys.argv[0])
+
+    from audit_project import TEMPLATE_FAMILY_RULES
+
+    try:
+        drifted, unfixed, still = fix(sys.argv[1], sys.argv[2], TEMPLATE_FAMILY_RULES)
+    except (OSError, ValueError) as exc:
+        sys.exit(str(exc))
+    print_fixes(drifted, unfixed, still, sys.stdout)
+    sys.exit(1 if unfixed or still else 0)
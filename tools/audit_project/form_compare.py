@@ -0,0 +1,182 @@
+"""
+Compare every observation instrument (ob_1a, ob_1b, ...) against ob_template
+
+Each observation should be an exact copy of ob_template, except that names
+ending _template end in the observation's code instead eg.
+    hr_template -> hr_3a,   'Ob Template' -> 'Ob 3a'
+
+In the XML structure items are defined in different places and there are
+various places where 'ref' items have to be looked up to find 'def'.
+
+    <FormDef OID="Form.ob_template" Name="Ob Template" Repeating="No" redcap:FormName="ob_template">
+        <ItemGroupRef ItemGroupOID="ob_template.timestamp_template" Mandatory="No"/>
+        ...
+    </FormDef>
+
+    <ItemGroupDef OID="ob_template.timestamp_template" Name="Ob Template" Repeating="No">
+        <ItemRef ItemOID="timestamp_template" Mandatory="No" redcap:Variable="timestamp_template"/>
+        ...
+    </ItemGroupDef>
+
+So we flatten each form into a neat
+    FormDef
+        ItemGroup(s)
+            Item(s)
+
+The template is flattened once. Each observation is compared against it by
+renaming the template's values on the fly (a str.replace per attribute, no
+copying of the template) and the differences are listed per observation:
+missing, extra, moved or changed groups, items and attributes.
+"""
+
+from project_model import REDCAP
+
+
+class FormShape:
+    """A form's attributes, its item groups and their items in order"""
+
+    __slots__ = ('attrib', 'groups')
+
+    def __init__(self, attrib, groups):
+        self.attrib = attrib
+        self.groups = groups    # [(group attrib, [item attrib, ...]), ...]
+
+
+def form_shape(proj, formname):
+    """Flatten FormDef formname (eg 'Form.ob_3a') into a FormShape. None if
+    the form isn't defined"""
+    form = proj.form(formname)
+    if form is None:
+        return None
+
+    groups = []
+    for igr in form:
+        igd = proj.item_group(igr.attrib['ItemGroupOID'])
+        if igd is None:
+            groups.append((dict(igr.attrib), []))
+            continue
+        items = []
+        for itemref in igd:
+            item = proj.item(itemref.attrib['ItemOID'])
+            items.append(dict(item.attrib) if item is not None
+                         else {'OID': itemref.attrib['ItemOID']})
+        groups.append(({**igr.attrib, **igd.attrib}, items))
+
+    return FormShape(dict(form.attrib), groups)
+
+
+def attr_name(name):
+    """'{https://projectredcap.org}FieldNote' -> 'redcap:FieldNote'"""
+    return name.replace(REDCAP, 'redcap:')
+
+
+class Renamer:
+    """Turn template text into what it should be for one observation"""
+
+    def __init__(self, obcode):
+        self.ob_suffix = obcode.split('_')[1]
+        self.new_suffix = f'_{self.ob_suffix}'
+
+    def value(self, value):
+        return value.replace('_template', self.new_suffix)
+
+    def name(self, value):
+        """Display names eg 'Ob Template' -> 'Ob 3a'"""
+        return value.replace('Template', self.ob_suffix)
+
+
+def diff_attrib(what, expected, actual, rename, diffs):
+    """Compare two attribute dicts, expected from the template"""
+    for key, tpl_value in expected.items():
+        want = rename(key, tpl_value)
+        if key not in actual:
+            diffs.append(f"{what}: missing {attr_name(key)} (expected {want!r})")
+        elif actual[key] != want:
+            diffs.append(f"{what}: {attr_name(key)} is {actual[key]!r}, expected {want!r}")
+
+    for key in actual:
+        if key not in expected:
+            diffs.append(f"{what}: extra {attr_name(key)}={actual[key]!r}")
+
+
+def diff_sequence(what, expected_oids, actual_oids, diffs,
+                  missing='missing', extra='extra'):
+    """Report missing/extra/moved entries between two OID lists.
+    Returns the OIDs present in both"""
+    actual_set = set(actual_oids)
+    expected_set = set(expected_oids)
+
+    for oid in expected_oids:
+        if oid not in actual_set:
+            diffs.append(f"{what} {oid}: {missing}")
+    for oid in actual_oids:
+        if oid not in expected_set:
+            diffs.append(f"{what} {oid}: {extra}")
+
+    common_expected = [oid for oid in expected_oids if oid in actual_set]
+    common_actual = [oid for oid in actual_oids if oid in expected_set]
+    for position, (want, got) in enumerate(zip(common_expected, common_actual)):
+        if want != got:
+            diffs.append(f"{what} order differs at position {position}: "
+                         f"{got} where {want} expected")
+            break
+
+    return expected_set & actual_set
+
+
+def diff_observation(template, shape, obcode):
+    """List every difference between an observation form and the template"""
+    if shape is None:
+        return [f"form Form.{obcode}: missing"]
+
+    renamer = Renamer(obcode)
+
+    def rename_form(key, value):
+        return renamer.name(value) if key == 'Name' else renamer.value(value)
+
+    def rename_item(key, value):
+        return renamer.value(value)
+
+    diffs = []
+    diff_attrib('form', template.attrib, shape.attrib, rename_form, diffs)
+
+    tpl_groups = [(renamer.value(group.get('OID', '')), group, items)
+                  for group, items in template.groups]
+    groups = {group.get('OID', ''): (group, items) for group, items in shape.groups}
+    common = diff_sequence('group', [oid for oid, _group, _items in tpl_groups],
+                           list(groups), diffs)
+
+    for oid, tpl_group, tpl_items in tpl_groups:
+        if oid not in common:
+            continue
+        group, items = groups[oid]
+        diff_attrib(f'group {oid}', tpl_group, group, rename_form, diffs)
+
+        tpl_items = [(renamer.value(item['OID']), item) for item in tpl_items]
+        items = {item['OID']: item for item in items}
+        common_items = diff_sequence(f'group {oid} item',
+                                     [item_oid for item_oid, _item in tpl_items],
+                                     list(items), diffs)
+        for item_oid, tpl_item in tpl_items:
+            if item_oid in common_items:
+                diff_attrib(f'item {item_oid}', tpl_item, items[item_oid],
+                            rename_item, diffs)
+
+    return diffs
+
+
+def compare_observations(proj, obcodes):
+    """Compare every observation in obcodes (a tuple) against ob_template in
+    one sweep. Returns {obcode: [difference, ...]}.
+
+    Remembered per project so all the per-observation checks share one run"""
+    return proj.memo(sweep_observations, obcodes)
+
+
+def sweep_observations(proj, obcodes):
+    template = form_shape(proj, 'Form.ob_template')
+    if template is None:
+        return {obcode: ["form Form.ob_template: missing"] for obcode in obcodes}
+
+    return {obcode: diff_observation(template, form_shape(proj, f'Form.{obcode}'), obcode)
+            for obcode in obcodes}
@@ -0,0 +1,163 @@
+"""
+Incremental audits: only re-run the rules whose part of the project changed
+
+After each edit in REDCap we download a fresh export and audit it again, but
+almost all of the file is the same as last time. So every audit records, for
+each rule, which parts of the project it looked at (the FormDefs, items,
+alerts, invites, reports... it asked the ProjectModel for) and a fingerprint
+of each. The next audit re-fingerprints just those parts. Rules where they
+all match get last run's verdict back without running. The rest run again.
+
+    proj.alert('Obs Combined Staff alert - ob_3a', 'ob_3a', 'SMS')
+        -> ('alert', ('ob_3a', 'Obs Combined Staff alert - ob_3a', 'SMS'))
+
+A lookup of something that isn't there is recorded too, so a rule re-runs if
+it appears. Rules that read the xml file itself (they take projxmlpath) re-run
+whenever the file changes at all.
+
+Rules must get at the project through the ProjectModel lookup methods (not
+its dicts directly) for this to see what they use. Editing any of the
+auditor's .py files throws the history away.
+
+The history lives in the project cache directory (project_cache.py), one per
+rules module. With caching turned off every audit is a full one.
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+
+from project_cache import get_cache_dir, load_project_cached
+from project_model import fingerprint
+from rule_runner import collect_checks, run_checks
+
+HISTORY_VERSION = 1
+
+
+def code_fingerprint(module):
+    """Hash of every .py file alongside the rules module. The verdicts depend
+    on the helpers and the model as much as on the rules themselves"""
+    digest = hashlib.sha256()
+    for path in sorted(Path(module.__file__).resolve().parent.glob('*.py')):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def history_path(cache_dir, module):
+    return Path(cache_dir) / 'history' / f'{module.__name__}.json'
+
+
+def read_history(path, code):
+    """Last audit's {rule name: {'units': .., 'results': ..}}, or {} if there
+    isn't a usable one"""
+    try:
+        with open(path) as file:
+            history = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if history.get('version') != HISTORY_VERSION or history.get('code') != code:
+        return {}
+    return history['rules']
+
+
+def write_history(path, history):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(history, file)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def as_key(key):
+    """json turns our tuple keys (alerts) into lists"""
+    return tuple(key) if isinstance(key, list) else key
+
+
+class Fingerprints:
+    """Fingerprints of parts of one project, worked out as they're asked for"""
+
+    def __init__(self, proj):
+        self.proj = proj
+        self.known = {}
+
+    def get(self, kind, key):
+        key = as_key(key)
+        if (kind, key) not in self.known:
+            if kind == 'file':
+                found = self.proj.sha256
+            else:
+                found = fingerprint(self.proj.lookup(kind, key))
+            self.known[kind, key] = found
+        return self.known[kind, key]
+
+
+def unchanged(previous, fingerprints):
+    """Is everything a rule looked at last time still the same?"""
+    return all(fingerprints.get(kind, key) == value
+               for kind, key, value in previous['units'])
+
+
+def run_incremental(module, xmlfilepath, jobs=1, proj=None, cache_dir=None):
+    """run_checks(), re-using the previous audit's result for any rule whose
+    inputs haven't changed.
+
+    Returns (results in check order, number of checks re-used)"""
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if proj is None:
+        proj = load_project_cached(xmlfilepath, cache_dir=cache_dir)
+
+    checks = collect_checks(module)
+    if cache_dir is None:
+        return run_checks(module, xmlfilepath, jobs, proj, checks), 0
+
+    path = history_path(cache_dir, module)
+    code = code_fingerprint(module)
+    previous = read_history(path, code)
+    fingerprints = Fingerprints(proj)
+
+    # Whole rules are re-run or re-used, not single checks. Checks of one
+    # rule can share work (eg form_compare.py compares every observation the
+    # first time it's asked) so only a rule's first check may see the lookups
+    reused = {}
+    for check in checks:
+        name = check.rule.name
+        if name not in reused:
+            reused[name] = name in previous and unchanged(previous[name], fingerprints)
+
+    to_run = [check for check in checks if not reused[check.rule.name]]
+    fresh = run_checks(module, xmlfilepath, jobs, proj, to_run, track_units=True)
+
+    rules = {name: previous[name] for name, use in reused.items() if use}
+    for result in fresh:
+        entry = rules.setdefault(result['rule'], {'units': set(), 'results': []})
+        entry['units'].update((kind, as_key(key)) for kind, key in result.pop('units'))
+        entry['results'].append(result)
+    for name, entry in rules.items():
+        if reused[name]:
+            continue
+        entry['units'] = [[kind, key, fingerprints.get(kind, key)]
+                          for kind, key in sorted(entry['units'], key=repr)]
+
+    try:
+        write_history(path, {
+            'version': HISTORY_VERSION,
+            'code': code,
+            'projxmlfile': xmlfilepath,
+            'sha256': proj.sha256,
+            'rules': rules,
+        })
+    except OSError:
+        pass  # Next audit will just be a full one
+
+    by_id = {result['id']: result
+             for entry in rules.values() for result in entry['results']}
+    results = [by_id[check.id] for check in checks]
+    return results, len(checks) - len(to_run)
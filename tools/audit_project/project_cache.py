@@ -0,0 +1,155 @@
+"""
+On-disk cache of parsed REDCap projects
+
+While editing ob_template we audit the same export over and over. Rather than
+re-parse it every time we pickle the indexed ProjectModel (project_model.py)
+into a cache directory, named by the SHA-256 of the xml file contents.
+
+- A changed file has a different hash, so old snapshots are never used for it
+- Snapshots record the ProjectModel layout version they were written with
+- The directory is kept under CACHE_MAX_BYTES by deleting the least recently
+  used snapshots. Loading a snapshot touches it.
+
+Set the AUDIT_CACHE_DIR environment variable to move the cache. Set it to an
+empty string to turn caching off.
+"""
+
+from pathlib import Path
+import hashlib
+import os
+import pickle
+import tempfile
+
+from project_model import AUDIT_SECTIONS, load_project
+
+# Bump this whenever ProjectModel/Node change shape so old snapshots are
+# ignored rather than unpickled into the wrong thing
+SNAPSHOT_VERSION = 2
+
+DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'redcap_audit'
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_cache_dir():
+    """Where snapshots live. None if caching is turned off"""
+    cache_dir = os.environ.get('AUDIT_CACHE_DIR')
+    if cache_dir is None:
+        return DEFAULT_CACHE_DIR
+    if cache_dir == '':
+        return None
+    return Path(cache_dir)
+
+
+def file_sha256(filepath):
+    """Hex SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_path(cache_dir, sha256, sections):
+    """Snapshot file name for an xml file hash. The set of sections loaded
+    is part of the name so a partial model is never mistaken for a full one"""
+    sections_key = hashlib.sha256(
+        '\n'.join(sorted(sections)).encode()).hexdigest()[:8]
+    return Path(cache_dir) / f'{sha256}.{sections_key}.v{SNAPSHOT_VERSION}.pickle'
+
+
+def read_snapshot(path):
+    """Unpickle a snapshot, or None if it's missing or unreadable"""
+    try:
+        with open(path, 'rb') as file:
+            proj = pickle.load(file)
+    except Exception:
+        # Missing, corrupt or written by some other version of the code.
+        # Rebuild it.
+        return None
+
+    # Mark as recently used for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return proj
+
+
+def write_snapshot(path, proj):
+    """Atomically write a snapshot so a concurrent reader never sees half
+    a file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(proj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """Delete least recently used snapshots until the cache fits in
+    max_bytes"""
+    snapshots = []
+    for path in Path(cache_dir).glob('*.pickle'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue  # Someone else evicted it
+        snapshots.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _mtime, size, _path in snapshots)
+    for _mtime, size, path in sorted(snapshots):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def rebind(proj, xmlfilepath):
+    """A snapshot may have been made from the same contents at another
+    path. Point it (and its attachment offsets) at this file"""
+    proj.xmlfilepath = xmlfilepath
+    for attachment in proj.attachments.values():
+        attachment.xmlfilepath = xmlfilepath
+    return proj
+
+
+def load_project_cached(xmlfilepath, sections=AUDIT_SECTIONS, cache_dir=None,
+                        max_bytes=CACHE_MAX_BYTES):
+    """load_project() but reuse a snapshot if this exact file has been
+    loaded before"""
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+
+    sha256 = file_sha256(xmlfilepath)
+
+    if cache_dir is None:
+        proj = load_project(xmlfilepath, sections)
+        proj.sha256 = sha256
+        return proj
+
+    path = snapshot_path(cache_dir, sha256, sections)
+    proj = read_snapshot(path)
+    if proj is not None:
+        return rebind(proj, xmlfilepath)
+
+    proj = load_project(xmlfilepath, sections)
+    proj.sha256 = sha256
+
+    # A read only or full disk shouldn't stop the audit
+    try:
+        write_snapshot(path, proj)
+        evict(cache_dir, max_bytes)
+    except OSError:
+        pass
+
+    return proj
@@ -0,0 +1,439 @@
+"""
+Indexed model of a REDCap project xml file
+
+The auditor used to answer every question with a fresh XPath search over the
+whole ODM tree eg.
+    proj.find("./Study/MetaDataVersion/ItemDef/[@OID='hr_3a']", proj.nsmap)
+
+Each of those is a linear scan of a 4MB document, and form_tree_definition()
+does one for every ItemGroupRef and ItemRef of every observation.
+
+Instead we walk the tree once and build dictionaries keyed on the things we
+look up by. After that every lookup is a dict access.
+
+    proj = load_project('CovidHomeMonitoring_2020-04-16_1204.REDCap.xml')
+    proj.form('Form.ob_3a')
+    proj.alert('Obs Combined Staff alert - ob_3a', 'ob_3a', 'SMS')
+
+Loading is streamed. Only the sections of the file the auditor reads are kept
+and the base64 redcap:OdmAttachment payloads (survey banner images, up to
+~100KB per line) are never handed to the parser at all. We just remember
+where they are in the file and decode them if someone asks.
+
+The model itself holds plain python Node records rather than lxml elements so
+it can be pickled and cached (see project_cache.py).
+"""
+
+import base64
+import hashlib
+import mmap
+import re
+import sys
+
+from lxml import etree
+
+# lxml names tags and attributes by {namespace}name
+# eg ODM + 'FormDef', REDCAP + 'FormName'
+ODM = '{http://www.cdisc.org/ns/odm/v1.3}'
+REDCAP = '{https://projectredcap.org}'
+
+# The parts of the project xml file the auditor looks at. Other sections
+# (user roles, dashboards, survey queue, attachments...) are thrown away as
+# soon as they have been parsed.
+AUDIT_SECTIONS = frozenset([
+    ODM + 'MetaDataVersion',
+    REDCAP + 'RepeatingInstrumentsAndEvents',
+    REDCAP + 'AlertsGroup',
+    REDCAP + 'SurveysGroup',
+    REDCAP + 'SurveysSchedulerGroup',
+    REDCAP + 'ReportsGroup',
+])
+
+# Which ProjectModel index each kind of lookup reads
+UNIT_INDEXES = {
+    'form': 'forms',
+    'instrument': 'forms_by_name',
+    'item_group': 'item_groups',
+    'item': 'items',
+    'code_list': 'code_lists',
+    'alert': 'alerts',
+    'survey': 'surveys',
+    'invite': 'invites',
+    'report': 'reports',
+    'repeating_instrument': 'repeating_instruments',
+}
+
+# Sections are the children of these
+SECTION_PARENTS = frozenset([ODM + 'Study', ODM + 'GlobalVariables'])
+
+# How much of the file we hand the parser at a time
+CHUNK_SIZE = 1 << 16
+
+# Attachments are found with a byte scan before parsing so we can cut their
+# payload out. REDCap always writes them like this:
+#   <redcap:OdmAttachment MimeType=".." DocName=".." ID=".."><![CDATA[iVBO...]]></redcap:OdmAttachment>
+ATTACHMENT_START = re.compile(rb'<redcap:OdmAttachment\b([^>]*)>')
+ATTACHMENT_END = b'</redcap:OdmAttachment>'
+ATTACHMENT_ATTRS = re.compile(rb'([\w:]+)="([^"]*)"')
+CDATA_START = b'<![CDATA['
+CDATA_END = b']]>'
+
+
+class Node:
+    """Plain python copy of an xml element.
+
+    Looks enough like an lxml element for the auditor (.tag .attrib .text and
+    iterating children) but is small and quick to pickle."""
+
+    __slots__ = ('tag', 'attrib', 'text', 'children')
+
+    def __init__(self, tag, attrib, text=None, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.text = text
+        self.children = list(children)
+
+    @classmethod
+    def from_element(cls, element):
+        """Copy an lxml element and everything under it. Comments and
+        processing instructions are dropped.
+
+        Tag and attribute names are interned. There are only a few hundred
+        distinct ones, and shared strings make the pickle much smaller."""
+        attrib = {sys.intern(k): v for k, v in element.attrib.items()}
+        return cls(sys.intern(element.tag), attrib, element.text,
+                   [cls.from_element(child) for child in element
+                    if isinstance(child.tag, str)])
+
+    def __reduce__(self):
+        # Quicker to unpickle than the default __slots__ state handling
+        return (Node, (self.tag, self.attrib, self.text, self.children))
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __repr__(self):
+        return '<Node %s %r>' % (self.tag, self.attrib)
+
+    def canonical(self):
+        """Everything about the node and its children as nested tuples, in a
+        stable order. Two nodes with equal canonical() are the same xml"""
+        return (self.tag, tuple(sorted(self.attrib.items())), self.text,
+                tuple(child.canonical() for child in self.children))
+
+
+def fingerprint(found):
+    """Short hash of what a lookup returned: a Node, a list of Nodes or None"""
+    if found is None:
+        canonical = None
+    elif isinstance(found, Node):
+        canonical = found.canonical()
+    else:
+        canonical = tuple(node.canonical() for node in found)
+    return hashlib.blake2b(repr(canonical).encode(), digest_size=16).hexdigest()
+
+
+class ProjectModel:
+    """All the REDCap definitions we audit, indexed by how we look them up.
+
+    Every definition is stored as a Node copied out of the parsed tree, the
+    lxml tree itself is not kept."""
+
+    def __init__(self, root, xmlfilepath=None, attachments=None):
+        self.xmlfilepath = xmlfilepath
+        self.sha256 = None              # set by project_cache
+
+        self.forms = {}                 # FormDef OID -> FormDef
+        self.forms_by_name = {}         # redcap:FormName -> FormDef
+        self.item_groups = {}           # ItemGroupDef OID -> ItemGroupDef
+        self.items = {}                 # ItemDef OID -> ItemDef
+        self.code_lists = {}            # CodeList OID -> CodeList
+        self.alerts = {}                # (form_name, title, type) -> Alerts
+        self.alert_list = []            # every Alerts node, document order
+        self.surveys = {}               # form_name -> Surveys
+        self.invites = {}               # survey_id -> SurveysScheduler
+        self.reports = {}               # title -> Reports
+        self.repeating_instruments = {}  # RepeatInstrument -> node
+        self.attachments = attachments or {}  # ID -> Attachment
+
+        self._index(root)
+
+    # When this is a set() every lookup below is recorded in it as
+    # (kind, key), so we know which parts of the project a rule looked at.
+    # See incremental.py
+    accessed = None
+
+    # Results of memo(), {(func, args): (result, lookups it made)}
+    _memo = None
+
+    def _used(self, kind, key=None):
+        if self.accessed is not None:
+            self.accessed.add((kind, key))
+
+    def memo(self, func, *args):
+        """func(self, *args), worked out once for this project. For shared
+        work like comparing every observation with ob_template in one sweep.
+
+        The lookups func made are recorded again for every later caller, so
+        incremental.py sees what each rule depends on even when it got a
+        remembered answer"""
+        if self._memo is None:
+            self._memo = {}
+        key = (func, args)
+        if key not in self._memo:
+            outer, self.accessed = self.accessed, set()
+            try:
+                result = func(self, *args)
+            finally:
+                used, self.accessed = self.accessed, outer
+            self._memo[key] = (result, used)
+        result, used = self._memo[key]
+        if self.accessed is not None:
+            self.accessed |= used
+        return result
+
+    def __getstate__(self):
+        # Snapshots hold the parsed project, not what was worked out from it
+        state = dict(self.__dict__)
+        state.pop('_memo', None)
+        state.pop('accessed', None)
+        return state
+
+    def lookup(self, kind, key=None):
+        """Repeat a recorded lookup: the Node (or list of Nodes) it returned"""
+        if kind == 'alerts':
+            return self.alert_list
+        if kind == 'surveys':
+            return list(self.surveys.values())
+        if kind == 'forms':
+            return list(self.forms.values())
+        if kind == 'invites':
+            return list(self.invites.values())
+        if kind == 'reports':
+            return list(self.reports.values())
+        return getattr(self, UNIT_INDEXES[kind]).get(key)
+
+    def _index(self, root):
+        """One walk over the whole tree, filing away every node we know about"""
+        indexers = {
+            ODM + 'FormDef': self._index_form,
+            ODM + 'ItemGroupDef': self._index_item_group,
+            ODM + 'ItemDef': self._index_item,
+            ODM + 'CodeList': self._index_code_list,
+            REDCAP + 'Alerts': self._index_alert,
+            REDCAP + 'Surveys': self._index_survey,
+            REDCAP + 'SurveysScheduler': self._index_invite,
+            REDCAP + 'Reports': self._index_report,
+            REDCAP + 'RepeatingInstrument': self._index_repeating_instrument,
+        }
+        for element in root.iter():
+            indexer = indexers.get(element.tag)
+            if indexer is not None:
+                indexer(Node.from_element(element))
+
+    # The xml file may contain duplicates (eg two alerts with the same title).
+    # An XPath .find() returns the first match, so setdefault() keeps the
+    # first one we see to give the same answer.
+
+    def _index_form(self, node):
+        self.forms.setdefault(node.attrib['OID'], node)
+        self.forms_by_name.setdefault(node.attrib[REDCAP + 'FormName'], node)
+
+    def _index_item_group(self, node):
+        self.item_groups.setdefault(node.attrib['OID'], node)
+
+    def _index_item(self, node):
+        self.items.setdefault(node.attrib['OID'], node)
+
+    def _index_code_list(self, node):
+        self.code_lists.setdefault(node.attrib['OID'], node)
+
+    def _index_alert(self, node):
+        key = (node.attrib.get('form_name'),
+               node.attrib.get('alert_title'),
+               node.attrib.get('alert_type'))
+        self.alerts.setdefault(key, node)
+        self.alert_list.append(node)
+
+    def _index_survey(self, node):
+        self.surveys.setdefault(node.attrib.get('form_name'), node)
+
+    def _index_invite(self, node):
+        self.invites.setdefault(node.attrib.get('survey_id'), node)
+
+    def _index_report(self, node):
+        self.reports.setdefault(node.attrib.get('title'), node)
+
+    def _index_repeating_instrument(self, node):
+        instr = node.attrib.get(REDCAP + 'RepeatInstrument')
+        self.repeating_instruments.setdefault(instr, node)
+
+    def form(self, oid):
+        """FormDef by OID eg 'Form.ob_3a'"""
+        self._used('form', oid)
+        return self.forms.get(oid)
+
+    def all_forms(self):
+        """Every FormDef, in the order they are in the file"""
+        self._used('forms')
+        return list(self.forms.values())
+
+    def instrument(self, form_name):
+        """FormDef by instrument name eg 'ob_3a'"""
+        self._used('instrument', form_name)
+        return self.forms_by_name.get(form_name)
+
+    def item_group(self, oid):
+        self._used('item_group', oid)
+        return self.item_groups.get(oid)
+
+    def item(self, oid):
+        self._used('item', oid)
+        return self.items.get(oid)
+
+    def code_list(self, oid):
+        """Choices for a field eg 'mon_sex.choices'"""
+        self._used('code_list', oid)
+        return self.code_lists.get(oid)
+
+    def alert(self, title, form_name, alert_type):
+        key = (form_name, title, alert_type)
+        self._used('alert', key)
+        return self.alerts.get(key)
+
+    def all_alerts(self):
+        """Every alert, in the order they are in the file"""
+        self._used('alerts')
+        return self.alert_list
+
+    def survey(self, form_name):
+        self._used('survey', form_name)
+        return self.surveys.get(form_name)
+
+    def all_surveys(self):
+        self._used('surveys')
+        return list(self.surveys.values())
+
+    def invite(self, survey_id):
+        """Automated survey invite (SurveysScheduler) for an instrument"""
+        self._used('invite', survey_id)
+        return self.invites.get(survey_id)
+
+    def all_invites(self):
+        self._used('invites')
+        return list(self.invites.values())
+
+    def report(self, title):
+        self._used('report', title)
+        return self.reports.get(title)
+
+    def all_reports(self):
+        self._used('reports')
+        return list(self.reports.values())
+
+    def repeating_instrument(self, form_name):
+        self._used('repeating_instrument', form_name)
+        return self.repeating_instruments.get(form_name)
+
+    def attachment(self, id):
+        return self.attachments.get(id)
+
+
+class Attachment:
+    """A redcap:OdmAttachment we skipped while parsing.
+
+    We only keep its attributes and where the base64 payload sits in the
+    xml file. data() reads and decodes it when it is actually needed."""
+
+    __slots__ = ('xmlfilepath', 'attrib', 'offset', 'length')
+
+    def __init__(self, xmlfilepath, attrib, offset, length):
+        self.xmlfilepath = xmlfilepath
+        self.attrib = attrib
+        self.offset = offset
+        self.length = length
+
+    def raw(self):
+        """The base64 text exactly as it is in the file"""
+        with open(self.xmlfilepath, 'rb') as file:
+            file.seek(self.offset)
+            return file.read(self.length)
+
+    def data(self):
+        """The decoded attachment eg the bytes of a png"""
+        return base64.b64decode(self.raw())
+
+    def sha256(self):
+        """Hash of the payload, to compare attachments without decoding"""
+        return hashlib.sha256(self.raw()).hexdigest()
+
+
+def find_attachments(xmlfilepath, buf):
+    """Byte scan buf (the xml file contents) for OdmAttachment payloads.
+
+    Returns {ID: Attachment} and a sorted list of (start, end) byte ranges
+    of the element contents that the parser should never see."""
+    attachments = {}
+    skip = []
+    for match in ATTACHMENT_START.finditer(buf):
+        start = match.end()
+        end = buf.find(ATTACHMENT_END, start)
+        if end < 0:
+            break  # Truncated file. Let the parser complain about it
+
+        attrib = {k.decode(): v.decode() for k, v in
+                  ATTACHMENT_ATTRS.findall(match.group(1))}
+
+        # Payload offsets point inside the CDATA wrapper
+        offset, length = start, end - start
+        if buf[start:start + len(CDATA_START)] == CDATA_START:
+            offset += len(CDATA_START)
+            length -= len(CDATA_START) + len(CDATA_END)
+
+        attachments[attrib.get('ID')] = Attachment(
+            xmlfilepath, attrib, offset, length)
+        skip.append((start, end))
+
+    return attachments, skip
+
+
+def iter_chunks(buf, skip):
+    """Yield buf in CHUNK_SIZE pieces leaving out the skip byte ranges"""
+    pos = 0
+    for skip_start, skip_end in skip + [(len(buf), len(buf))]:
+        while pos < skip_start:
+            chunk_end = min(pos + CHUNK_SIZE, skip_start)
+            yield buf[pos:chunk_end]
+            pos = chunk_end
+        pos = skip_end
+
+
+def parse_sections(chunks, sections):
+    """Incrementally parse the xml chunks, keeping only the wanted sections.
+
+    Returns the (pruned) root element"""
+    parser = etree.XMLPullParser(events=('end',), remove_blank_text=True)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _event, node in parser.read_events():
+            parent = node.getparent()
+            if (parent is not None and parent.tag in SECTION_PARENTS
+                    and node.tag not in SECTION_PARENTS
+                    and node.tag not in sections):
+                parent.remove(node)
+
+    return parser.close()
+
+
+def load_project(xmlfilepath, sections=AUDIT_SECTIONS):
+    """Stream a REDCap project xml file, keeping the sections we need, and
+    index it"""
+    with open(xmlfilepath, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        attachments, skip = find_attachments(xmlfilepath, buf)
+        root = parse_sections(iter_chunks(buf, skip), sections)
+
+    return ProjectModel(root, xmlfilepath=xmlfilepath, attachments=attachments)
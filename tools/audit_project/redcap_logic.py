@@ -0,0 +1,546 @@
+"""
+Parse and evaluate REDCap logic
+
+Branching logic, calculated fields, alert conditions, invite conditions and
+report filters are all written in the same little language eg.
+
+    if([temp_template] > [fw_high_temp], 1, 0)
+    [calc_mon_status_observation] = 1 and (datediff([mon_admission_date], 'today', 'd') = 9 or ...)
+    [cons_agree(1)] = 1
+
+parse() turns an expression into a tree of Field, Literal, Compare, BoolOp,
+Arith, Negate and Call nodes. Two expressions can then be compared by meaning
+rather than by spelling:
+
+    equivalent("[mon_group] <> '0'", "([mon_group] != 0)")      -> True
+
+compile_logic() turns an expression into a python function of a record
+(a dict of field name -> value, as REDCap would export it):
+
+    evaluate = compile_logic("if([temp_3a] > [fw_high_temp], 1, 0)")
+    evaluate({'temp_3a': '38.7', 'fw_high_temp': '38.5'})        -> 1
+
+Compiled functions are built once out of closures and cached by expression
+text, so evaluating the same condition for many records is cheap.
+
+What we follow of REDCap's rules
+- Values are compared as numbers if both sides look like numbers, otherwise as
+  text. '0' = 0 is true.
+- A blank value ('' or a missing field) only equals blank. Blank compared
+  with < > <= >= is false, and arithmetic on a blank gives a blank.
+- and/or (also AND OR && ||) treat blank, 0 and '0' as false.
+- Checkbox options [field(code)] are read from the exported column field___code.
+- Event prefixes [event][field] are parsed but records have no events, the
+  field is looked up by name.
+- datediff(date1, date2, units[, format[, signed]]) with 'today' or 'now' for
+  either date. Unsigned (absolute) unless signed is true. Units y M d h m s.
+"""
+
+from datetime import date, datetime
+from functools import lru_cache
+import math
+import re
+
+TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<field>(?:\[[^\[\]]+\])+)
+  | (?P<number>\d+(?:\.\d*)?|\.\d+)
+  | (?P<string>'[^']*'|"[^"]*")
+  | (?P<op><>|!=|==|<=|>=|&&|\|\||[=<>+\-*/^(),])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+''', re.VERBOSE)
+
+# Different spellings of the same operator
+OPERATORS = {'<>': '!=', '==': '=', '&&': 'and', '||': 'or'}
+COMPARISONS = ('=', '!=', '<', '>', '<=', '>=')
+
+FIELD_PART = re.compile(r'\[([^\[\]]+)\]')
+CHECKBOX = re.compile(r'^(\w+)\((\w+)\)$')
+
+# datediff units in seconds. Years and months as REDCap counts them
+DATEDIFF_UNITS = {
+    'y': 365.2425 * 86400,
+    'M': 30.44 * 86400,
+    'd': 86400,
+    'h': 3600,
+    'm': 60,
+    's': 1,
+}
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+class LogicError(ValueError):
+    """An expression we couldn't parse, or a function we don't know"""
+
+
+class Expr:
+    """Base of the syntax tree nodes. Equal if the same type and fields"""
+
+    __slots__ = ()
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __hash__(self):
+        return hash((type(self), self._values()))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(repr(value) for value in self._values()))
+
+
+class Field(Expr):
+    """[name], [name(code)] for a checkbox option, or [event][name]"""
+
+    __slots__ = ('name', 'choice', 'event')
+
+    def __init__(self, name, choice=None, event=None):
+        self.name = name
+        self.choice = choice
+        self.event = event
+
+    @property
+    def column(self):
+        """The record key the value is exported under"""
+        return self.name if self.choice is None else f'{self.name}___{self.choice}'
+
+
+class Literal(Expr):
+    """A number or a quoted string"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Compare(Expr):
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+class BoolOp(Expr):
+    """'and' or 'or' over two or more operands"""
+
+    __slots__ = ('op', 'operands')
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = tuple(operands)
+
+
+class Arith(Expr):
+    """+ - * / ^"""
+
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+class Negate(Expr):
+    __slots__ = ('operand',)
+
+    def __init__(self, operand):
+        self.operand = operand
+
+
+class Call(Expr):
+    """A function eg if(), datediff(), round()"""
+
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = tuple(args)
+
+
+def tokenize(text):
+    """[(kind, value, position), ...] ending with ('end', None, len(text))"""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None:
+            raise LogicError(f"Unexpected {text[pos:pos + 10]!r} at {pos} in {text!r}")
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'op':
+            value = OPERATORS.get(value, value)
+        elif kind == 'name' and value.lower() in ('and', 'or'):
+            kind, value = 'op', value.lower()
+        if kind != 'space':
+            tokens.append((kind, value, pos))
+        pos = match.end()
+    tokens.append(('end', None, pos))
+    return tokens
+
+
+class Parser:
+    """Recursive descent, loosest binding first:
+        or, and, comparison, + -, * /, ^, unary -, (...) call field literal"""
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, got, pos = self.take()
+        if got != value:
+            raise LogicError(f"Expected {value!r} at {pos} in {self.text!r}")
+
+    def error(self, what):
+        _kind, value, pos = self.peek()
+        found = 'end' if value is None else repr(value)
+        return LogicError(f"{what} at {pos} (found {found}) in {self.text!r}")
+
+    def parse(self):
+        expr = self.boolean('or', self.boolean_and)
+        if self.peek()[0] != 'end':
+            raise self.error("Unexpected text")
+        return expr
+
+    def boolean(self, op, operand):
+        operands = [operand()]
+        while self.peek()[1] == op and self.peek()[0] == 'op':
+            self.take()
+            operands.append(operand())
+        if len(operands) == 1:
+            return operands[0]
+        # Flatten (a and b) and c into one and
+        flat = []
+        for expr in operands:
+            flat.extend(expr.operands if isinstance(expr, BoolOp) and expr.op == op else [expr])
+        return BoolOp(op, flat)
+
+    def boolean_and(self):
+        return self.boolean('and', self.comparison)
+
+    def comparison(self):
+        left = self.additive()
+        while self.peek()[0] == 'op' and self.peek()[1] in COMPARISONS:
+            op = self.take()[1]
+            left = Compare(op, left, self.additive())
+        return left
+
+    def additive(self):
+        left = self.multiplicative()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('+', '-'):
+            op = self.take()[1]
+            left = Arith(op, left, self.multiplicative())
+        return left
+
+    def multiplicative(self):
+        left = self.power()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('*', '/'):
+            op = self.take()[1]
+            left = Arith(op, left, self.power())
+        return left
+
+    def power(self):
+        base = self.unary()
+        if self.peek()[0] == 'op' and self.peek()[1] == '^':
+            self.take()
+            return Arith('^', base, self.power())
+        return base
+
+    def unary(self):
+        if self.peek()[0] == 'op' and self.peek()[1] in ('-', '+'):
+            op = self.take()[1]
+            operand = self.unary()
+            return Negate(operand) if op == '-' else operand
+        return self.primary()
+
+    def primary(self):
+        kind, value, _pos = self.peek()
+        if kind == 'op' and value == '(':
+            self.take()
+            expr = self.boolean('or', self.boolean_and)
+            self.expect(')')
+            return expr
+        if kind == 'field':
+            self.take()
+            return parse_field(value)
+        if kind == 'number':
+            self.take()
+            return Literal(float(value) if '.' in value else int(value))
+        if kind == 'string':
+            self.take()
+            return Literal(value[1:-1])
+        if kind == 'name':
+            self.take()
+            if self.peek()[1] != '(':
+                # eg a bare today, true, false
+                return Literal(value)
+            self.take()
+            args = []
+            if self.peek()[1] != ')':
+                args.append(self.boolean('or', self.boolean_and))
+                while self.peek()[1] == ',':
+                    self.take()
+                    args.append(self.boolean('or', self.boolean_and))
+            self.expect(')')
+            return Call(value.lower(), args)
+        raise self.error("Expected a value")
+
+
+def parse_field(token):
+    """'[event][field(1)]' -> Field('field', '1', 'event')"""
+    parts = FIELD_PART.findall(token)
+    name = parts[-1].strip()
+    event = parts[-2].strip() if len(parts) > 1 else None
+    checkbox = CHECKBOX.match(name)
+    if checkbox:
+        return Field(checkbox.group(1), checkbox.group(2), event)
+    return Field(name, None, event)
+
+
+@lru_cache(maxsize=4096)
+def parse(text):
+    """Syntax tree of a REDCap logic expression. Raises LogicError"""
+    return Parser(text).parse()
+
+
+def fields(text):
+    """Names of every field an expression refers to"""
+    found = set()
+
+    def walk(expr):
+        if isinstance(expr, Field):
+            found.add(expr.name)
+        for value in expr._values():
+            for item in value if isinstance(value, tuple) else (value,):
+                if isinstance(item, Expr):
+                    walk(item)
+
+    walk(parse(text))
+    return found
+
+
+def as_number(value):
+    """Number, or None if the value doesn't look like one"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def canonical(expr):
+    """A normal form of the tree, so the same logic written differently
+    compares equal: numeric strings become numbers, and/or operands are put
+    in a fixed order"""
+    if isinstance(expr, Literal):
+        number = as_number(expr.value)
+        return Literal(float(number)) if number is not None else expr
+    if isinstance(expr, Field):
+        return Field(expr.name, expr.choice)
+    if isinstance(expr, BoolOp):
+        return BoolOp(expr.op, sorted((canonical(e) for e in expr.operands), key=repr))
+    if isinstance(expr, (Compare, Arith)):
+        return type(expr)(expr.op, canonical(expr.left), canonical(expr.right))
+    if isinstance(expr, Negate):
+        return Negate(canonical(expr.operand))
+    return Call(expr.name, [canonical(arg) for arg in expr.args])
+
+
+def equivalent(text1, text2):
+    """Do two expressions mean the same thing? Spacing, brackets, operator
+    spellings, quoting of numbers and the order of and/or operands don't
+    matter"""
+    return canonical(parse(text1)) == canonical(parse(text2))
+
+
+# Evaluation
+
+def is_blank(value):
+    return value is None or value == ''
+
+
+def truthy(value):
+    if is_blank(value):
+        return False
+    number = as_number(value)
+    if number is not None:
+        return number != 0
+    return bool(value)
+
+
+def compare(op, left, right):
+    if is_blank(left) or is_blank(right):
+        if op == '=':
+            return is_blank(left) and is_blank(right)
+        if op == '!=':
+            return not (is_blank(left) and is_blank(right))
+        return False
+
+    left_number = as_number(left)
+    right_number = as_number(right)
+    if left_number is not None and right_number is not None:
+        left, right = left_number, right_number
+    else:
+        left, right = str(left), str(right)
+
+    if op == '=':
+        return left == right
+    if op == '!=':
+        return left != right
+    if op == '<':
+        return left < right
+    if op == '>':
+        return left > right
+    if op == '<=':
+        return left <= right
+    return left >= right
+
+
+def arith(op, left, right):
+    left = as_number(left)
+    right = as_number(right)
+    if left is None or right is None:
+        return ''
+    if op == '+':
+        return left + right
+    if op == '-':
+        return left - right
+    if op == '*':
+        return left * right
+    if op == '/':
+        return left / right if right else ''
+    return left ** right
+
+
+def as_datetime(value, now):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if value in ('today', 'now'):
+        return now if value == 'now' else datetime(now.year, now.month, now.day)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def datediff(now, date1, date2, units='d', fmt=None, signed=False):
+    first = as_datetime(date1, now)
+    second = as_datetime(date2, now)
+    if first is None or second is None or units not in DATEDIFF_UNITS:
+        return ''
+    diff = (second - first).total_seconds() / DATEDIFF_UNITS[units]
+    if not truthy(signed):
+        diff = abs(diff)
+    return round(diff, 10)
+
+
+def numbers(args):
+    return [number for number in map(as_number, args) if number is not None]
+
+
+def redcap_round(value, places=0, how=round):
+    number = as_number(value)
+    if number is None:
+        return ''
+    scale = 10 ** int(as_number(places) or 0)
+    return how(number * scale) / scale
+
+
+# Functions of already evaluated arguments. if() is special cased, it only
+# evaluates the branch it takes
+FUNCTIONS = {
+    'round': redcap_round,
+    'roundup': lambda value, places=0: redcap_round(value, places, math.ceil),
+    'rounddown': lambda value, places=0: redcap_round(value, places, math.floor),
+    'abs': lambda value: '' if as_number(value) is None else abs(as_number(value)),
+    'min': lambda *args: min(numbers(args), default=''),
+    'max': lambda *args: max(numbers(args), default=''),
+    'sum': lambda *args: sum(numbers(args)),
+    'mean': lambda *args: sum(numbers(args)) / len(numbers(args)) if numbers(args) else '',
+    'isnumber': lambda value: as_number(value) is not None,
+    'isblankormissingcode': is_blank,
+}
+
+
+def build(expr):
+    """Closure evaluating expr against (record, now)"""
+    if isinstance(expr, Literal):
+        value = expr.value
+        return lambda record, now: value
+
+    if isinstance(expr, Field):
+        column = expr.column
+        return lambda record, now: record.get(column, '')
+
+    if isinstance(expr, Compare):
+        op = expr.op
+        left, right = build(expr.left), build(expr.right)
+        return lambda record, now: compare(op, left(record, now), right(record, now))
+
+    if isinstance(expr, BoolOp):
+        operands = [build(operand) for operand in expr.operands]
+        if expr.op == 'and':
+            return lambda record, now: all(truthy(f(record, now)) for f in operands)
+        return lambda record, now: any(truthy(f(record, now)) for f in operands)
+
+    if isinstance(expr, Arith):
+        op = expr.op
+        left, right = build(expr.left), build(expr.right)
+        return lambda record, now: arith(op, left(record, now), right(record, now))
+
+    if isinstance(expr, Negate):
+        operand = build(expr.operand)
+        return lambda record, now: arith('-', 0, operand(record, now))
+
+    if expr.name == 'if':
+        if len(expr.args) != 3:
+            raise LogicError(f"if() takes 3 arguments, not {len(expr.args)}")
+        test, then, otherwise = (build(arg) for arg in expr.args)
+        return lambda record, now: (then(record, now) if truthy(test(record, now))
+                                    else otherwise(record, now))
+
+    args = [build(arg) for arg in expr.args]
+    if expr.name == 'datediff':
+        return lambda record, now: datediff(now, *(f(record, now) for f in args))
+
+    function = FUNCTIONS.get(expr.name)
+    if function is None:
+        raise LogicError(f"Unknown function {expr.name}()")
+    return lambda record, now: function(*(f(record, now) for f in args))
+
+
+@lru_cache(maxsize=4096)
+def compile_logic(text):
+    """A function evaluate(record, now=None) for a REDCap logic expression.
+    record is {field name: value}. now is the datetime 'today' and 'now'
+    mean, the current time if not given"""
+    evaluate = build(parse(text))
+
+    def run(record, now=None):
+        return evaluate(record, now if now is not None else datetime.now())
+
+    run.__doc__ = text
+    return run
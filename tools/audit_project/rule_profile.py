@@ -0,0 +1,128 @@
+"""
+Where the audit's time and memory goes
+
+run_checks(..., profile=True) records each check's wall time ('duration'),
+CPU time ('cpu') and the peak memory it allocated ('memory_peak', from
+tracemalloc). This adds them up per rule, prints the slowest rules, and
+writes a table of every check that can be kept with the results and compared
+from one export to the next:
+
+    ./audit_project.py --profile profile.csv Project.REDCap.xml
+
+For a closer look the slowest rules can be run again under cProfile, one
+pstats file per rule (plus a readable .txt of the top functions):
+
+    ./audit_project.py --profile profile.csv --pstats profiles/ Project.REDCap.xml
+    python -m pstats profiles/test_observation_alerts_match_template.prof
+
+Checks that share work through a cache (eg banned_strings.scan_file()) only
+show it in the first check to need it in the times. Each rule is profiled
+from cold: a freshly loaded project, so nothing memoised, and the module
+level caches in CACHES cleared, so its profile shows the work it causes
+rather than cache hits.
+
+tracemalloc slows down everything that allocates, so times under --profile
+are higher than a normal run. Compare them with other profiled runs.
+"""
+
+import cProfile
+import csv
+import io
+import os
+import pstats
+
+from banned_strings import scan_cached
+from calc_graph import build_graph
+from field_references import tokenize
+from project_cache import load_project_cached
+from redcap_logic import compile_logic, parse
+from rule_runner import collect_checks, run_check
+from vector_logic import compile_vector
+
+COLUMNS = ['id', 'rule', 'outcome', 'duration', 'cpu', 'memory_peak']
+
+# lru_caches the audit fills, cleared to time or profile from cold
+CACHES = [scan_cached, build_graph, tokenize, parse, compile_logic, compile_vector]
+
+
+class RuleTotals:
+    """A rule's checks added up"""
+
+    __slots__ = ('rule', 'checks', 'duration', 'cpu', 'memory_peak', 'slowest')
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.checks = 0
+        self.duration = 0.0
+        self.cpu = 0.0
+        self.memory_peak = 0
+        self.slowest = None
+
+    def add(self, result):
+        self.checks += 1
+        self.duration += result['duration']
+        self.cpu += result.get('cpu', 0.0)
+        self.memory_peak = max(self.memory_peak, result.get('memory_peak', 0))
+        if self.slowest is None or result['duration'] > self.slowest['duration']:
+            self.slowest = result
+
+
+def rule_totals(results):
+    """[RuleTotals, ...] slowest rule first"""
+    totals = {}
+    for result in results:
+        if result['rule'] not in totals:
+            totals[result['rule']] = RuleTotals(result['rule'])
+        totals[result['rule']].add(result)
+    return sorted(totals.values(), key=lambda total: total.duration, reverse=True)
+
+
+def write_profile(results, path):
+    """Every check's time and memory as csv, in check order"""
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(dict(result, duration='%.6f' % result['duration'],
+                                 cpu='%.6f' % result['cpu']))
+
+
+def print_profile(results, out, slowest=10):
+    """Table of the slowest rules"""
+    totals = rule_totals(results)
+    out.write(f"\nSlowest rules of {len(totals)}, "
+              f"{sum(total.duration for total in totals):.3f}s in all\n")
+    out.write(f"{'wall s':>8} {'cpu s':>8} {'peak KiB':>9} {'checks':>6}  rule (slowest check)\n")
+    for total in totals[:slowest]:
+        detail = f" ({total.slowest['id']} {total.slowest['duration']:.3f}s)" \
+            if total.checks > 1 else ''
+        out.write(f"{total.duration:8.3f} {total.cpu:8.3f} {total.memory_peak / 1024:9.0f} "
+                  f"{total.checks:6}  {total.rule}{detail}\n")
+
+
+def clear_caches():
+    """Empty the module level caches, as a fresh process would have them"""
+    for cache in CACHES:
+        cache.cache_clear()
+
+
+def dump_pstats(module, xmlfilepath, rule_names, directory, top=30, load=load_project_cached):
+    """Run each rule's checks again under cProfile, from cold. Writes
+    <rule>.prof for pstats and <rule>.txt with the top functions by
+    cumulative time"""
+    os.makedirs(directory, exist_ok=True)
+    checks = collect_checks(module)
+    for rule_name in rule_names:
+        proj = load(xmlfilepath)
+        clear_caches()
+        profiler = cProfile.Profile()
+        for check in checks:
+            if check.rule.name == rule_name:
+                profiler.runcall(run_check, check, proj, xmlfilepath)
+
+        path = os.path.join(directory, rule_name)
+        profiler.dump_stats(path + '.prof')
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+        with open(path + '.txt', 'w') as file:
+            file.write(text.getvalue())
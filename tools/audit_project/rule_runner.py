@@ -0,0 +1,377 @@
+"""
+Rule registry and runner for the audit checks in audit_project.py
+
+Checks register themselves with the @rule decorator:
+
+    @rule()
+    def test_registration_instrument_exists(proj):
+        ...
+
+    @rule(over=EXPECTED_OBSERVATIONS)
+    def test_observation_exists(proj, obs):
+        ...
+
+A rule with over= becomes one check per value, eg test_observation_exists[ob_3a].
+A rule asks for the indexed project (proj) and/or the xml file path
+(projxmlpath) by naming them as arguments.
+
+The runner calls the checks directly. It does not need pytest, runs every
+check rather than stopping at the first failure, and can write the results
+as JSON or JUnit xml. A failed bare assert is reported whole, with the
+values of its operands where they are plain lookups (calls aren't re-run)
+and the differing keys when two dicts are compared. pytest is still a
+front end: when pytest is loaded @rule also applies the matching
+pytest.mark.parametrize, and conftest.py supplies proj and projxmlpath as
+fixtures.
+
+Checks can be spread across worker processes (jobs > 1). The project is
+loaded once in the parent and worker processes are forked after that so
+they share the parsed model copy-on-write. Where fork isn't available the
+workers load the model from the on-disk snapshot (project_cache.py) instead
+of re-parsing the xml. Results are sorted back into rule order, so the
+report is the same however many jobs ran.
+
+With profile=True each result also records the check's CPU time and peak
+memory allocated (tracemalloc), see rule_profile.py.
+"""
+
+from functools import lru_cache
+from multiprocessing import get_all_start_methods, get_context
+import ast
+import importlib
+import inspect
+import json
+import os
+import reprlib
+import sys
+import time
+import traceback
+import tracemalloc
+
+from lxml import etree
+
+from project_cache import load_project_cached
+
+# The arguments a rule can ask for
+RULE_ARGS = ('proj', 'projxmlpath')
+
+PASSED = 'PASSED'
+FAILED = 'FAILED'
+SKIPPED = 'SKIPPED'
+ERROR = 'ERROR'
+
+# Expressions in a failed assert that are shown with their values. Looking
+# these up again has no side effects, calls are never re-run
+PLAIN_EXPRESSION = (ast.Name, ast.Attribute, ast.Subscript, ast.Constant, ast.Tuple,
+                    ast.Slice, ast.Load)
+
+# How much of each value a failure message shows
+FAILURE_REPR = reprlib.Repr()
+FAILURE_REPR.maxstring = FAILURE_REPR.maxother = 200
+
+# Every registered rule, in the order they were defined
+RULES = []
+
+# Worker process state. Set before forking, or by worker_init()
+WORKER_STATE = None
+
+
+class SkipRule(Exception):
+    """Raised by skip_rule() when running without pytest"""
+
+
+class Rule:
+    """A registered audit check function"""
+
+    def __init__(self, func, argname, values):
+        self.func = func
+        self.name = func.__name__
+        self.module = func.__module__
+        self.argname = argname
+        self.values = values
+        params = inspect.signature(func).parameters
+        self.wants = [name for name in RULE_ARGS if name in params]
+
+
+class Check:
+    """One rule run with one parameter value"""
+
+    def __init__(self, rule, value=None):
+        self.rule = rule
+        self.params = {rule.argname: value} if rule.argname else {}
+        self.id = rule.name + (f'[{value}]' if rule.argname else '')
+
+    def __repr__(self):
+        return f'<Check {self.id}>'
+
+
+def rule(over=None, arg='obs'):
+    """Decorator registering an audit check. See the module docstring"""
+
+    def register(func):
+        RULES.append(Rule(func, arg if over is not None else None, over))
+
+        # Only touch pytest if it's already loaded (ie it's collecting us),
+        # importing it just to run checks costs more than the checks
+        pytest = sys.modules.get('pytest')
+        if pytest is not None and over is not None:
+            func = pytest.mark.parametrize(arg, over)(func)
+        return func
+
+    return register
+
+
+def skip_rule(reason):
+    """Skip the running check. Works under pytest and the native runner"""
+    if 'PYTEST_CURRENT_TEST' in os.environ:
+        import pytest
+        pytest.skip(reason)
+    raise SkipRule(reason)
+
+
+def collect_checks(module):
+    """All the checks registered by module, in definition order"""
+    checks = []
+    for registered in RULES:
+        if registered.module != module.__name__:
+            continue
+        if registered.argname is None:
+            checks.append(Check(registered))
+        else:
+            checks.extend(Check(registered, value) for value in registered.values)
+    return checks
+
+
+def describe_failure(exc):
+    """Short description of where and why a check failed. A bare assert is
+    shown whole, with the values of its operands"""
+    tb = exc.__traceback__
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    where = f'{os.path.basename(tb.tb_frame.f_code.co_filename)}:{tb.tb_lineno}'
+    if str(exc) or not isinstance(exc, AssertionError):
+        return f'{where}: {exc}'
+    source, node = failed_assert(tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+    if node is None:
+        return f'{where}: {traceback.extract_tb(tb)[-1].line}'
+    values = {}
+    for operand, text in assert_operands(source, node):
+        try:
+            values[text] = eval(compile(ast.Expression(operand), '<assert>', 'eval'),
+                                tb.tb_frame.f_globals, tb.tb_frame.f_locals)
+        except Exception:
+            continue
+    if len(values) == 2 and all(isinstance(value, dict) for value in values.values()):
+        values = dict_differences(*values.items())
+    else:
+        values = [f'{text} = {FAILURE_REPR.repr(value)}' for text, value in values.items()]
+    statement = ' '.join(line.strip().rstrip('\\').strip()
+                         for line in ast.get_source_segment(source, node).splitlines())
+    return f'{where}: {statement}' + (f" ({'; '.join(values)})" if values else '')
+
+
+@lru_cache(maxsize=None)
+def source_asserts(filename):
+    """The file's source and its assert statements"""
+    with open(filename) as file:
+        source = file.read()
+    return source, [node for node in ast.walk(ast.parse(source)) if isinstance(node, ast.Assert)]
+
+
+def failed_assert(filename, lineno):
+    """(source, the ast.Assert at lineno), (None, None) if there's no source"""
+    try:
+        source, asserts = source_asserts(filename)
+    except (OSError, SyntaxError):
+        return None, None
+    for node in asserts:
+        if node.lineno <= lineno <= node.end_lineno:
+            return source, node
+    return None, None
+
+
+def dict_differences(left, right):
+    """['key: left value != right value', ...] of two compared dicts"""
+    (left_text, left), (right_text, right) = left, right
+    return [f'{key!r}: {FAILURE_REPR.repr(left.get(key))} != {FAILURE_REPR.repr(right.get(key))}'
+            for key in sorted(left.keys() | right.keys(), key=str)
+            if key not in left or key not in right or left[key] != right[key]] \
+        or [f'{left_text} = {FAILURE_REPR.repr(left)}', f'{right_text} = {FAILURE_REPR.repr(right)}']
+
+
+def assert_operands(source, node):
+    """[(expression, its source), ...] worth showing the value of: each side
+    of a comparison, or the whole test, if they're plain lookups"""
+    test = node.test
+    if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not):
+        test = test.operand
+    operands = [test.left] + test.comparators if isinstance(test, ast.Compare) else [test]
+    return [(operand, ast.get_source_segment(source, operand)) for operand in operands
+            if not isinstance(operand, ast.Constant)
+            and all(isinstance(part, PLAIN_EXPRESSION) for part in ast.walk(operand))]
+
+
+def run_check(check, proj, xmlfilepath, track_units=False, profile=False):
+    """Run one check. Returns a result dict.
+
+    With track_units the result also lists the parts of the project the
+    check looked at, as [kind, key] pairs (see incremental.py). With profile
+    it has the check's 'cpu' seconds and 'memory_peak' bytes"""
+    available = {'proj': proj, 'projxmlpath': xmlfilepath}
+    args = {name: available[name] for name in check.rule.wants}
+
+    if track_units:
+        proj.accessed = set()
+
+    if profile:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+        cpu_start = time.process_time()
+
+    start = time.perf_counter()
+    message = ''
+    try:
+        check.rule.func(**args, **check.params)
+        outcome = PASSED
+    except AssertionError as exc:
+        outcome = FAILED
+        message = describe_failure(exc)
+    except SkipRule as exc:
+        outcome = SKIPPED
+        message = str(exc)
+    except Exception as exc:
+        outcome = ERROR
+        message = describe_failure(exc) + ' ' + type(exc).__name__
+
+    result = {
+        'id': check.id,
+        'rule': check.rule.name,
+        'outcome': outcome,
+        'message': message,
+        'duration': time.perf_counter() - start,
+    }
+
+    if profile:
+        result['cpu'] = time.process_time() - cpu_start
+        result['memory_peak'] = tracemalloc.get_traced_memory()[1] - memory_start
+
+    if track_units:
+        units = proj.accessed
+        proj.accessed = None
+        if 'projxmlpath' in check.rule.wants:
+            # Reads the file itself, so depends on all of it
+            units.add(('file', None))
+        result['units'] = [list(unit) for unit in units]
+
+    return result
+
+
+def worker_init(module_name, xmlfilepath, check_ids, track_units, profile):
+    """Start a non-forked worker: import the rules, load the cached model"""
+    global WORKER_STATE
+    module = importlib.import_module(module_name)
+    wanted = set(check_ids)
+    WORKER_STATE = ([check for check in collect_checks(module) if check.id in wanted],
+                    load_project_cached(xmlfilepath),
+                    xmlfilepath, track_units, profile)
+
+
+def worker_run(index):
+    checks, proj, xmlfilepath, track_units, profile = WORKER_STATE
+    return index, run_check(checks[index], proj, xmlfilepath, track_units, profile)
+
+
+def run_checks(module, xmlfilepath, jobs=1, proj=None, checks=None,
+               track_units=False, profile=False):
+    """Run every check in module (or just checks) against the project xml
+    file.
+
+    Returns the results in check order"""
+    global WORKER_STATE
+
+    if checks is None:
+        checks = collect_checks(module)
+    if proj is None:
+        proj = load_project_cached(xmlfilepath)
+
+    if jobs <= 1 or len(checks) <= 1:
+        results = [run_check(check, proj, xmlfilepath, track_units, profile)
+                   for check in checks]
+        if profile:
+            tracemalloc.stop()
+        return results
+
+    if 'fork' in get_all_start_methods():
+        # Children inherit the loaded model, nothing to re-load
+        WORKER_STATE = (checks, proj, xmlfilepath, track_units, profile)
+        pool = get_context('fork').Pool(jobs)
+    else:
+        pool = get_context().Pool(jobs, initializer=worker_init,
+                                  initargs=(module.__name__, xmlfilepath,
+                                            [check.id for check in checks],
+                                            track_units, profile))
+
+    with pool:
+        results = dict(pool.imap_unordered(worker_run, range(len(checks))))
+
+    WORKER_STATE = None
+    return [results[i] for i in range(len(checks))]
+
+
+def summarise(results):
+    """{'PASSED': n, 'FAILED': n, ...}"""
+    counts = {}
+    for result in results:
+        counts[result['outcome']] = counts.get(result['outcome'], 0) + 1
+    return counts
+
+
+def print_report(results, out):
+    """pytest -v style report. Returns True if every check passed"""
+    for result in results:
+        out.write(f"{result['id']} {result['outcome']}\n")
+
+    problems = [r for r in results if r['outcome'] in (FAILED, ERROR)]
+    if problems:
+        out.write('\n')
+    for result in problems:
+        out.write(f"{result['outcome']} {result['id']} - {result['message']}\n")
+
+    summary = ', '.join(f'{n} {outcome.lower()}'
+                        for outcome, n in sorted(summarise(results).items()))
+    out.write(f'\n{summary}\n')
+
+    return not problems
+
+
+def write_json(results, path, xmlfilepath):
+    """Machine readable results"""
+    with open(path, 'w') as file:
+        json.dump({
+            'projxmlfile': xmlfilepath,
+            'summary': summarise(results),
+            'results': results,
+        }, file, indent=1)
+
+
+def write_junit(results, path, suite_name):
+    """JUnit xml results, for CI servers and editors"""
+    counts = summarise(results)
+    suites = etree.Element('testsuites')
+    suite = etree.SubElement(
+        suites, 'testsuite', name=suite_name, tests=str(len(results)),
+        failures=str(counts.get(FAILED, 0)), errors=str(counts.get(ERROR, 0)),
+        skipped=str(counts.get(SKIPPED, 0)),
+        time='%.3f' % sum(r['duration'] for r in results))
+
+    for result in results:
+        case = etree.SubElement(suite, 'testcase', classname=suite_name,
+                                name=result['id'], time='%.6f' % result['duration'])
+        tag = {FAILED: 'failure', ERROR: 'error', SKIPPED: 'skipped'}.get(result['outcome'])
+        if tag:
+            etree.SubElement(case, tag, message=result['message'])
+
+    etree.ElementTree(suites).write(
+        path, xml_declaration=True, encoding='UTF-8', pretty_print=True)
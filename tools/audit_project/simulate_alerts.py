@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Simulate the alert levels an observation instrument gives for many readings
+
+Each observation (ob_1a, ob_1b, ...) decides whether to alert with a chain of
+calc fields (see documentation/redcap_design_overview.md):
+
+    calc_in_fw_temp_3a      if([temp_3a] > [fw_high_temp], 1, 0)
+    ...
+    calc_trigger_mc_3a      ...
+    calc_trigger_alert_level_3a     0 NONE, 1 FEVER WARNING, 2 CLINICAL REVIEW, 3 MET CALL
+
+We take those calculations out of the project xml file and evaluate them with
+numpy (vector_logic.py) over whole arrays of readings and per patient
+thresholds, so a change to the thresholds or the logic can be checked
+against millions of readings in seconds.
+
+Calc fields are evaluated one after the other in the order they are on the
+form, as REDCap does. A calc that uses one further down the form sees it
+blank, just like in REDCap.
+
+Readings are named without the observation's suffix (sat, hr, temp) or in
+full (sat_3a). Thresholds the readings don't give (fw_high_temp,
+cr_low_sat...) take the @DEFAULT from their registration field.
+
+    sim = AlertSimulator(proj, 'ob_3a')
+    sim.alert_levels({'sat': sats, 'hr': hrs, 'temp': temps})
+
+Usage
+  ./simulate_alerts.py Project.REDCap.xml ob_3a readings.csv [--out levels.csv]
+  ./simulate_alerts.py Project.REDCap.xml ob_3a --random 1000000
+
+readings.csv has a header row naming its columns eg. sat,hr,temp,cr_low_sat
+"""
+
+import argparse
+import re
+import sys
+import time
+
+import numpy as np
+from lxml import etree
+
+from calc_graph import form_calcs
+from project_cache import load_project_cached
+from project_model import REDCAP
+from redcap_logic import fields
+from template_families import OBCODE
+from vector_logic import compile_vector
+
+DEFAULT_ANNOTATION = re.compile(r'''@DEFAULT\s*=\s*(['"])(.*?)\1''')
+
+ALERT_LEVELS = ['NONE', 'FEVER WARNING', 'CLINICAL REVIEW', 'MET CALL']
+
+
+def field_default(proj, name):
+    """A field's @DEFAULT annotation as a number, or None"""
+    item = proj.item(name)
+    if item is None:
+        return None
+    found = DEFAULT_ANNOTATION.search(item.attrib.get(REDCAP + 'FieldAnnotation', ''))
+    if found is None:
+        return None
+    try:
+        return float(found.group(2))
+    except ValueError:
+        return None
+
+
+class AlertSimulator:
+    """The calc fields of one observation instrument, ready to run on arrays"""
+
+    def __init__(self, proj, form_name):
+        found = OBCODE.fullmatch(form_name)
+        if found is None:
+            raise ValueError(f"{form_name} isn't an observation instrument, eg ob_3a")
+        if proj.instrument(form_name) is None:
+            raise ValueError(f"No instrument {form_name} in {proj.xmlfilepath}")
+        self.form_name = form_name
+        self.suffix = '_' + found.group(1)
+
+        self.calcs = form_calcs(proj, form_name)
+        self.compiled = [(name, compile_vector(calc)) for name, calc in self.calcs]
+
+        calculated = {name for name, _calc in self.calcs}
+        self.inputs = sorted({name for _name, calc in self.calcs for name in fields(calc)}
+                             - calculated)
+        self.defaults = {name: field_default(proj, name) for name in self.inputs}
+
+    def columns(self, readings):
+        """Map the given readings onto the fields the calcs use"""
+        columns = {}
+        for name in self.inputs:
+            short = name[:-len(self.suffix)] if name.endswith(self.suffix) else None
+            if name in readings:
+                columns[name] = readings[name]
+            elif short is not None and short in readings:
+                columns[name] = readings[short]
+            elif self.defaults[name] is not None:
+                columns[name] = self.defaults[name]
+        return {name: np.asarray(values, dtype=float) for name, values in columns.items()}
+
+    def run(self, readings):
+        """Every calc field's value for every row. {field name: array}"""
+        columns = self.columns(readings)
+        for name, evaluate in self.compiled:
+            columns[name] = np.asarray(evaluate(columns), dtype=float)
+        return columns
+
+    def alert_levels(self, readings):
+        """calc_trigger_alert_level for every row"""
+        return self.run(readings)['calc_trigger_alert_level' + self.suffix]
+
+
+def read_csv(path):
+    """{column name: float array} from a csv file with a header row"""
+    with open(path) as file:
+        header = file.readline().strip().split(',')
+    data = np.genfromtxt(path, delimiter=',', skip_header=1, dtype=float,
+                         ndmin=2, filling_values=np.nan)
+    return {name.strip(): data[:, i] for i, name in enumerate(header)}
+
+
+def random_readings(rows, seed=0):
+    """Plausible spread of patient readings, for trying things out"""
+    rng = np.random.default_rng(seed)
+    return {
+        'sat': np.clip(rng.normal(96, 2.5, rows).round(), 70, 100),
+        'hr': rng.normal(85, 20, rows).round(),
+        'temp': rng.normal(37.2, 0.8, rows).round(1),
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Simulate observation alert levels for many readings")
+    parser.add_argument('projxmlfile', metavar='Project.REDCAP.xml')
+    parser.add_argument('form_name', metavar='ob_3a')
+    parser.add_argument('readings', nargs='?', metavar='readings.csv')
+    parser.add_argument('--random', type=int, metavar='N',
+                        help="Make up N random readings instead")
+    parser.add_argument('--out', metavar='FILE',
+                        help="Write the readings with their alert level as csv")
+    args = parser.parse_args()
+
+    if (args.readings is None) == (args.random is None):
+        sys.exit("Give either a readings.csv file or --random N")
+
+    try:
+        sim = AlertSimulator(load_project_cached(args.projxmlfile), args.form_name)
+        readings = read_csv(args.readings) if args.readings else random_readings(args.random)
+    except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+        sys.exit(f"{exc}\n\n{parser.format_usage()}")
+
+    start = time.perf_counter()
+    levels = sim.alert_levels(readings)
+    took = time.perf_counter() - start
+
+    # A blank level is a calc with nothing to go on, eg a missing threshold,
+    # not NONE
+    blank = np.isnan(levels)
+    counts = np.bincount(levels[~blank].astype(int), minlength=len(ALERT_LEVELS))
+    print(f"{len(levels)} readings in {took:.3f}s")
+    for level, count in enumerate(counts):
+        print(f"  {level} {ALERT_LEVELS[level]:16} {count}")
+    print(f"    {'(blank)':16} {np.count_nonzero(blank)}")
+
+    if args.out:
+        names = list(readings)
+        table = np.column_stack([readings[name] for name in names] + [levels])
+        np.savetxt(args.out, table, delimiter=',', fmt='%g',
+                   header=','.join(names + ['alert_level']), comments='')
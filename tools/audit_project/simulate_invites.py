@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""
+Simulate the SMS load from the Automated Survey Invites (redcap:SurveysScheduler)
+
+Each observation has an invite that REDCap schedules the day before it's due
+and sends at 8am or 3pm, with reminders every few hours until the patient
+fills it in (see 'Observation Invites' in documentation/redcap_design_overview.md).
+Every patient's invites go out in the same minute, so with thousands of
+patients we need to know how many SMS a minute Twilio has to take, and we want
+to know that the schedule logic sends every patient each observation once.
+
+We read every active invite and its condition logic out of the project file,
+make up patients admitted over a number of days, and play REDCap's scheduler
+forward for all of them at once with numpy (vector_logic.py):
+
+- A patient's registration calc fields (calc_admission_days, ...,
+  calc_mon_status_observation) are worked out from the project's own
+  calculations each day, with mon_group BIDAILY and patient_loc home
+- Invite logic is checked when a survey is completed and by REDCap's daily
+  check at --check-time. The first time it's true (and the 'when survey is
+  completed' survey is done) the invite is scheduled. Each invite is only
+  ever scheduled once per patient
+- Patients complete ob_0 at admission
+- 'Send on next day at hh:mm' sends on the following day at that time, other
+  options as REDCap describes them
+- With 'reevaluate before sending' the logic is checked again at send time,
+  and the invite is dropped if it's now false
+- A patient answers each invite or reminder before the next reminder with
+  probability --response-rate, ANSWER_DELAY after it arrives, otherwise gets
+  the next reminder. Patients who are never reminded again never answer
+
+Then report SMS per minute (peak minutes, and per day), invites dropped, and
+patients who got no invite or more than one for an observation slot (day
+after admission and send time).
+
+Usage
+  ./simulate_invites.py Project.REDCap.xml --admissions 40 --days 30
+  ./simulate_invites.py Project.REDCap.xml --admissions-file per_day.txt --per-minute load.csv
+
+per_day.txt has the number of admissions on each day, one per line.
+"""
+
+from datetime import datetime
+import argparse
+import sys
+
+import numpy as np
+
+from calc_graph import form_calcs
+from project_cache import load_project_cached
+from simulate_alerts import field_default
+from vector_logic import compile_vector
+
+MINUTE = np.timedelta64(1, 'm')
+DAY = np.timedelta64(1, 'D')
+
+WEEKDAYS = ['MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY', 'SUNDAY']
+
+# Patients are admitted between these hours
+ADMISSION_HOURS = (8, 18)
+
+# Patient's registration answers. mon_period_days takes its @DEFAULT, or
+# --period-days
+PATIENT = {'mon_group': 1.0, 'patient_loc': 1.0}
+
+# How long after an invite or reminder a patient who answers it does
+ANSWER_DELAY = np.timedelta64(20, 'm')
+
+NOT_YET = np.datetime64('NaT')
+
+
+def time_of_day(text):
+    """'08:00:00' -> minutes after midnight"""
+    parts = [int(part) for part in text.split(':')]
+    return np.timedelta64(parts[0] * 60 + (parts[1] if len(parts) > 1 else 0), 'm')
+
+
+def lag(invite, prefix):
+    """condition_send_time_lag_* or reminder_timelag_* as a timedelta"""
+    total = 0
+    for unit, minutes in (('days', 1440), ('hours', 60), ('minutes', 1)):
+        value = invite.attrib.get(f'{prefix}_{unit}') or '0'
+        total += int(float(value) * minutes)
+    return np.timedelta64(total, 'm')
+
+
+def next_day(dates, day_type):
+    """The first day after each date that is a day_type (DAY, WEEKDAY,
+    WEEKENDDAY, MONDAY ...)"""
+    days = dates.astype('datetime64[D]') + DAY
+    # numpy's day 0 (1970-01-01) was a Thursday
+    weekday = (days.astype('int64') + 3) % 7
+    if day_type in ('', 'DAY'):
+        return days
+    if day_type == 'WEEKDAY':
+        return days + np.where(weekday == 5, 2, np.where(weekday == 6, 1, 0)) * DAY
+    if day_type == 'WEEKENDDAY':
+        return days + np.where(weekday < 5, 5 - weekday, 0) * DAY
+    target = WEEKDAYS.index(day_type)
+    return days + ((target - weekday) % 7) * DAY
+
+
+def send_times(invite, triggered):
+    """When an invite triggered at each time is sent"""
+    option = invite.attrib.get('condition_send_time_option')
+    if option == 'NEXT_OCCURRENCE':
+        return (next_day(triggered, invite.attrib.get('condition_send_next_day_type', ''))
+                + time_of_day(invite.attrib['condition_send_next_time']))
+    if option == 'TIME_LAG':
+        return triggered + lag(invite, 'condition_send_time_lag')
+    if option == 'EXACT_TIME':
+        exact = np.datetime64(invite.attrib['condition_send_time_exact'].replace(' ', 'T'), 'm')
+        return np.maximum(triggered, exact)
+    return triggered  # IMMEDIATELY
+
+
+def reminder_times(invite, sent, count):
+    """Time of reminder number count (1, 2, ...) for invites sent at sent"""
+    reminder_type = invite.attrib.get('reminder_type')
+    if reminder_type == 'TIME_LAG':
+        return sent + count * lag(invite, 'reminder_timelag')
+    if reminder_type == 'NEXT_OCCURRENCE':
+        when = sent
+        for _ in range(count):
+            when = (next_day(when, invite.attrib.get('reminder_nextday_type', ''))
+                    + time_of_day(invite.attrib['reminder_nexttime']))
+        return when
+    exact = np.datetime64(invite.attrib['reminder_exact_time'].replace(' ', 'T'), 'm')
+    return np.full(sent.shape, exact)
+
+
+class Patients:
+    """Made up patients, and their registration calc fields on any day"""
+
+    def __init__(self, proj, per_day, start, rng, period_days=None):
+        per_day = np.asarray(per_day, dtype=int)
+        day = np.repeat(np.arange(len(per_day)), per_day)
+        self.admitted_on = np.datetime64(start, 'D') + day * DAY
+        minutes = rng.integers(ADMISSION_HOURS[0] * 60, ADMISSION_HOURS[1] * 60, len(day))
+        self.admitted_at = self.admitted_on.astype('datetime64[m]') + minutes * MINUTE
+        self.period_days = period_days or field_default(proj, 'mon_period_days')
+        if self.period_days is None:
+            raise ValueError("mon_period_days has no @DEFAULT, give the days to monitor "
+                             "with --period-days")
+
+        self.calcs = [(name, compile_vector(calc))
+                      for name, calc in form_calcs(proj, 'registration')]
+        self.record = {
+            'mon_admission_date': self.admitted_on,
+            'mon_period_days': self.period_days,
+            **PATIENT,
+        }
+
+    def __len__(self):
+        return len(self.admitted_on)
+
+    def on(self, today):
+        """Every patient's fields as REDCap would have them on a day"""
+        columns = dict(self.record)
+        for name, evaluate in self.calcs:
+            columns[name] = evaluate(columns, today)
+        return columns
+
+
+def evaluate_on(condition, patients, days):
+    """condition for each patient on their own day"""
+    result = np.zeros(len(patients), dtype=bool)
+    for day in np.unique(days[~np.isnat(days)]):
+        mask = days == day
+        result[mask] = np.broadcast_to(condition(patients.on(day), day), mask.shape)[mask]
+    return result
+
+
+def simulate_invite(invite, patients, completed, first_day, last_day, check_time,
+                    response_rate, rng):
+    """Play one invite forward. completed is {survey_id: completion times} of
+    the surveys done so far.
+
+    Returns (send times, [reminder times], number dropped at send, when the
+    patients complete this survey)"""
+    logic = invite.attrib.get('condition_logic', '').strip()
+    condition = compile_vector(logic) if logic else None
+    andor = invite.attrib.get('condition_andor', 'AND')
+    after = invite.attrib.get('condition_surveycomplete_survey_id', '')
+    after_done = completed[after] if after else None
+
+    none = np.full(len(patients), NOT_YET, dtype='datetime64[m]')
+    triggered = none.copy()
+    day = first_day
+    while day <= last_day:
+        waiting = np.isnat(triggered) & (patients.admitted_on <= day)
+        if waiting.any():
+            if condition is None:
+                logic_true = np.ones(len(patients), dtype=bool)
+            else:
+                logic_true = np.broadcast_to(condition(patients.on(day), day), waiting.shape)
+
+            # Times it's checked today: saving the record at admission or
+            # when a survey is completed, and the daily check
+            midnight = day.astype('datetime64[m]')
+            checks = [np.where(patients.admitted_on == day, patients.admitted_at, none),
+                      np.where(patients.admitted_on < day, midnight + check_time, none)]
+            if after_done is not None:
+                checks.append(np.where(after_done.astype('datetime64[D]') == day,
+                                       after_done, none))
+
+            for checked_at in checks:
+                if after_done is None:
+                    true = logic_true
+                else:
+                    done = ~np.isnat(after_done) & (after_done <= checked_at)
+                    if condition is None:
+                        true = done
+                    else:
+                        true = (logic_true & done) if andor == 'AND' else (logic_true | done)
+                fire = waiting & true & ~np.isnat(checked_at)
+                earlier = fire & (np.isnat(triggered) | (checked_at < triggered))
+                triggered[earlier] = checked_at[earlier]
+        day += DAY
+
+    sent = send_times(invite, triggered)
+    if condition is not None and invite.attrib.get('reeval_before_send') == '1':
+        still = evaluate_on(condition, patients, sent.astype('datetime64[D]'))
+        dropped = int((~np.isnat(sent) & ~still).sum())
+        sent = np.where(still, sent, np.datetime64('NaT'))
+    else:
+        dropped = 0
+
+    # Messages each patient gets before answering (0 = answers the invite)
+    number = int(invite.attrib.get('reminder_num') or 0)
+    if not invite.attrib.get('reminder_type'):
+        number = 0
+    answers_after = rng.geometric(response_rate, len(patients)) - 1
+    reminded = np.minimum(answers_after, number)
+
+    reminders = []
+    last_message = sent.copy()
+    for count in range(1, number + 1):
+        at = reminder_times(invite, sent, count)
+        mask = ~np.isnat(sent) & (reminded >= count)
+        reminders.append(at[mask])
+        last_message[mask] = at[mask]
+
+    answered = ~np.isnat(sent) & (answers_after <= number)
+    completion = np.where(answered, last_message + ANSWER_DELAY, none)
+    return sent, reminders, dropped, completion
+
+
+def simulate(proj, per_day, start, check_time='00:00', response_rate=0.8, seed=0,
+             period_days=None):
+    """Run every active invite for patients admitted per_day[i] on day i,
+    monitored for period_days (default mon_period_days' @DEFAULT).
+
+    Returns a dict of
+        patients    Patients
+        invites     [(invite, send times, [reminder times], dropped), ...]
+        start, end  first and last minute of the simulation"""
+    rng = np.random.default_rng(seed)
+    patients = Patients(proj, per_day, start, rng, period_days)
+    first_day = np.datetime64(start, 'D')
+    last_day = first_day + (len(per_day) + int(patients.period_days) + 2) * DAY
+
+    none = np.full(len(patients), NOT_YET, dtype='datetime64[m]')
+    completed = {'ob_0': patients.admitted_at}
+
+    # Invites that wait for another survey run after that survey's invite
+    pending = [invite for invite in proj.invites.values()
+               if invite.attrib.get('active') == '1']
+    invites = []
+    while pending:
+        ready = [invite for invite in pending
+                 if invite.attrib.get('condition_surveycomplete_survey_id', '') in ('', *completed)]
+        if not ready:
+            # Waiting on surveys nobody is invited to, they're never completed
+            for invite in pending:
+                completed.setdefault(invite.attrib['condition_surveycomplete_survey_id'], none)
+            continue
+        for invite in ready:
+            pending.remove(invite)
+            sent, reminders, dropped, completion = simulate_invite(
+                invite, patients, completed, first_day, last_day,
+                time_of_day(check_time), response_rate, rng)
+            completed[invite.attrib['survey_id']] = completion
+            invites.append((invite, sent, reminders, dropped))
+
+    return {
+        'patients': patients,
+        'invites': invites,
+        'start': first_day.astype('datetime64[m]'),
+        'end': (last_day + 2 * DAY).astype('datetime64[m]'),
+    }
+
+
+def is_sms(invite):
+    return invite.attrib.get('delivery_type', '').startswith('SMS')
+
+
+def per_minute(result):
+    """(invites, reminders) SMS counts for every minute of the simulation"""
+    start, end = result['start'], result['end']
+    minutes = int((end - start) / MINUTE)
+    invites = np.zeros(minutes, dtype=np.int64)
+    reminders = np.zeros(minutes, dtype=np.int64)
+    for invite, sent, sent_reminders, _dropped in result['invites']:
+        if not is_sms(invite):
+            continue
+        for counts, times in [(invites, sent)] + [(reminders, t) for t in sent_reminders]:
+            times = times[~np.isnat(times)]
+            index = ((times - start) / MINUTE).astype(np.int64)
+            index = index[(index >= 0) & (index < minutes)]
+            counts += np.bincount(index, minlength=minutes)
+    return invites, reminders
+
+
+def slot_problems(result):
+    """Patients with no invite, or more than one, for each observation slot.
+
+    A slot is (days after admission, send time). Expected slots are every
+    send time on days 1 to mon_period_days. Returns
+    [(days after admission, send time, patients with none, with 2+, patients)]"""
+    patients = result['patients']
+    end_day = result['end'].astype('datetime64[D]') - 2 * DAY
+
+    slots = {}
+    for invite, sent, _reminders, _dropped in result['invites']:
+        if invite.attrib.get('condition_send_time_option') != 'NEXT_OCCURRENCE':
+            continue
+        slot_time = invite.attrib['condition_send_next_time'][:5]
+        got = ~np.isnat(sent)
+        offset = ((sent.astype('datetime64[D]') - patients.admitted_on) / DAY)
+        for day_offset in range(1, int(patients.period_days) + 1):
+            counts = slots.setdefault((day_offset, slot_time),
+                                      np.zeros(len(patients), dtype=int))
+            counts += got & (offset == day_offset)
+
+    problems = []
+    for (day_offset, slot_time), counts in sorted(slots.items()):
+        # Only patients whose day this is inside the simulation
+        seen = patients.admitted_on + day_offset * DAY <= end_day
+        none = int(((counts == 0) & seen).sum())
+        many = int(((counts > 1) & seen).sum())
+        if none or many:
+            problems.append((day_offset, slot_time, none, many, int(seen.sum())))
+    return problems
+
+
+def print_report(result, out, top=5):
+    invites, reminders = per_minute(result)
+    total = invites + reminders
+    start = result['start']
+    patients = result['patients']
+
+    out.write(f"{len(patients)} patients, {len(result['invites'])} active invites\n")
+    out.write(f"{invites.sum()} SMS invites, {reminders.sum()} SMS reminders\n\n")
+
+    out.write("Busiest minutes\n")
+    for minute in np.argsort(total, kind='stable')[::-1][:top]:
+        if total[minute] == 0:
+            break
+        out.write(f"  {start + minute * MINUTE}  {total[minute]} SMS "
+                  f"({invites[minute]} invites, {reminders[minute]} reminders)\n")
+
+    out.write("\nSMS per day (peak minute)\n")
+    for day, day_total in enumerate(total.reshape(-1, 1440)):
+        if day_total.sum():
+            out.write(f"  {(start + day * DAY).astype('datetime64[D]')}  "
+                      f"{day_total.sum():7}  ({day_total.max()}/min)\n")
+
+    dropped = [(invite.attrib['survey_id'], n)
+               for invite, _sent, _reminders, n in result['invites'] if n]
+    if dropped:
+        out.write("\nDropped at send (logic false when re-checked)\n")
+        for survey_id, count in dropped:
+            out.write(f"  {survey_id}  {count}\n")
+
+    problems = slot_problems(result)
+    out.write("\nObservation slots\n" if problems else "\nEvery patient got one invite per slot\n")
+    for day_offset, slot_time, none, many, seen in problems:
+        out.write(f"  day {day_offset:2} {slot_time}  {none} of {seen} patients got none, "
+                  f"{many} got more than one\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Simulate SMS load from the project's automated survey invites")
+    parser.add_argument('projxmlfile', metavar='Project.REDCAP.xml')
+    parser.add_argument('--admissions', type=float, default=20, metavar='N',
+                        help="Average admissions a day (Poisson)")
+    parser.add_argument('--admissions-file', metavar='FILE',
+                        help="Admissions on each day, one number per line")
+    parser.add_argument('--days', type=int, default=28,
+                        help="Days of admissions to simulate")
+    parser.add_argument('--start', default=datetime.now().strftime('%Y-%m-%d'),
+                        help="First day YYYY-MM-DD")
+    parser.add_argument('--check-time', default='00:00',
+                        help="When REDCap's daily check of invite logic runs")
+    parser.add_argument('--response-rate', type=float, default=0.8,
+                        help="Chance a patient answers before each reminder")
+    parser.add_argument('--period-days', type=int, metavar='N',
+                        help="Days each patient is monitored "
+                             "(default mon_period_days' @DEFAULT)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--per-minute', metavar='FILE',
+                        help="Write SMS per minute as csv")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.admissions_file:
+        per_day = np.loadtxt(args.admissions_file, dtype=int, ndmin=1)
+    else:
+        per_day = rng.poisson(args.admissions, args.days)
+
+    if not 0 < args.response_rate <= 1:
+        sys.exit("--response-rate must be more than 0 and at most 1")
+
+    if args.period_days is not None and args.period_days < 1:
+        sys.exit("--period-days must be at least 1")
+
+    try:
+        result = simulate(load_project_cached(args.projxmlfile), per_day, args.start,
+                          args.check_time, args.response_rate, args.seed, args.period_days)
+    except ValueError as exc:
+        sys.exit(str(exc))
+    print_report(result, sys.stdout)
+
+    if args.per_minute:
+        invites, reminders = per_minute(result)
+        minutes = result['start'] + np.arange(len(invites)) * MINUTE
+        busy = (invites + reminders) > 0
+        with open(args.per_minute, 'w') as file:
+            file.write('minute,invites,reminders\n')
+            for minute, n_invites, n_reminders in zip(minutes[busy], invites[busy], reminders[busy]):
+                file.write(f'{minute},{n_invites},{n_reminders}\n')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Make synthetic project exports with more observation days and slots
+
+The project monitors patients for 14 days with two observations a day
+(ob_1a ... ob_14b). Before moving to 28-90 days, or more observations a day,
+we want to know how the audit tools cope. This takes a real export and
+writes a copy with DAYS x SLOTS observations instead:
+
+    ./synthetic_project.py Project.REDCap.xml 90x2 Synthetic_90x2.REDCap.xml
+
+Each new observation is a copy of a real one: its instrument, item groups,
+fields, choices, survey settings, automated invite and alerts, renamed as
+generate_obs_definitions.py does (hr_2a -> hr_37a, ob_2a -> ob_37a). Morning
+slots are copied from ob_2a, afternoon slots from ob_2b (slots after 'b' are
+copied from them in turn, 'c' like 'a'...). References to the same slot the
+day before are renamed to the new day before, so late obs alerts still hang
+off the preceding observation's form. New alerts get new numbers.
+
+ob_template and ob_0, and everything that isn't an observation's, are left
+as they are. Anything outside the observations that refers to one that's no
+longer there (registration calcs, reports, user rights) still does, so not
+every audit check passes on a synthetic project. It's for timing.
+
+Usage
+  ./synthetic_project.py Project.REDCap.xml DAYSxSLOTS OUT.REDCap.xml
+"""
+
+from copy import deepcopy
+from string import ascii_lowercase
+import re
+import sys
+
+from lxml import etree
+
+from project_model import ODM, REDCAP
+from template_families import OBCODE
+
+# Real observations the new ones are copied from, by slot, and the one
+# before each in its slot (see get_obs_preceding_obs() in audit_project.py)
+PROTOTYPES = ['ob_2a', 'ob_2b']
+PREVIOUS = {'ob_2a': 'ob_1a', 'ob_2b': 'ob_1b'}
+
+SIZE = re.compile(r'(\d+)x(\d+)\Z')
+
+# datediff([mon_admission_date], 'today', 'd') = 2
+ADMISSION_DAY = re.compile(r"(datediff\(\[mon_admission_date\], 'today', 'd'\) = )(\d+)")
+
+
+def parse_size(size):
+    """'90x2' -> (90, 2)"""
+    match = SIZE.match(size)
+    if match is None:
+        raise ValueError(f"Size should be DAYSxSLOTS eg 28x2, not {size!r}")
+    days, slots = int(match.group(1)), int(match.group(2))
+    if days < 1 or not 1 <= slots <= len(ascii_lowercase):
+        raise ValueError(f"Need at least 1 day and 1 to {len(ascii_lowercase)} slots, not {size}")
+    return days, slots
+
+
+def observation_codes(days, slots):
+    """['ob_1a', 'ob_1b', 'ob_2a', ...] in the order they're done"""
+    return [f'ob_{day}{ascii_lowercase[slot]}'
+            for day in range(1, days + 1) for slot in range(slots)]
+
+
+def observation_day(obcode):
+    """ob_37b -> 37"""
+    return int(OBCODE.fullmatch(obcode).group(1).rstrip(ascii_lowercase))
+
+
+def is_daily(obcode):
+    """ob_1a ... but not ob_template or ob_0, which are left alone"""
+    found = OBCODE.fullmatch(obcode or '')
+    return found is not None and found.group(1) not in ('template', '0')
+
+
+def observation_members(root):
+    """{obcode: [element, ...]} of everything belonging to each daily
+    observation, in file order within each kind"""
+    metadata = root.find(f'./{ODM}Study/{ODM}MetaDataVersion')
+    item_groups = {node.get('OID'): node for node in metadata.iter(ODM + 'ItemGroupDef')}
+    items = {node.get('OID'): node for node in metadata.iter(ODM + 'ItemDef')}
+    code_lists = {node.get('OID'): node for node in metadata.iter(ODM + 'CodeList')}
+
+    members = {}
+    for form in metadata.iter(ODM + 'FormDef'):
+        obcode = form.get(REDCAP + 'FormName')
+        if not is_daily(obcode):
+            continue
+        groups = [item_groups[ref.get('ItemGroupOID')] for ref in form]
+        fields = [items[ref.get('ItemOID')] for group in groups for ref in group]
+        choices = [code_lists[ref.get('CodeListOID')] for field in fields
+                   for ref in field.iter(ODM + 'CodeListRef')]
+        members[obcode] = [form] + groups + fields + choices
+
+    for alert in root.iter(REDCAP + 'Alerts'):
+        found = OBCODE.search(alert.get('alert_title', ''))
+        if found is not None and found.group(0) in members:
+            members[found.group(0)].append(alert)
+    for survey in root.iter(REDCAP + 'Surveys'):
+        if survey.get('form_name') in members:
+            members[survey.get('form_name')].append(survey)
+    for invite in root.iter(REDCAP + 'SurveysScheduler'):
+        if invite.get('survey_id') in members:
+            members[invite.get('survey_id')].append(invite)
+    return members
+
+
+def renamer(prototype, obcode, previous):
+    """A function renaming the prototype observation's codes in a string
+    to obcode's (hr_2a, Ob 2a), and its previous observation's to previous.
+    Days since admission in invite logic are moved on to obcode's day"""
+    names = {prototype[3:]: obcode[3:], PREVIOUS[prototype][3:]: previous[3:]}
+    pattern = re.compile(r'(?<=[_ ])(%s)(?![0-9a-z])' % '|'.join(map(re.escape, names)))
+    shift = observation_day(obcode) - observation_day(prototype)
+
+    def rename(text):
+        text = pattern.sub(lambda match: names[match.group(1)], text)
+        return ADMISSION_DAY.sub(lambda match: match.group(1) + str(int(match.group(2)) + shift),
+                                 text)
+
+    return rename
+
+
+def renamed_copy(element, rename):
+    """A deep copy of element with every attribute value and text renamed"""
+    copy = deepcopy(element)
+    for node in copy.iter():
+        for name, value in node.attrib.items():
+            node.set(name, rename(value))
+        if node.text:
+            node.text = rename(node.text)
+    return copy
+
+
+def generate(xmlfilepath, days, slots):
+    """The export's lxml tree with its daily observations replaced by
+    days x slots copies of the prototypes"""
+    tree = etree.parse(xmlfilepath, etree.XMLParser(huge_tree=True))
+    root = tree.getroot()
+    members = observation_members(root)
+    missing = [prototype for prototype in PROTOTYPES if prototype not in members]
+    if missing:
+        raise ValueError(f"{xmlfilepath} has no {', '.join(missing)} to copy")
+
+    old = [element for obcode in members for element in members[obcode]]
+    # New elements go where the first old one of their kind was
+    first = {}
+    for element in old:
+        key = (element.getparent(), element.tag)
+        if key not in first or element.getparent().index(element) < first[key][0]:
+            first[key] = (element.getparent().index(element), element)
+
+    alert_number = max(int(alert.get('alert_number', 0))
+                       for alert in root.iter(REDCAP + 'Alerts'))
+    # Each slot follows on from the same slot the day before, and day 1
+    # from ob_0
+    previous = ['ob_0'] * slots
+    for position, obcode in enumerate(observation_codes(days, slots)):
+        slot = position % slots
+        prototype = PROTOTYPES[slot % len(PROTOTYPES)]
+        rename = renamer(prototype, obcode, previous[slot])
+        for element in members[prototype]:
+            copy = renamed_copy(element, rename)
+            if copy.tag == REDCAP + 'Alerts':
+                alert_number += 1
+                copy.set('alert_number', str(alert_number))
+            first[element.getparent(), element.tag][1].addprevious(copy)
+        previous[slot] = obcode
+
+    for element in old:
+        element.getparent().remove(element)
+    return tree
+
+
+def write_synthetic(xmlfilepath, outpath, days, slots):
+    tree = generate(xmlfilepath, days, slots)
+    tree.write(outpath, xml_declaration=True, encoding='UTF-8')
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 4:
+        sys.exit("Usage:\n%s Project.REDCAP.xml DAYSxSLOTS OUT.REDCAP.xml" % sys.argv[0])
+
+    try:
+        write_synthetic(sys.argv[1], sys.argv[3], *parse_size(sys.argv[2]))
+    except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+        sys.exit(str(exc))
@@ -0,0 +1,163 @@
+"""
+Find everything copied from ob_template and compare the copies with it
+
+Every observation (ob_0, ob_1a ... ob_14b) has its own copy of the things
+made for ob_template: the instrument, its survey settings, its automated
+invite and alerts like 'Obs Combined Staff alert - ob_template'. Rather than
+a hand written check per kind of alert, we sweep the project once, put each
+alert, survey, invite and form in a family by its name with the observation
+code swapped for ob_template:
+
+    'Late obs staff - ob_3a' (SMS)  ->  family 'Late obs staff - ob_template' (SMS)
+
+Any family that has an ob_template member is a template family, and every
+other member is compared with the template. A copy matches if each attribute
+is the template's with _template swapped for its own code (hr_template ->
+hr_3a) and it doesn't still mention _template anywhere. So a new kind of
+alert made from ob_template is checked without any new code.
+
+Some attributes are meant to differ (alert numbers, the time a morning or
+afternoon alert goes out). Those are given per kind (IGNORE_ALWAYS) and per
+family, by the caller:
+
+    rules = {('alert', 'Late obs staff - ob_template', 'SMS'): {'ignore': ['form_name']}}
+    copy_differences(proj, 'ob_3a', rules)
+        -> {('alert', 'Late obs staff - ob_template', 'SMS'): ["alert_message: ..."]}
+
+A family's rules can instead list 'only' the attributes to compare.
+Instruments are compared item by item by form_compare.py.
+
+The sweep is done once per project (ProjectModel.memo()), comparing a copy
+is a pass over its attributes, so checking every observation is linear in
+the size of what was copied.
+"""
+
+import re
+
+from form_compare import compare_observations
+from project_model import REDCAP
+
+OBCODE = re.compile(r'\bob_(template|\d+[a-z]?)\b')
+
+TEMPLATE = 'template'
+
+# Attributes that differ on every copy of each kind
+IGNORE_ALWAYS = {
+    'alert': ['alert_number', 'email_timestamp_sent', 'email_sent'],
+    'survey': ['title', 'logo', 'check_diversity_view_results'],
+    'invite': [],
+}
+
+
+class Family:
+    """ob_template's version of something and the observations' copies"""
+
+    __slots__ = ('key', 'template', 'copies')
+
+    def __init__(self, key):
+        self.key = key              # eg ('alert', 'Late obs staff - ob_template', 'SMS')
+        self.template = None
+        self.copies = {}            # obcode -> Node
+
+    @property
+    def kind(self):
+        return self.key[0]
+
+
+def family_key(kind, name, *rest):
+    """(kind, name with its observation code as ob_template, ...) and the
+    observation code. None if the name has no observation code"""
+    found = OBCODE.search(name or '')
+    if found is None:
+        return None, None
+    key = (kind, OBCODE.sub('ob_' + TEMPLATE, name)) + rest
+    return key, 'ob_' + found.group(1)
+
+
+def sweep(proj):
+    """Every template family in the project, {key: Family}. One pass over
+    the alerts, surveys, invites and forms"""
+    candidates = []
+    for alert in proj.all_alerts():
+        candidates.append((family_key('alert', alert.attrib.get('alert_title'),
+                                      alert.attrib.get('alert_type')), alert))
+    for survey in proj.all_surveys():
+        candidates.append((family_key('survey', survey.attrib.get('form_name')), survey))
+    for invite in proj.all_invites():
+        candidates.append((family_key('invite', invite.attrib.get('survey_id')), invite))
+    for form in proj.all_forms():
+        candidates.append((family_key('form', form.attrib[REDCAP + 'FormName']), form))
+
+    families = {}
+    for (key, obcode), node in candidates:
+        if key is None:
+            continue
+        family = families.setdefault(key, Family(key))
+        if obcode == 'ob_' + TEMPLATE:
+            family.template = node
+        else:
+            # The first of any duplicates, like the model's lookups
+            family.copies.setdefault(obcode, node)
+    return {key: family for key, family in families.items() if family.template is not None}
+
+
+def as_template(value, obcode):
+    """A copy's value as the template would have it"""
+    return value.replace('_' + obcode[3:], '_' + TEMPLATE)
+
+
+def ignored(family, rules):
+    """Attributes a family's copies may have of their own"""
+    return set(IGNORE_ALWAYS[family.kind]) | set(rules.get('ignore', ()))
+
+
+def compared(family, rules):
+    """The template attributes every copy has to match"""
+    ignore = ignored(family, rules)
+    return rules.get('only') or [name for name in family.template.attrib if name not in ignore]
+
+
+def diff_copy(family, obcode, rules):
+    """How a copy differs from its template, as a list of readable strings"""
+    template, copy = family.template.attrib, family.copies[obcode].attrib
+    ignore = ignored(family, rules)
+    names = compared(family, rules)
+
+    diffs = []
+    for name in names:
+        if name not in copy:
+            diffs.append(f"{name}: missing")
+            continue
+        if as_template(copy[name], obcode) != template.get(name):
+            diffs.append(f"{name}: {copy[name]!r} isn't the template's {template.get(name)!r}")
+        elif '_' + TEMPLATE in copy[name]:
+            diffs.append(f"{name}: still refers to _{TEMPLATE} {copy[name]!r}")
+    for name in copy:
+        if name not in template and name not in ignore and not rules.get('only'):
+            diffs.append(f"{name}: not in the template")
+    return diffs
+
+
+def template_families(proj):
+    """{key: Family}, worked out once per project"""
+    return proj.memo(sweep)
+
+
+def copy_differences(proj, obcode, rules=None, keys=None):
+    """{family key: [difference, ...]} for each of the observation's copies
+    that doesn't match its template. rules is {family key: {'ignore': [...]}
+    or {'only': [...]}}. Only the families in keys, if given"""
+    rules = rules or {}
+    found = {}
+    for key, family in template_families(proj).items():
+        if keys is not None and key not in keys:
+            continue
+        if obcode not in family.copies:
+            continue
+        if family.kind == 'form':
+            diffs = compare_observations(proj, tuple(family.copies))[obcode]
+        else:
+            diffs = diff_copy(family, obcode, rules.get(key, {}))
+        if diffs:
+            found[key] = diffs
+    return found
@@ -0,0 +1,175 @@
+"""
+Evaluate REDCap logic over whole numpy arrays at once
+
+redcap_logic.compile_logic() evaluates an expression for one record. For
+simulations we want the same expression over millions of records, so this
+builds closures from the same syntax tree that work on columns instead:
+
+    evaluate = compile_vector("if([temp_3a] > [fw_high_temp], 1, 0)")
+    evaluate({'temp_3a': np.array([37.0, 38.7]), 'fw_high_temp': 38.5})
+        -> array([0., 1.])
+
+Columns are float arrays with NaN for blank, datetime64 arrays (NaT for
+blank) for dates, or plain numbers that apply to every row. A missing column
+is blank for every row. Blank follows REDCap's rules as in redcap_logic.py:
+blank only equals blank, is false in < > comparisons and in and/or, and
+arithmetic on it is blank.
+
+Only numeric logic is supported. Text values can't be compared here, only
+text literals that look like numbers ('1') and datediff() units and 'today'.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from redcap_logic import (Arith, BoolOp, Compare, Field, Literal, LogicError,
+                          Negate, as_number, parse, DATEDIFF_UNITS)
+
+
+def truthy(values):
+    values = np.asarray(values, dtype=float)
+    return (values != 0) & ~np.isnan(values)
+
+
+def vector_compare(op, left, right):
+    left = np.asarray(left, dtype=float)
+    right = np.asarray(right, dtype=float)
+    with np.errstate(invalid='ignore'):
+        if op == '=':
+            return (left == right) | (np.isnan(left) & np.isnan(right))
+        if op == '!=':
+            return ~((left == right) | (np.isnan(left) & np.isnan(right)))
+        if op == '<':
+            return left < right
+        if op == '>':
+            return left > right
+        if op == '<=':
+            return left <= right
+        return left >= right
+
+
+def vector_arith(op, left, right):
+    left = np.asarray(left, dtype=float)
+    right = np.asarray(right, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if op == '+':
+            return left + right
+        if op == '-':
+            return left - right
+        if op == '*':
+            return left * right
+        if op == '/':
+            return np.where(right == 0, np.nan, left / right)
+        return left ** right
+
+
+def as_dates(value, now):
+    """datetime64 array from a column, or 'today'/'now'"""
+    if isinstance(value, str):
+        if value == 'today':
+            return np.datetime64(now, 'D').astype('datetime64[s]')
+        if value == 'now':
+            return np.datetime64(now, 's')
+        return np.datetime64(value, 's')
+    values = np.asarray(value)
+    if values.dtype.kind != 'M':
+        # Blank (NaN) rather than dates
+        return np.full(values.shape, np.datetime64('NaT'), dtype='datetime64[s]')
+    return values.astype('datetime64[s]')
+
+
+def vector_datediff(now, date1, date2, units='d', fmt=None, signed=0):
+    if units not in DATEDIFF_UNITS:
+        raise LogicError(f"Unknown datediff units {units!r}")
+    first = as_dates(date1, now)
+    second = as_dates(date2, now)
+    seconds = (second - first) / np.timedelta64(1, 's')
+    diff = np.where(np.isnat(first) | np.isnat(second), np.nan, seconds) / DATEDIFF_UNITS[units]
+    if not truthy(signed).all():
+        diff = np.abs(diff)
+    return np.round(diff, 10)
+
+
+def constant(value):
+    """A literal as a column value"""
+    if value == '':
+        return np.nan
+    number = as_number(value)
+    if number is not None:
+        return float(number)
+    # Only meaningful as a datediff() argument
+    return value
+
+
+def build(expr):
+    """Closure evaluating expr against (columns, now)"""
+    if isinstance(expr, Literal):
+        value = constant(expr.value)
+        return lambda columns, now: value
+
+    if isinstance(expr, Field):
+        column = expr.column
+        return lambda columns, now: columns.get(column, np.nan)
+
+    if isinstance(expr, Compare):
+        op = expr.op
+        left, right = build(expr.left), build(expr.right)
+        return lambda columns, now: vector_compare(op, left(columns, now), right(columns, now))
+
+    if isinstance(expr, BoolOp):
+        operands = [build(operand) for operand in expr.operands]
+        combine = np.logical_and if expr.op == 'and' else np.logical_or
+
+        def boolean(columns, now):
+            result = truthy(operands[0](columns, now))
+            for operand in operands[1:]:
+                result = combine(result, truthy(operand(columns, now)))
+            return result
+
+        return boolean
+
+    if isinstance(expr, Arith):
+        op = expr.op
+        left, right = build(expr.left), build(expr.right)
+        return lambda columns, now: vector_arith(op, left(columns, now), right(columns, now))
+
+    if isinstance(expr, Negate):
+        operand = build(expr.operand)
+        return lambda columns, now: -np.asarray(operand(columns, now), dtype=float)
+
+    if expr.name == 'if':
+        if len(expr.args) != 3:
+            raise LogicError(f"if() takes 3 arguments, not {len(expr.args)}")
+        test, then, otherwise = (build(arg) for arg in expr.args)
+        return lambda columns, now: np.where(truthy(test(columns, now)),
+                                             then(columns, now), otherwise(columns, now))
+
+    args = [build(arg) for arg in expr.args]
+    if expr.name == 'datediff':
+        return lambda columns, now: vector_datediff(now, *(f(columns, now) for f in args))
+
+    if expr.name == 'round' and len(args) in (1, 2):
+        def rounded(columns, now):
+            places = int(args[1](columns, now)) if len(args) == 2 else 0
+            return np.round(np.asarray(args[0](columns, now), dtype=float), places)
+        return rounded
+
+    if expr.name == 'abs' and len(args) == 1:
+        return lambda columns, now: np.abs(np.asarray(args[0](columns, now), dtype=float))
+
+    raise LogicError(f"{expr.name}() can't be evaluated over arrays")
+
+
+@lru_cache(maxsize=1024)
+def compile_vector(text):
+    """A function evaluate(columns, now=None) for a REDCap logic expression.
+    columns is {field name: array or number}. now is the datetime 'today' and
+    'now' mean, the current time if not given. Returns an array"""
+    evaluate = build(parse(text))
+
+    def run(columns, now=None):
+        return evaluate(columns, now if now is not None else np.datetime64('now'))
+
+    run.__doc__ = text
+    return run
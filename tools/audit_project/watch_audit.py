@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Keep auditing a directory of project exports as they change
+
+While editing ob_template we re-export and re-audit over and over, and each
+./audit_project.py run starts Python, imports lxml and loads the project
+again. This stays running instead. It watches a directory (the one the
+browser downloads exports into) and when an export appears or changes it
+- waits for the file to stop growing (downloads are written in pieces)
+- skips it if its contents are the same as last time (touched, copied)
+- loads it through the snapshot cache (project_cache.py)
+- re-runs only the rules that look at something that changed
+  (incremental.py), re-using the verdicts of the rest
+- prints what changed since that file's previous audit:
+
+    COVIDHomeMonitoring_2020-05-21_0910.REDCap.xml: 357 checks, 65 run in 0.412s
+      PASSED -> FAILED  test_observation_alerts_match_template[ob_3a] - ...
+      FAILED -> PASSED  test_calc_fields_come_after_the_fields_they_use
+
+A new file is compared with the newest export audited before it, so a fresh
+download shows what the edit did.
+
+Watching is done by polling the directory's file sizes and modification
+times, which works everywhere without extra packages. Exports are only a few
+MB and a poll is a stat() per file.
+
+With --socket the watcher also answers audit requests on a Unix socket, for
+editors and scripts. The request is one line naming an xml file, the answer
+one line of JSON with 'summary', 'run', 'reused', 'delta' and 'results'
+(the same results as audit_project.py --json). Unchanged files are answered
+from memory. A client is built in:
+
+    ./watch_audit.py --socket /tmp/audit.sock --ask Project.REDCap.xml
+
+Usage
+  ./watch_audit.py DIR [--interval SECONDS] [--socket PATH] [--jobs N]
+  ./audit_project.py --watch DIR
+"""
+
+from pathlib import Path
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from incremental import run_incremental
+from project_cache import file_sha256, load_project_cached
+from rule_runner import ERROR, FAILED, print_report, summarise
+
+DEFAULT_INTERVAL = 1.0
+
+
+class Audit:
+    """The last audit of one file"""
+
+    __slots__ = ('sha256', 'results', 'reused', 'baseline', 'delta', 'took')
+
+    def __init__(self, sha256, results, reused, baseline, delta, took):
+        self.sha256 = sha256
+        self.results = results
+        self.reused = reused
+        self.baseline = baseline    # the file compared with, if any
+        self.delta = delta
+        self.took = took
+
+    def as_json(self, path):
+        return {
+            'projxmlfile': str(path),
+            'summary': summarise(self.results),
+            'run': len(self.results) - self.reused,
+            'reused': self.reused,
+            'took': self.took,
+            'baseline': self.baseline and str(self.baseline),
+            'delta': self.delta,
+            'results': self.results,
+        }
+
+
+def result_delta(previous, results):
+    """Checks whose outcome differs from the previous audit's, as
+    [{'id':, 'was':, 'now':, 'message':}, ...]. A check that's new or gone has
+    None for was/now"""
+    if previous is None:
+        return [{'id': result['id'], 'was': None, 'now': result['outcome'],
+                 'message': result['message']}
+                for result in results if result['outcome'] in (FAILED, ERROR)]
+
+    before = {result['id']: result for result in previous}
+    now = {result['id']: result for result in results}
+    delta = []
+    for result in results:
+        old = before.get(result['id'])
+        if old is None or old['outcome'] != result['outcome'] \
+                or old['message'] != result['message']:
+            delta.append({'id': result['id'],
+                          'was': old['outcome'] if old else None,
+                          'now': result['outcome'],
+                          'message': result['message']})
+    for result in previous:
+        if result['id'] not in now:
+            delta.append({'id': result['id'], 'was': result['outcome'],
+                          'now': None, 'message': ''})
+    return delta
+
+
+def print_delta(path, audit, out):
+    compared = '' if audit.baseline in (None, path) else f", against {audit.baseline.name}"
+    out.write(f"{path.name}: {len(audit.results)} checks, "
+              f"{len(audit.results) - audit.reused} run in {audit.took:.3f}s{compared}\n")
+    for change in audit.delta:
+        message = f" - {change['message']}" if change['message'] else ''
+        out.write(f"  {change['was'] or 'new'} -> {change['now'] or 'gone'}  "
+                  f"{change['id']}{message}\n")
+    if not audit.delta:
+        out.write("  no change\n" if audit.baseline else "  all passed\n")
+    out.flush()
+
+
+class Watcher:
+    """Audits the xml files in a directory when they change"""
+
+    def __init__(self, module, directory, jobs=1, out=sys.stdout):
+        self.module = module
+        self.directory = Path(directory)
+        self.jobs = jobs
+        self.out = out
+        self.stats = {}         # path -> (size, mtime) when last looked at
+        self.pending = set()    # paths changed since they were last audited
+        self.audits = {}        # path -> Audit
+        self.latest = None      # path of the newest file audited
+        # The audit and the socket server share the cache and history files
+        self.lock = threading.Lock()
+
+    def audit(self, path):
+        """Audit path if it's changed since its last audit. Returns its Audit"""
+        path = Path(path).resolve()
+        with self.lock:
+            sha256 = file_sha256(path)
+            last = self.audits.get(path)
+            if last is not None and last.sha256 == sha256:
+                return last
+
+            start = time.perf_counter()
+            proj = load_project_cached(str(path))
+            results, reused = run_incremental(self.module, str(path), self.jobs, proj)
+            took = time.perf_counter() - start
+
+            baseline = path if last is not None else self.latest
+            previous = self.audits[baseline].results if baseline else None
+            audit = Audit(sha256, results, reused, baseline,
+                          result_delta(previous, results), took)
+            self.audits[path] = audit
+            self.latest = path
+            return audit
+
+    def settled(self):
+        """Files that have changed since the last poll and then stayed the
+        same for a whole poll"""
+        found = []
+        for path in self.directory.glob('*.xml'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue    # Deleted or renamed since the glob
+            found.append((stat.st_mtime_ns, stat.st_size, path.resolve()))
+
+        # Oldest first, so each is compared with the export before it
+        ready = []
+        for mtime, size, path in sorted(found):
+            now = (size, mtime)
+            if self.stats.get(path) != now:
+                self.stats[path] = now
+                self.pending.add(path)
+            elif path in self.pending:
+                self.pending.discard(path)
+                ready.append(path)
+        return ready
+
+    def poll(self):
+        """Audit whatever is ready and print the changes"""
+        for path in self.settled():
+            last = self.audits.get(path)
+            try:
+                audit = self.audit(path)
+            except Exception as exc:
+                # Not a project file, or broken. Try again when it changes
+                self.out.write(f"{path.name}: can't audit, {type(exc).__name__} {exc}\n")
+                continue
+            if audit is not last:   # else only touched
+                print_delta(path, audit, self.out)
+
+    def run(self, interval=DEFAULT_INTERVAL):
+        self.out.write(f"Watching {self.directory} for project exports\n")
+        self.out.flush()
+        while True:
+            self.poll()
+            time.sleep(interval)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One line with an xml file path in, one line of JSON out"""
+
+    def handle(self):
+        line = self.rfile.readline().decode().strip()
+        watcher = self.server.watcher
+        path = Path(line) if os.path.isabs(line) else watcher.directory / line
+        try:
+            answer = watcher.audit(path).as_json(path.resolve())
+        except Exception as exc:
+            answer = {'error': f"{type(exc).__name__}: {exc}"}
+        self.wfile.write(json.dumps(answer).encode() + b'\n')
+
+
+def serve(watcher, socket_path):
+    """Answer audit requests on a Unix socket in a background thread"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)      # Left behind by a watcher that was killed
+    server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    server.watcher = watcher
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def ask(socket_path, xmlfilepath):
+    """Have a running watcher audit a file. Returns its JSON answer"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(os.path.abspath(xmlfilepath).encode() + b'\n')
+        with conn.makefile('rb') as answer:
+            return json.loads(answer.readline())
+
+
+def watch(directory, interval=DEFAULT_INTERVAL, socket_path=None, jobs=1):
+    """Run the watcher on audit_project's rules until interrupted"""
+    # Imported as a module, as audit_project.py's main does, so the rules
+    # register under 'audit_project'
+    import audit_project
+
+    watcher = Watcher(audit_project, directory, jobs)
+    server = serve(watcher, socket_path) if socket_path else None
+    # Tidy up the socket when killed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        watcher.run(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            os.unlink(socket_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Audit project exports in a directory as they change")
+    parser.add_argument('directory', nargs='?', metavar='DIR')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        metavar='SECONDS', help="How often to look for changes")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="Also answer audit requests on this Unix socket")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help="Run the checks in N processes")
+    parser.add_argument('--ask', metavar='Project.REDCAP.xml',
+                        help="Ask the watcher on --socket to audit this file")
+    args = parser.parse_args()
+
+    if args.ask:
+        if not args.socket:
+            parser.error("--ask needs the --socket the watcher is on")
+        answer = ask(args.socket, args.ask)
+        if 'error' in answer:
+            sys.exit(answer['error'])
+        sys.exit(0 if print_report(answer['results'], sys.stdout) else 1)
+
+    if args.directory is None or not os.path.isdir(args.directory):
+        parser.error("give the directory to watch")
+    watch(args.directory, args.interval, args.socket, args.jobs)
@@ -0,0 +1,153 @@
+"""
+Send many alert updates to REDCap at once, politely
+
+Saving an alert is one POST and a round trip to the server. Sent one after
+the other a full re-sync is mostly waiting. This sends them from a small
+pool of threads sharing one requests.Session, whose connection pool keeps a
+keep-alive connection per thread, with
+- a cap on requests per second across all threads, so we don't hammer the
+  REDCap server everyone else is using
+- retries with exponential backoff when a request fails in a way that may
+  go away (connection dropped, timeout, 429, 5xx)
+- no retries, and nothing more sent, once REDCap has logged us out
+
+    sess = pooled_session(phpsessionid, workers=4)
+    results = write_alerts(lambda payload: save(sess, payload), writes,
+                           workers=4, rate=2)
+    print_results(results)
+
+writes is a list of Write: a name for the report, the alert id and the
+payload handed to send. send returns the requests Response.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0      # requests per second
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0   # seconds before the first retry, doubled each time
+
+# Responses worth trying again
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class Write:
+    """One alert to save"""
+
+    __slots__ = ('name', 'alert_id', 'payload')
+
+    def __init__(self, name, alert_id, payload):
+        self.name = name            # eg 'STAFF_ALERT_COMBINED_SMS ob_3a'
+        self.alert_id = alert_id
+        self.payload = payload
+
+
+class WriteResult:
+    """How saving one alert went"""
+
+    __slots__ = ('write', 'ok', 'status', 'attempts', 'error')
+
+    def __init__(self, write, ok, status=None, attempts=0, error=None):
+        self.write = write
+        self.ok = ok
+        self.status = status        # last http status, None if no response
+        self.attempts = attempts    # 0 if never sent
+        self.error = error
+
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1/rate seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def pooled_session(phpsessionid, workers=DEFAULT_WORKERS):
+    """An authenticated session with a keep-alive connection for each worker"""
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    sess.mount('https://', adapter)
+    sess.mount('http://', adapter)
+    sess.headers.update({'cookie': f'PHPSESSID={phpsessionid}'})
+    return sess
+
+
+def is_transient(response=None, error=None):
+    """Might trying again work"""
+    if error is not None:
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return response.status_code in RETRY_STATUS
+
+
+def write_one(send, write, limiter, stop, logged_out, retries, backoff):
+    """Send one write, retrying transient failures"""
+    status = None
+    error = None
+    for attempt in range(1, retries + 2):
+        if stop.is_set():
+            return WriteResult(write, False, status, attempt - 1, error or "not sent, logged out")
+        limiter.wait()
+        try:
+            response = send(write.payload)
+        except requests.RequestException as exc:
+            response, status, error = None, None, f"{type(exc).__name__}: {exc}"
+            if not is_transient(error=exc):
+                return WriteResult(write, False, None, attempt, error)
+        else:
+            status = response.status_code
+            if logged_out(response):
+                stop.set()
+                return WriteResult(write, False, status, attempt, "logged out of REDCap")
+            if response.ok:
+                return WriteResult(write, True, status, attempt)
+            error = f"HTTP {status}"
+            if not is_transient(response):
+                return WriteResult(write, False, status, attempt, error)
+        if attempt <= retries:
+            # Full jitter so the workers don't all come back at once
+            time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+    return WriteResult(write, False, status, retries + 1, error)
+
+
+def write_alerts(send, writes, logged_out, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """Send every write, at most workers at a time and rate a second.
+    logged_out(response) says if REDCap has logged us out, after which
+    nothing more is sent. Returns a WriteResult per write, in order"""
+    limiter = RateLimiter(rate)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(write_one, send, write, limiter, stop, logged_out,
+                               retries, backoff)
+                   for write in writes]
+        return [future.result() for future in futures]
+
+
+def print_results(results, out):
+    """A line per alert and the totals. Returns True if every write worked"""
+    for result in results:
+        if result.ok:
+            retried = f" after {result.attempts} attempts" if result.attempts > 1 else ''
+            out.write(f"ok      {result.write.name} alert {result.write.alert_id}{retried}\n")
+        else:
+            out.write(f"FAILED  {result.write.name} alert {result.write.alert_id}: "
+                      f"{result.error}\n")
+    failed = sum(1 for result in results if not result.ok)
+    out.write(f"\n{len(results) - failed} alerts saved, {failed} failed\n")
+    return failed == 0
@@ -0,0 +1,121 @@
+"""
+Read the alerts out of REDCap's Alerts & Notifications page
+
+The page has no machine readable list of alerts, but each alert's edit
+button calls some javascript with all its settings as JSON:
+
+   <script type="text/javascript">function __rcfunc_editEmailAlert_emailRow10(){ editEmailAlert({"alert-id":"200","alert-title":"...},200,11) }</script>
+
+We scan the page once, decode every one of those and index them:
+
+    page = alerts_page(sess, page_url(URL, projectid))
+    page.alerts                 every alert's settings, in page order
+    page.by_id['200']
+    page.by_key['Obs Combined Staff alert - ob_3a', 'ob_3a', 'SMS']
+    page.titled('obs combined staff alert - OB_3A', 'SMS')
+
+The page is a few hundred KB. alerts_page() keeps the parsed page for each
+requests.Session for CACHE_SECONDS, so the tools download it once however
+many alerts they look up. After saving alerts call invalidate() so the next
+look is at what REDCap has now.
+"""
+
+from urllib.parse import urlencode
+import json
+import time
+import weakref
+
+EDIT_CALL = 'editEmailAlert('
+
+CACHE_SECONDS = 30
+
+# requests.Session -> {page url: (when downloaded, AlertsPage)}
+_cache = weakref.WeakKeyDictionary()
+
+
+class LoggedOut(Exception):
+    """REDCap sent us to the login page"""
+
+
+class AlertsPage:
+    """Every alert on the page, indexed"""
+
+    __slots__ = ('alerts', 'by_id', 'by_key', 'by_title')
+
+    def __init__(self, alerts_page_html):
+        self.alerts = parse_alerts(alerts_page_html)
+        self.by_id = {}
+        self.by_key = {}
+        self.by_title = {}
+        for data in self.alerts:
+            # The first of any duplicates, as REDCap lists them
+            self.by_id.setdefault(data.get('alert-id'), data)
+            self.by_key.setdefault(
+                (data.get('alert-title'), data.get('form-name'), data.get('alert-type')), data)
+            self.by_title.setdefault(
+                (data.get('alert-title', '').casefold(), data.get('alert-type')), []).append(data)
+
+    def titled(self, title, alert_type):
+        """Alerts of the type with the title, ignoring case"""
+        return self.by_title.get((title.casefold(), alert_type), [])
+
+
+def parse_alerts(alerts_page_html):
+    """The settings of every editEmailAlert({...}) call on the page, in page
+    order. One pass, each call's JSON decoded where it starts"""
+    decoder = json.JSONDecoder()
+    alerts = []
+    pos = alerts_page_html.find(EDIT_CALL)
+    while pos >= 0:
+        start = pos + len(EDIT_CALL)
+        if alerts_page_html.startswith('{', start):
+            try:
+                data, start = decoder.raw_decode(alerts_page_html, start)
+            except ValueError:
+                pass    # Not one of the edit buttons, eg the function itself
+            else:
+                alerts.append(data)
+        pos = alerts_page_html.find(EDIT_CALL, start)
+    return alerts
+
+
+def page_url(url, projectid):
+    """The Alerts & Notifications page of a project"""
+    return url + '?' + urlencode({'pid': projectid, 'route': 'AlertsController:setup'})
+
+
+def is_redcap_logged_out(response):
+    """Redcap does not give a http response code on logout. You just get back
+    Detect if we've been bumped to a login page"""
+
+    # Quick and dirty. Look for the forgot password link
+    return response.status_code == 302 or 'Authentication/password_recovery.php' in response.text
+
+
+def download_alerts_page(sess, alerts_page_url):
+    res = sess.get(alerts_page_url, allow_redirects=False)
+    if is_redcap_logged_out(res):
+        raise LoggedOut(alerts_page_url)
+    res.raise_for_status()
+    return AlertsPage(res.text)
+
+
+def alerts_page(sess, alerts_page_url, max_age=CACHE_SECONDS):
+    """The parsed page, downloaded with sess unless it was less than max_age
+    seconds ago"""
+    pages = _cache.setdefault(sess, {})
+    cached = pages.get(alerts_page_url)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    page = download_alerts_page(sess, alerts_page_url)
+    pages[alerts_page_url] = (time.monotonic(), page)
+    return page
+
+
+def invalidate(sess, alerts_page_url=None):
+    """Forget the session's page (or all its pages), eg after saving alerts"""
+    pages = _cache.get(sess, {})
+    if alerts_page_url is None:
+        pages.clear()
+    else:
+        pages.pop(alerts_page_url, None)
@@ -31,13 +31,12 @@ It works by issuing a GET request for the Alerts & Notifications page in
 REDCap, and parsing the html for the alerts and metadata.
 """
 
-from urllib.parse import parse_qs
-import json
-import re
 import sys
 
 import requests
 
+from alerts_page import LoggedOut, alerts_page, page_url
+
 URL = "https://redcap.yourcompay.com/redcap_v9.8.0/index.php"
 
 
@@ -45,27 +44,14 @@ def list_alerts(url, phpsessionid, projectid):
     """Load the REDCap Alerts & Notifications tab, parse out the list of alerts
     and their metadata and print it to stdout"""
 
-    qwargs_template = "pid=nnn&route=AlertsController:setup"
-
-    qwargs_data = parse_qs(qwargs_template)
-    qwargs_data['pid'] = projectid
-
-    headers = {
-        'cookie': 'PHPSESSID=%s' % phpessionid,
-    }
-
-    res = requests.get(url, headers=headers, params=qwargs_data)
-    # print(res)
+    sess = requests.Session()
+    sess.headers.update({'cookie': 'PHPSESSID=%s' % phpsessionid})
 
     # Easiest place to find the title/id/index is in the javascript that
-    # triggers the edit box for each alert
-    # look for  function __rcfunc_editEmailAlert_emailRow....
-    reg = r'__rcfunc_editEmailAlert_emailRow.*editEmailAlert\(({.*}),'
-
-    matches = re.findall(reg, res.text)
+    # triggers the edit box for each alert, see alerts_page.py
+    page = alerts_page(sess, page_url(url, projectid))
 
-    for match in matches:
-        alert_data = json.loads(match)
+    for alert_data in page.alerts:
         print(
             alert_data['alert-id'],
             alert_data['alert-number'],
@@ -82,4 +68,7 @@ if __name__ == '__main__':
     projectid = sys.argv[1]
     phpessionid = sys.argv[2]
 
-    list_alerts(url=URL, phpsessionid=phpessionid, projectid=projectid)
+    try:
+        list_alerts(url=URL, phpsessionid=phpessionid, projectid=projectid)
+    except LoggedOut:
+        sys.exit("Logged out of REDCap")
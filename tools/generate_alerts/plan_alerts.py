@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+"""
+Work out every observation alert's settings from a project export, then
+push just those to REDCap
+
+update_alert.py needs the template's and each target's alert ids typed in.
+Instead, plan reads the project xml export (no session, no network), finds
+each ob_template alert and every observation's copy of it by title, works
+out what the copy should be (the same transformation as update_alert.py)
+and writes the copies that differ to a plan file, with what changes:
+
+  ./plan_alerts.py plan Project.REDCap.xml alerts_plan.json
+
+Read it, then apply it. apply downloads the alerts page once, finds each
+planned alert's id by title (ignoring case, REDCap shows Ob_4a), skips any
+that REDCap already has right, and saves the rest in bulk (alert_writer.py):
+
+  ./plan_alerts.py apply alerts_plan.json phpsession csrftoken project
+
+The plan is of the export, REDCap may have moved on since. An alert whose
+settings on the alerts page aren't what the plan says it was changing from
+has been edited since the export: it's reported and left alone, unless
+--force. Each alert keeps REDCap's casing of its title.
+
+Observations with no copy of a template alert in the export are listed in
+the plan as missing. Make those in REDCap first.
+
+Usage
+  ./plan_alerts.py plan Project.REDCap.xml PLAN.json [--all]
+  ./plan_alerts.py apply PLAN.json phpsession csrftoken project
+                   [--workers N] [--rate PER_SECOND] [--retries N] [--force]
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+
+from lxml import etree
+
+from alert_writer import (DEFAULT_RATE, DEFAULT_RETRIES, DEFAULT_WORKERS, Write,
+                          pooled_session, print_results, write_alerts)
+from alerts_page import invalidate, is_redcap_logged_out
+from update_alert import (ALERT_TEMPLATE_TITLE, OBSERVATIONS, alert_changes, alert_settings,
+                          alert_type_obcodes, get_alerts_page_url, load_alerts,
+                          postdata_from_alert, prepare_update, send_alert, shorten)
+
+REDCAP = '{https://projectredcap.org}'
+
+OBCODE = re.compile(r'\bob_(template|\d+[a-z]?)\b')
+
+
+def read_alerts(xmlfilepath):
+    """Every alert's attributes in the export, as alerts page post vars
+    (alert_title -> alert-title). Only the alerts are parsed"""
+    alerts = []
+    for _event, element in etree.iterparse(xmlfilepath, tag=REDCAP + 'Alerts', huge_tree=True):
+        alerts.append({name.replace('_', '-'): value for name, value in element.attrib.items()})
+        element.clear()
+    return alerts
+
+
+def plan(xmlfilepath, obcodes=OBSERVATIONS, everything=False):
+    """The plan: each observation alert that doesn't match what its
+    template makes it (every one if everything), with its settings"""
+    alerts = read_alerts(xmlfilepath)
+    by_title = {(data['alert-title'], data['alert-type']): data for data in reversed(alerts)}
+    types = {title: alert_type for alert_type, title in ALERT_TEMPLATE_TITLE.items()}
+
+    planned = []
+    missing = []
+    unknown = []
+    up_to_date = 0
+    for data in alerts:
+        found = OBCODE.search(data['alert-title'])
+        if found is None or found.group(1) != 'template':
+            continue
+        alert_type = types.get((data['alert-title'], data['alert-type']))
+        if alert_type is None:
+            unknown.append(data['alert-title'])
+            continue
+
+        template_postdata = postdata_from_alert(data)
+        for obcode in alert_type_obcodes(alert_type, obcodes):
+            title = data['alert-title'].replace('ob_template', obcode)
+            target = by_title.get((title, data['alert-type']))
+            if target is None:
+                missing.append({'name': f"{alert_type} {obcode}", 'title': title})
+                continue
+            desired = prepare_update(template_postdata, alert_type, None, None, obcode)
+            changes = alert_changes(postdata_from_alert(target), desired)
+            if not changes and not everything:
+                up_to_date += 1
+                continue
+            planned.append({
+                'name': f"{alert_type} {obcode}",
+                'type': alert_type,
+                'obcode': obcode,
+                'title': title,
+                'alert-type': data['alert-type'],
+                'changes': changes,
+                'postvars': desired,
+            })
+
+    with open(xmlfilepath, 'rb') as file:
+        sha256 = hashlib.sha256(file.read()).hexdigest()
+    return {
+        'projxmlfile': os.path.basename(xmlfilepath),
+        'sha256': sha256,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'up_to_date': up_to_date,
+        'alerts': planned,
+        'missing': missing,
+        'unknown_templates': unknown,
+    }
+
+
+def print_planned(alert, out):
+    """The alert's name and title, and what will change"""
+    out.write(f"{alert['name']} {alert['title']!r}\n")
+    for key, old, new in alert['changes']:
+        out.write(f"    {key}: {shorten(old)!r} -> {shorten(new)!r}\n")
+    if not alert['changes']:
+        out.write("    no change, planned with --all\n")
+
+
+def print_plan(the_plan, out):
+    for alert in the_plan['alerts']:
+        print_planned(alert, out)
+    for alert in the_plan['missing']:
+        out.write(f"{alert['name']}: no alert {alert['title']!r} in the project, make it first\n")
+    for title in the_plan['unknown_templates']:
+        out.write(f"{title!r}: not an alert type update_alert.py knows, not planned\n")
+    out.write(f"\n{len(the_plan['alerts'])} alerts to save, "
+              f"{the_plan['up_to_date']} already up to date\n")
+
+
+def same_setting(key, current, planned):
+    """Titles are matched ignoring case, as the alerts are looked up"""
+    if key == 'alert-title':
+        return (current or '').casefold() == (planned or '').casefold()
+    return current == planned
+
+
+def edited_since(alert, target):
+    """[(post var, value in the export, value now), ...] of the planned
+    changes REDCap's alert no longer has the export's value for"""
+    current = alert_settings(postdata_from_alert(target))
+    return [(key, old, current.get(key)) for key, old, _new in alert['changes']
+            if not same_setting(key, current.get(key), old)]
+
+
+def apply(the_plan, sess, csrftoken, projectid, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE,
+          retries=DEFAULT_RETRIES, force=False):
+    """Save the planned alerts. Those edited in REDCap since the export
+    are left alone unless force. Returns True if they were all saved"""
+    print(f"Plan of {the_plan['projxmlfile']} (sha256 {the_plan['sha256'][:12]}), "
+          f"made {the_plan['created']}")
+    page = load_alerts(sess, projectid)
+
+    writes = []
+    not_found = []
+    edited = []
+    for alert in the_plan['alerts']:
+        found = page.titled(alert['title'], alert['alert-type'])
+        if not found:
+            not_found.append(alert)
+            continue
+        target = found[0]
+        payload = dict(alert['postvars'],
+                       index_modal_update=target['alert-id'], redcap_csrf_token=csrftoken)
+        # Found ignoring case, so keep REDCap's casing of the title
+        if same_setting('alert-title', target.get('alert-title'), payload.get('alert-title')):
+            payload['alert-title'] = target['alert-title']
+        if not alert_changes(postdata_from_alert(target), payload):
+            print(f"{alert['name']} alert {target['alert-id']}: already up to date")
+            continue
+        since = edited_since(alert, target)
+        if since and not force:
+            edited.append((alert, target, since))
+            continue
+        writes.append(Write(alert['name'], target['alert-id'], payload))
+
+    results = write_alerts(lambda payload: send_alert(sess, projectid, payload), writes,
+                           is_redcap_logged_out, workers, rate, retries)
+    invalidate(sess, get_alerts_page_url(projectid))
+    ok = print_results(results, sys.stdout)
+    for alert in not_found:
+        print(f"{alert['name']}: no alert {alert['title']!r} on the alerts page, not saved")
+    for alert, target, since in edited:
+        print(f"{alert['name']} alert {target['alert-id']}: edited in REDCap since the plan "
+              f"was made, not saved (--force to save it anyway)")
+        for key, old, now in since:
+            print(f"    {key}: was {shorten(old)!r}, now {shorten(now)!r}")
+    return ok and not not_found and not edited
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Plan observation alert updates from a project export, and apply the plan")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = commands.add_parser('plan', help="Work out the alert updates, offline")
+    plan_parser.add_argument('projxmlfile', metavar='Project.REDCAP.xml')
+    plan_parser.add_argument('planfile', metavar='PLAN.json')
+    plan_parser.add_argument('--all', action='store_true',
+                             help="Plan every observation alert, not just those that differ")
+
+    apply_parser = commands.add_parser('apply', help="Save a plan's alerts to REDCap")
+    apply_parser.add_argument('planfile', metavar='PLAN.json')
+    apply_parser.add_argument('phpsession')
+    apply_parser.add_argument('csrftoken')
+    apply_parser.add_argument('project')
+    apply_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, metavar='N',
+                              help="Save N alerts at a time (default %(default)s)")
+    apply_parser.add_argument('--rate', type=float, default=DEFAULT_RATE, metavar='PER_SECOND',
+                              help="At most this many requests a second (default %(default)s)")
+    apply_parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, metavar='N',
+                              help="Retry failed saves N times (default %(default)s)")
+    apply_parser.add_argument('--force', action='store_true',
+                              help="Save alerts edited in REDCap since the plan was made too")
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        try:
+            the_plan = plan(args.projxmlfile, everything=args.all)
+        except (OSError, etree.XMLSyntaxError) as exc:
+            sys.exit(str(exc))
+        with open(args.planfile, 'w') as file:
+            json.dump(the_plan, file, indent=1)
+        print_plan(the_plan, sys.stdout)
+        sys.exit(1 if the_plan['missing'] else 0)
+
+    with open(args.planfile) as file:
+        the_plan = json.load(file)
+    sess = pooled_session(args.phpsession, args.workers)
+    ok = apply(the_plan, sess, args.csrftoken, args.project, args.workers, args.rate, args.retries,
+               args.force)
+    sys.exit(0 if ok else 1)
@@ -22,9 +22,33 @@ the appropriate values for OB_COD.
 eg
 
   ./update_alert.py d7kbb39c... 31ee8469.... 984 STAFF_ALERT_COMBINED_SMS 200 290 ob_14b
+
+
+Batch mode updates every observation's copy of the template alerts in one
+run. The Alerts & Notifications page is downloaded once, each observation's
+alert is found on it by title (the template's title with ob_template swapped
+for the obcode), and the updates are sent a few at a time over pooled
+connections, no faster than --rate a second, retrying failures that may be
+temporary (see alert_writer.py). A line per alert and totals are printed at
+the end.
+
+Alerts that already match what the template would make them are skipped,
+the settings of those that don't are compared with the template's and the
+differences listed before anything is sent. --force saves them all anyway.
+
+  ./update_alert.py phpsession csrftoken project --all [type ...]
+                    [--workers N] [--rate PER_SECOND] [--retries N] [--force]
+
+eg
+
+  ./update_alert.py d7kbb39c... 31ee8469.... 984 --all
+  ./update_alert.py d7kbb39c... 31ee8469.... 984 --all LATE_OBS_STAFF_SMS
+
+To work out the updates offline from a project xml export first, and review
+them before anything is sent, see plan_alerts.py.
 """
 
-import json
+import argparse
 import sys
 import re
 from pprint import pprint
@@ -32,6 +56,10 @@ from urllib.parse import parse_qs
 
 import requests
 
+from alert_writer import (DEFAULT_RATE, DEFAULT_RETRIES, DEFAULT_WORKERS, Write,
+                          pooled_session, print_results, write_alerts)
+from alerts_page import LoggedOut, alerts_page, invalidate, is_redcap_logged_out, page_url
+
 
 # These are the html post vars required to update an alert
 # they map *almost* 1-to-1 with a structure set by javascript inside the
@@ -95,9 +123,56 @@ ALERT_TEMPLATE_ID = {
     'LATE_OBS_STAFF_SMS': '307'
 }
 
+# The template alerts by title and type, as in the project xml export
+ALERT_TEMPLATE_TITLE = {
+    'STAFF_ALERT_COMBINED_EMAIL': ('Obs Combined Staff alert email - ob_template', 'EMAIL'),
+    'STAFF_ALERT_COMBINED_SMS': ('Obs Combined Staff alert - ob_template', 'SMS'),
+    'PATIENT_ALERT_COMBINED_SMS': ('Obs Combined Patient alert - ob_template', 'SMS'),
+    'LATE_OBS_STAFF_SMS': ('Late obs staff - ob_template', 'SMS'),
+}
+
+# Post vars that are how the form was filled in rather than the alert's
+# settings, left out when checking if an alert needs saving
+NOT_SETTINGS = {
+    'redcap_csrf_token', 'index_modal_update', 'alert-message-editor',
+    'alert-send-how-many', 'alert-trigger',
+}
+
+# Recipients can be picked from a list or typed into the freeform box
+FREEFORM = {
+    'phone-number-to': 'phone-number-to-freeform',
+    'email-to': 'email-to-freeform',
+    'email-cc': 'email-cc-freeform',
+    'email-bcc': 'email-bcc-freeform',
+}
+
+# Every observation with its own copy of the template alerts
+OBSERVATIONS = ['ob_0'] + [f'ob_{day}{slot}' for day in range(1, 15) for slot in 'ab']
+
+URL = "https://redcap.yourcompay.com/redcap_v9.8.0/index.php"
+
+# Seconds to wait for REDCap to save an alert
+SEND_TIMEOUT = 60
+
 
 def update_alert(sess, template_postdata, alert_type, csrftoken, projectid, alert_index, obcode):
 
+    transformed_data = prepare_update(template_postdata, alert_type, csrftoken, alert_index, obcode)
+
+    for key, val in transformed_data.items():
+        print(f"{key}: {val}")
+
+    payload = transformed_data
+    pprint(payload)
+
+    res = post_alert(sess, projectid, payload)
+    print(res)
+    print(res.text)
+
+
+def prepare_update(template_postdata, alert_type, csrftoken, alert_index, obcode):
+    """The post vars making alert alert_index obcode's copy of the template"""
+
     # Different alerts need us to transform the template in different ways
     # Some are a simple string.replace('_template', '_4a'), some just be set
     # explicitly
@@ -109,15 +184,22 @@ def update_alert(sess, template_postdata, alert_type, csrftoken, projectid, aler
     else:
         sys.exit(f"Unknown alert_type: {alert_type}")
 
-
     # Form update stuff
     transformed_data['index_modal_update'] = alert_index
     transformed_data['redcap_csrf_token'] = csrftoken
+    return transformed_data
 
-    for key, val in transformed_data.items():
-        print(f"{key}: {val}")
 
-    URL = "https://redcap.yourcompay.com/redcap_v9.8.0/index.php"
+def post_alert(sess, projectid, payload):
+    """Save an alert. Exits if we've been logged out"""
+    res = send_alert(sess, projectid, payload)
+    invalidate(sess, get_alerts_page_url(projectid))
+    checkexit_redcap_loggout(res)
+    return res
+
+
+def send_alert(sess, projectid, payload):
+    """POST an alert's settings to REDCap. Returns the response"""
     QVAR_TEMPLATE = "pid=984&route=AlertsController:saveAlert"
 
     template_qvar_data = {k: v[0] for k, v in parse_qs(QVAR_TEMPLATE).items()}
@@ -129,21 +211,112 @@ def update_alert(sess, template_postdata, alert_type, csrftoken, projectid, aler
         'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
     }
 
-    payload = transformed_data
-    pprint(payload)
-
-
     req = requests.Request(
         'POST', url=URL, headers=headers, params=transformed_qvars_data, data=payload)
     prep = req.prepare()
     prep.headers = {**sess.headers, **prep.headers}
 
-    #breakpoint()
-    res = sess.send(prep)
-
-    checkexit_redcap_loggout(res)
-    print(res)
-    print(res.text)
+    return sess.send(prep, timeout=SEND_TIMEOUT)
+
+
+def sync_alerts(sess, csrftoken, projectid, alert_types, obcodes=OBSERVATIONS,
+                workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, retries=DEFAULT_RETRIES,
+                force=False):
+    """Update every observation's copy of each template alert type from one
+    download of the alerts page, workers at a time and at most rate a
+    second (see alert_writer.py). Alerts already the same as the template
+    would make them are left alone unless force. Returns True if every
+    alert was found and saved"""
+    page = load_alerts(sess, projectid)
+
+    writes = []
+    missing = []
+    unchanged = 0
+    for alert_type in alert_types:
+        template = page.by_id.get(ALERT_TEMPLATE_ID[alert_type])
+        if template is None:
+            sys.exit(f"No template alert {ALERT_TEMPLATE_ID[alert_type]} for {alert_type}")
+        template_postdata = postdata_from_alert(template)
+
+        for obcode in alert_type_obcodes(alert_type, obcodes):
+            target = find_alert_copy(page, template, obcode)
+            if target is None:
+                missing.append((alert_type, obcode))
+                continue
+            name = f"{alert_type} {obcode}"
+            desired = prepare_update(template_postdata, alert_type, csrftoken,
+                                     target['alert-id'], obcode)
+            changes = alert_changes(postdata_from_alert(target), desired)
+            if not changes and not force:
+                unchanged += 1
+                continue
+            print_changes(name, target['alert-id'], changes, sys.stdout)
+            writes.append(Write(name, target['alert-id'], desired))
+
+    print(f"{len(writes)} alerts to save, {unchanged} already up to date\n")
+    results = write_alerts(lambda payload: send_alert(sess, projectid, payload), writes,
+                           is_redcap_logged_out, workers, rate, retries)
+    invalidate(sess, get_alerts_page_url(projectid))
+    ok = print_results(results, sys.stdout)
+
+    for alert_type, obcode in missing:
+        print(f"{alert_type} {obcode}: no alert found, not updated")
+    return ok and not missing
+
+
+def alert_settings(postdata):
+    """An alert's post vars as the settings they save, to compare alerts.
+    Leaves out the form housekeeping. Recipients count the same typed into
+    the freeform box or not, None the same as ''"""
+    settings = {}
+    for key, val in postdata.items():
+        if key in NOT_SETTINGS or key in FREEFORM.values():
+            continue
+        if key in FREEFORM:
+            val = postdata.get(FREEFORM[key]) or val
+        if key == 'cron-send-email-on-next-time' and val and re.fullmatch(r'\d\d:\d\d:00', val):
+            val = val[:-3]
+        settings[key] = val or ''
+    return settings
+
+
+def alert_changes(current, desired):
+    """[(post var, current value, desired value), ...] that differ"""
+    current, desired = alert_settings(current), alert_settings(desired)
+    return [(key, current.get(key), desired[key]) for key in sorted(desired)
+            if current.get(key) != desired[key]]
+
+
+def print_changes(name, alert_id, changes, out):
+    out.write(f"{name} alert {alert_id}\n")
+    for key, old, new in changes:
+        out.write(f"    {key}: {shorten(old)!r} -> {shorten(new)!r}\n")
+    if not changes:
+        out.write("    no change, saving anyway\n")
+
+
+def shorten(text, width=70):
+    if text is not None and len(text) > width:
+        return text[:width - 3] + '...'
+    return text
+
+
+def alert_type_obcodes(alert_type, obcodes):
+    """The observations with a copy of the alert type. Nothing is late
+    before ob_0"""
+    if alert_type == 'LATE_OBS_STAFF_SMS':
+        return [obcode for obcode in obcodes if obcode != 'ob_0']
+    return obcodes
+
+
+def find_alert_copy(page, template, obcode):
+    """The obcode's copy of the template alert on the alerts page, by title.
+    The page has 'Ob_template' where the project has 'ob_template'"""
+    title = re.sub('ob_template', obcode, template['alert-title'], flags=re.IGNORECASE)
+    for data in page.titled(title, template['alert-type']):
+        if data['alert-id'] != template['alert-id']:
+            return data
+    return None
 
 
 def prepare_postvars_obs_simplealert(template_postdata, obcode):
@@ -156,8 +329,6 @@ def prepare_postvars_obs_simplealert(template_postdata, obcode):
 
     transformed_data = {}
     for key, vals in template_postdata.items():
-        print(f"{key}: {vals}")
-
         tranformed_key = key.replace('_template', f'_{obcode_trailer}')
 
         # TODO what if that text exists as a literal in the text?
@@ -190,7 +361,7 @@ def prepare_postvars_late_obs_staff(template_postdata, obcode):
     preceding_obprefix, preceding_obnum = get_obs_preceding_obs(obcode).split("_")
 
     # Explicitly set the triggering form to be the PRECEEDING observation
-    transformed_data = template_postdata
+    transformed_data = dict(template_postdata)
     transformed_data['form-name'] = transformed_data['form-name'].replace('_template', f'_{preceding_obnum}')
 
     # Now just replace the rest as usual
@@ -272,12 +443,24 @@ def get_obs_preceding_obs(obcode):
 
 
 def load_postdata_from_template(sess, projectid, template_id):
-    alerts_page_url = get_alerts_page_url(projectid)
-    res = sess.get(alerts_page_url, allow_redirects=False)
-    checkexit_redcap_loggout(res)
+    data = load_alerts(sess, projectid).by_id.get(template_id)
+    if data is None:
+        raise Exception("Could not find template alert structure")
+    return postdata_from_alert(data)
+
+
+def load_alerts(sess, projectid):
+    """The alerts page, parsed (see alerts_page.py). Downloaded at most once
+    a CACHE_SECONDS per session"""
+    try:
+        return alerts_page(sess, get_alerts_page_url(projectid))
+    except LoggedOut:
+        sys.exit("Logged out of REDCap")
 
-    alerts_page_html = res.text
-    data = extract_alert_data_structure(alerts_page_html, template_id)
+
+def postdata_from_alert(data):
+    """The post vars to save an alert, from its structure on the alerts page"""
+    data = dict(data)
 
     # Add the extra post fields
 
@@ -287,7 +470,7 @@ def load_postdata_from_template(sess, projectid, template_id):
 
     data = {
         'alert-send-how-many': None,
-        'index_modal_update': template_id,
+        'index_modal_update': data.get('alert-id'),
         'phone-number-to-freeform': None,
         'email-to-freeform': None,
         'email-cc-freeform': None,
@@ -304,43 +487,53 @@ def load_postdata_from_template(sess, projectid, template_id):
     return filtered
 
 
-def extract_alert_data_structure(alerts_page_html, alertid):
-    """
-    Find the javascript call to open the editor for alertid. Extract params.
-
-    Looks something like this:
-       <script type="text/javascript">function __rcfunc_editEmailAlert_emailRow10(){ editEmailAlert({"alert-id":"200","alert-title":"...},200,11) }</script>
-    """
-    for scriptcall in re.findall(r"editEmailAlert\({(.*)}.*\)", alerts_page_html):
-        if f'"alert-id":"{alertid}"' in scriptcall:
-            data = json.loads("{" + scriptcall + "}")
-            return data
-
-    raise Exception("Could not find template alert structure")
-
-
 def get_alerts_page_url(projectid):
-    # TODO break out to config
-    return f"https://redcap.yourcompay.com/redcap_v9.8.0/index.php?pid={projectid}&route=AlertsController:setup"
+    return page_url(URL, projectid)
 
 
 def checkexit_redcap_loggout(response):
-    """Given a requests response exit with error if we've been logged out.
-
-    Redcap does not give a http response code on logout. You just get back
-    Detect if we've been bumped to a login page and exit"""
-
-    # Quick and dirty. Look for the forgot password link
-    if response.status_code == 302 or 'Authentication/password_recovery.php' in response.text:
+    """Given a requests response exit with error if we've been logged out."""
+    if is_redcap_logged_out(response):
         sys.exit("Logged out of REDCap")
 
 
 if __name__ == '__main__':
 
+    if '--all' in sys.argv[1:]:
+        parser = argparse.ArgumentParser(
+            description="Update every observation's copy of the template alerts")
+        parser.add_argument('phpsession')
+        parser.add_argument('csrftoken')
+        parser.add_argument('project')
+        parser.add_argument('--all', action='store_true', required=True)
+        parser.add_argument('types', nargs='*', metavar='type',
+                            help="Alert types to update (default all)")
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, metavar='N',
+                            help="Save N alerts at a time (default %(default)s)")
+        parser.add_argument('--rate', type=float, default=DEFAULT_RATE, metavar='PER_SECOND',
+                            help="At most this many requests a second (default %(default)s)")
+        parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, metavar='N',
+                            help="Retry failed saves N times (default %(default)s)")
+        parser.add_argument('--force', action='store_true',
+                            help="Save alerts that already match the template too")
+        args = parser.parse_args()
+
+        unknown = [alert_type for alert_type in args.types if alert_type not in ALERT_TEMPLATE_ID]
+        if unknown:
+            sys.exit("Unknown alert type: %s\nKnown types: %s" % (unknown, ALERT_TEMPLATE_ID.keys()))
+
+        # One session for the page and every update, a pooled connection per worker
+        sess = pooled_session(args.phpsession, args.workers)
+        ok = sync_alerts(sess, args.csrftoken, args.project, args.types or list(ALERT_TEMPLATE_ID),
+                         workers=args.workers, rate=args.rate, retries=args.retries,
+                         force=args.force)
+        sys.exit(0 if ok else 1)
+
     if len(sys.argv) != 8:
         sys.exit(
-            "Usage:\n%s phpsession csrftoken project type template target obcode" %
-            sys.argv[0])
+            "Usage:\n%s phpsession csrftoken project type template target obcode\n"
+            "%s phpsession csrftoken project --all [type ...] [--workers N] [--rate R] [--retries N] [--force]"
+            % (sys.argv[0], sys.argv[0]))
 
     phpsessionid = sys.argv[1]
     csrf_token = sys.argv[2]